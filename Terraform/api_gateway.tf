@@ -23,6 +23,24 @@ resource "aws_dynamodb_table" "sunomi-ws-connections" {
     type = "S"
   }
 
+  attribute {
+    name = "videoId"
+    type = "S"
+  }
+
+  # ws-notify looks up the connections of a video by its id
+  global_secondary_index {
+    name            = "videoId-index"
+    hash_key        = "videoId"
+    projection_type = "KEYS_ONLY"
+  }
+
+  # Connections whose disconnect was missed are deleted once they expire
+  ttl {
+    attribute_name = "expiresAt"
+    enabled        = true
+  }
+
   tags = {
     Name   = "sunomi-ws-connections"
     deploy = "terraform"
@@ -114,13 +132,15 @@ resource "aws_iam_policy" "sunomi-ws-notify-lambda-policy" {
         Effect = "Allow"
         Action = [
           "dynamodb:GetItem",
-          "dynamodb:Scan",
+          "dynamodb:Query",
+          "dynamodb:BatchWriteItem",
           "execute-api:ManageConnections",
           "execute-api:Invoke",
           "sns:Subscribe"
         ]
         Resource = [
           aws_dynamodb_table.sunomi-ws-connections.arn,
+          "${aws_dynamodb_table.sunomi-ws-connections.arn}/index/*",
           "${aws_apigatewayv2_api.sunomi-ws.execution_arn}/*",
           aws_sns_topic.transcoder_status.arn
         ]
@@ -142,11 +162,12 @@ resource "aws_iam_role_policy_attachment" "sunomi-ws-notify-lambda-policy-attach
 
 # Lambda function to handle WebSocket connect events
 resource "aws_lambda_function" "sunomi-ws-lambda-connect" {
-  filename      = data.archive_file.connect-lambda.output_path
-  function_name = "sunomi-ws-lambda-connect"
-  role          = aws_iam_role.sunomi-ws-connect-lambda-role.arn
-  handler       = "main.lambda_handler"
-  runtime       = "python3.13"
+  filename         = data.archive_file.connect-lambda.output_path
+  function_name    = "sunomi-ws-lambda-connect"
+  role             = aws_iam_role.sunomi-ws-connect-lambda-role.arn
+  handler          = "main.lambda_handler"
+  runtime          = "python3.13"
+  source_code_hash = data.archive_file.connect-lambda.output_base64sha256
 
   environment {
     variables = {
@@ -171,15 +192,21 @@ resource "aws_lambda_function" "sunomi-ws-lambda-disconnect" {
 }
 
 resource "aws_lambda_function" "sunomi-ws-lambda-notify" {
-  filename      = data.archive_file.notify-lambda.output_path
-  function_name = "sunomi-ws-lambda-notify"
-  role          = aws_iam_role.sunomi-ws-notify-lambda-role.arn
-  handler       = "main.lambda_handler"
-  runtime       = "python3.13"
+  filename         = data.archive_file.notify-lambda.output_path
+  function_name    = "sunomi-ws-lambda-notify"
+  role             = aws_iam_role.sunomi-ws-notify-lambda-role.arn
+  handler          = "main.lambda_handler"
+  runtime          = "python3.13"
+  source_code_hash = data.archive_file.notify-lambda.output_base64sha256
+  # Posts to the connections of a video run concurrently, the videos of a batch one after the other
+  timeout = 30
+
+  layers = [aws_lambda_layer_version.batch_layer.arn]
 
   environment {
     variables = {
       dynamodb_connections_table = aws_dynamodb_table.sunomi-ws-connections.name,
+      dynamodb_connections_index = "videoId-index",
       websocket_api_endpoint = "https://${aws_apigatewayv2_api.sunomi-ws.id}.execute-api.${var.region}.amazonaws.com/${aws_apigatewayv2_stage.sunomi-ws-stage.name}/",
       publish_lambda_name = aws_lambda_function.publish_video.function_name
     }
@@ -244,22 +271,7 @@ resource "aws_lambda_permission" "sunomi-ws-disconnect-permission" {
   source_arn    = "${aws_apigatewayv2_api.sunomi-ws.execution_arn}/*/*"
 }
 
-# Add SNS subscription for notify Lambda
-resource "aws_sns_topic_subscription" "lambda_notification" {
-  topic_arn = aws_sns_topic.transcoder_status.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.sunomi-ws-lambda-notify.arn
-}
-
-# Add permission for SNS to invoke Lambda
-resource "aws_lambda_permission" "with_sns" {
-  statement_id  = "AllowExecutionFromSNS"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.sunomi-ws-lambda-notify.arn
-  principal     = "sns.amazonaws.com"
-  source_arn    = aws_sns_topic.transcoder_status.arn
-}
-
+# The notify Lambda reads the status topic through an SQS queue, see status_queues.tf
 
 
 ### Setup WebSocket with custom domain name and Route 53
@@ -0,0 +1,137 @@
+"""
+Batch handling shared by the Lambdas fed by SNS topics, invoked by SNS directly or through an SQS queue.
+
+Every record of a delivery is handled, not only the first one. Messages of a batch can be collapsed
+per key before they are handled, so a burst of progress updates of a video costs one call. Records
+whose message fails are reported in batchItemFailures: with ReportBatchItemFailures enabled on the
+SQS event source, only they return to the queue. SNS ignores the response, a delivery with a failed
+record raises instead, so the asynchronous retries and the failure destination of the Lambda get it.
+"""
+import json
+
+# Status of the progress messages of the transcoder, their "progress" only holds the qualities that changed
+PROGRESS_STATUS = "TRANSCODING"
+
+
+class BatchItem:
+    """Message decoded from one or more records, collapsed ones keep the ids of every record."""
+
+    def __init__(self, item_id, message):
+        self.item_ids = [item_id]
+        self.message = message
+
+
+def decode_record(record):
+    """
+    Decode the message of an SNS or SQS record.
+
+    An SQS queue subscribed to a topic without raw message delivery receives the SNS envelope, the
+    message is read from it. Status messages sent as a JSON string are decoded twice.
+
+    Returns:
+    - tuple[str, object]: The id of the record, reported when it fails, and its message.
+    """
+    if 'Sns' in record:
+        item_id = record['Sns']['MessageId']
+        message = json.loads(record['Sns']['Message'])
+    else:
+        item_id = record['messageId']
+        message = json.loads(record['body'])
+        if isinstance(message, dict) and message.get('Type') == 'Notification' and 'Message' in message:
+            message = json.loads(message['Message'])
+    if isinstance(message, str):
+        message = json.loads(message)
+    return item_id, message
+
+
+def collect(event, key=None, merge=None):
+    """
+    Decode the records of an event, collapsing their messages per key.
+
+    Parameters:
+    - event (dict): Event of an SNS or SQS invocation.
+    - key (callable | None): Key of a message, messages with the same key may be collapsed. None collapses nothing.
+    - merge (callable | None): Message combining an earlier and a later one of the same key, or None when both
+      must be handled. The later message then collapses with the ones after it.
+
+    Returns:
+    - tuple[list[BatchItem], list[str]]: The items in the order of their records, and the ids of the records
+      that could not be decoded.
+    """
+    items = []
+    failures = []
+    # Last item of each key, the one the next message of the key can collapse into
+    latest = {}
+    for record in event.get('Records', []):
+        try:
+            item_id, message = decode_record(record)
+        except (KeyError, TypeError, ValueError) as e:
+            item_id = record.get('messageId') or record.get('Sns', {}).get('MessageId')
+            print(f"Error decoding record {item_id}: {str(e)}")
+            failures.append(item_id)
+            continue
+
+        item_key = key(message) if key else None
+        if item_key is not None and item_key in latest and merge is not None:
+            item = latest[item_key]
+            merged = merge(item.message, message)
+            if merged is not None:
+                item.message = merged
+                item.item_ids.append(item_id)
+                continue
+
+        item = BatchItem(item_id, message)
+        items.append(item)
+        if item_key is not None:
+            latest[item_key] = item
+    return items, failures
+
+
+def process_batch(event, handle, key=None, merge=None):
+    """
+    Handle every message of an SNS or SQS event, see collect for key and merge.
+
+    Parameters:
+    - event (dict): Event of the invocation.
+    - handle (callable): Called with each message, raising marks its records as failed.
+
+    Returns:
+    - dict: batchItemFailures listing the failed records, the response of an SQS event source with
+      ReportBatchItemFailures.
+
+    Raises:
+    - RuntimeError: When a record of an SNS delivery failed, the whole delivery is retried by Lambda.
+    """
+    items, failures = collect(event, key, merge)
+    for item in items:
+        try:
+            handle(item.message)
+        except Exception as e:
+            print(f"Error handling {', '.join(item.item_ids)}: {str(e)}")
+            failures += item.item_ids
+
+    records = event.get('Records', [])
+    print(f"Handled {len(items)} messages from {len(records)} records, {len(failures)} records failed")
+    if failures and any('Sns' in record for record in records):
+        raise RuntimeError(f"{len(failures)} of {len(records)} SNS records failed: {', '.join(map(str, failures))}")
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failures]}
+
+
+def progress_key(message):
+    """Progress messages collapse per video."""
+    if isinstance(message, dict) and message.get('videoId'):
+        return message['videoId']
+    return None
+
+
+def merge_progress(earlier, later):
+    """
+    Combine two messages of a video into the latest state, when both are progress messages. Each one
+    only holds the qualities that changed, the later value of a quality wins. Any other status is
+    handled on its own, so a completion or an error is never dropped.
+    """
+    if earlier.get('status') != PROGRESS_STATUS or later.get('status') != PROGRESS_STATUS:
+        return None
+    merged = dict(later)
+    merged['progress'] = {**(earlier.get('progress') or {}), **(later.get('progress') or {})}
+    return merged
@@ -0,0 +1,122 @@
+"""
+Runtime shared by the database Lambdas, shipped next to PyMySQL in the mysql layer.
+
+Everything is kept at module scope, so it survives across the warm invocations of an execution
+environment: AWS clients are created on first use, secrets are cached for SECRET_TTL seconds, and
+the MySQL connection stays open, checked with a ping before it is reused.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+import boto3
+import pymysql
+from botocore.exceptions import ClientError
+
+# Seconds a secret is reused before it is read again, so a rotated password is picked up
+SECRET_TTL = float(os.environ.get('SECRET_TTL', '300'))
+# MySQL error returned for a wrong password, the cached one may have been rotated
+ACCESS_DENIED = 1045
+
+_clients = {}
+_secrets = {}
+_connection = None
+
+
+def get_client(service_name, region_name=None):
+    """boto3 client of a service, created on the first call and reused afterwards."""
+    key = (service_name, region_name)
+    if key not in _clients:
+        _clients[key] = boto3.client(service_name=service_name, region_name=region_name)
+    return _clients[key]
+
+
+def get_secret(secret_name, region_name):
+    """JSON secret from Secrets Manager, cached for SECRET_TTL seconds."""
+    cached = _secrets.get(secret_name)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    try:
+        get_secret_value_response = get_client('secretsmanager', region_name).get_secret_value(SecretId=secret_name)
+    except ClientError as e:
+        print(f"Error retrieving secret: {e}")
+        raise e
+    secret = json.loads(get_secret_value_response["SecretString"])
+    _secrets[secret_name] = (time.monotonic() + SECRET_TTL, secret)
+    return secret
+
+
+def _connect():
+    secret_name = os.environ['SECRET_NAME']
+    region_name = os.environ['REGION_NAME']
+    for attempt in range(2):
+        secret = get_secret(secret_name, region_name)
+        try:
+            return pymysql.connect(
+                host=os.environ['DB_HOST'],
+                user=secret["username"],
+                password=secret["password"],
+                database=os.environ['DB_NAME']
+            )
+        except pymysql.OperationalError as e:
+            if e.args[0] != ACCESS_DENIED or attempt:
+                raise
+            print("Database access denied, reading the secret again...")
+            _secrets.pop(secret_name, None)
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except pymysql.Error:
+            pass
+        _connection = None
+
+
+def get_connection(retries=0, backoff_in_seconds=1):
+    """
+    MySQL connection to DB_NAME on DB_HOST with the credentials of SECRET_NAME, reused across warm
+    invocations. A connection the server dropped while the environment was frozen fails its ping and
+    is replaced. Connecting is retried with an exponential backoff up to retries times.
+    """
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.ping(reconnect=False)
+            return _connection
+        except pymysql.Error:
+            print("Database connection lost, reconnecting...")
+            close_connection()
+
+    attempt = 0
+    while True:
+        try:
+            _connection = _connect()
+            return _connection
+        except pymysql.OperationalError:
+            if attempt == retries:
+                raise
+            wait = backoff_in_seconds * 2 ** attempt
+            print(f"Database connection attempt {attempt + 1} failed. Retrying in {wait} seconds...")
+            time.sleep(wait)
+            attempt += 1
+
+
+@contextmanager
+def transaction(retries=0, backoff_in_seconds=1):
+    """Cursor on the shared connection, committed when the block succeeds and rolled back otherwise."""
+    conn = get_connection(retries, backoff_in_seconds)
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except pymysql.Error:
+            # The connection is unusable, the next invocation opens a new one
+            close_connection()
+        raise
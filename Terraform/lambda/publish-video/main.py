@@ -1,69 +1,20 @@
-import os
-import pymysql
-import json
-import boto3
-from botocore.exceptions import ClientError
+from lambda_batch import process_batch, progress_key
+from lambda_runtime import transaction
 
-def get_secret(secret_name, region_name):
-
-    # Create a Secrets Manager client
-    client = boto3.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-        secret = get_secret_value_response["SecretString"]
-        return json.loads(secret)  # Convert JSON string to dictionary
-    except ClientError as e:
-        print(f"Error retrieving secret: {e}")
-        raise e
-
-def lambda_handler(event, context):
-    # Get database connection details from environment variables
-    db_host = os.environ['DB_HOST']
-    db_name = os.environ['DB_NAME']
-    secret_name = os.environ['SECRET_NAME']
-    region_name = os.environ['REGION_NAME']
-
-    secret = get_secret(secret_name, region_name)
-    db_user = secret["username"]
-    db_password = secret["password"]
-
-
-    message = json.loads(event['Records'][0]['Sns']['Message'])
-    if isinstance(message, str):
-        event_data = json.loads(message)
-    else:
-        event_data = message
-        
+def publish(event_data):
     video_id = event_data.get('videoId')
     if not video_id:
         raise ValueError("videoId is required in the event")
-        
 
-    # Connect to the database
-    conn = pymysql.connect(
-        host=db_host,
-        user=db_user,
-        password=db_password,
-        database=db_name
-    )
+    # The connection and the database credentials are reused across warm invocations
+    with transaction() as cursor:
 
-    try:
-        with conn.cursor() as cursor:
-            
-            cursor.execute("""
-                UPDATE videos 
-                SET status = 'PUBLIC' 
-                WHERE id = %s
-                """, (video_id,))
+        cursor.execute("""
+            UPDATE videos
+            SET status = 'PUBLIC'
+            WHERE id = %s
+            """, (video_id,))
 
-
-        conn.commit()
-        return {"statusCode": 200, "body": "Status updated successfully"}
-    except Exception as e:
-        return {"statusCode": 500, "body": f"Error updating video status: {str(e)}"}
-    finally:
-        conn.close()
\ No newline at end of file
+def lambda_handler(event, context):
+    # PLAYABLE and COMPLETED of the same video publish it alike, it is updated once per batch
+    return process_batch(event, publish, key=progress_key, merge=lambda earlier, later: later)
@@ -1,17 +1,15 @@
 import boto3
 import os
-import json
+from lambda_batch import process_batch
 
-def lambda_handler(event, context):
+def start_moderation(sns_message):
+    """Start the content moderation of every upload of an S3 event."""
     rekognition = boto3.client('rekognition')
-    s3 = boto3.client('s3')
-    
 
-    sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-    bucket = sns_message['Records'][0]['s3']['bucket']['name']
-    video = sns_message['Records'][0]['s3']['object']['key']
-    
-    try:
+    for record in sns_message.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        video = record['s3']['object']['key']
+
         response = rekognition.start_content_moderation(
             Video={
                 'S3Object': {
@@ -24,14 +22,7 @@ def lambda_handler(event, context):
                 'RoleArn': os.environ['REKOGNITION_ROLE_ARN']
             }
         )
-        
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'JobId': response['JobId']
-            })
-        }
-        
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        raise e
\ No newline at end of file
+        print(f"Content moderation job {response['JobId']} started for {video}")
+
+def lambda_handler(event, context):
+    return process_batch(event, start_moderation)
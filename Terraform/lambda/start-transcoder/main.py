@@ -1,71 +1,265 @@
 import os
 import json
+import math
 import boto3
 from botocore.exceptions import BotoCoreError, ClientError
+from lambda_batch import process_batch
 
-def lambda_handler(event, context):
-    try:
-        sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-        record = sns_message['Records'][0]
-        bucket_name = record['s3']['bucket']['name']
-        object_key = record['s3']['object']['key']
+# Rungs of the transcoder ladder (src/transcoder-aws/video_quality.py), by label and short side, highest first
+LADDER = [("2160p", 2160), ("1440p", 1440), ("1080p", 1080), ("720p", 720), ("480p", 480), ("360p", 360)]
+# HLS_SEGMENT_DURATION of the transcoder, time ranges start on segment boundaries
+SEGMENT_DURATION = 6
+# FANOUT_PREFIX of the transcoder (src/transcoder-aws/fanout.py), the parts of a video report under it
+FANOUT_PREFIX = "fanout"
+# The moov box of a long video is a few MB, larger ones are not worth reading to plan the job
+MAX_MOOV_SIZE = 32 * 1024 * 1024
 
-        s3_bucket_name = bucket_name
-        status_topic = os.environ['STATUS_TOPIC']
-        cluster_name = os.environ['ECS_CLUSTER_NAME']
-        task_definition = os.environ['ECS_TASK_DEFINITION']
-        task_container_name = os.environ['ECS_TASK_CONTAINER_NAME']
-        subnets = os.environ['SUBNETS'].split(',')
-        security_groups = os.environ['SECURITY_GROUPS'].split(',')
+# Fan-out: "off" starts one task per upload, "rungs" one task per rung of the ladder, "chunks" one task per time range
+# of FANOUT_CHUNK_SECONDS. Uploads smaller than FANOUT_MIN_BYTES, or whose MP4 header cannot be read, use a single task
+FANOUT_MODE = os.environ.get('FANOUT_MODE', 'off')
+FANOUT_MIN_BYTES = int(os.environ.get('FANOUT_MIN_BYTES', str(512 * 1024 * 1024)))
+FANOUT_CHUNK_SECONDS = int(os.environ.get('FANOUT_CHUNK_SECONDS', '600'))
+FANOUT_MAX_PARTS = int(os.environ.get('FANOUT_MAX_PARTS', '10'))
+# HLS_PACKAGING of the transcoder. An fMP4 rendition is a single file, it cannot be split in time ranges
+HLS_PACKAGING = os.environ.get('HLS_PACKAGING', 'ts')
 
-        video_id = object_key.split('/')[0]
 
-        ecs_client = boto3.client('ecs')
-      
-        container_overrides = [
+def iter_boxes(data, offset=0, end=None):
+    """Yield the type, payload start and end of the ISO BMFF boxes in data[offset:end]."""
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        box_type = data[offset + 4:offset + 8]
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+
+def read_mp4_header(s3_client, bucket, key, object_size):
+    """
+    Read the duration and frame size of an MP4/MOV upload from its moov box, with ranged GETs
+    and without downloading the media data.
+
+    Returns:
+    - tuple[float, int, int] | None: Duration in seconds, width and height, None if the header cannot be read.
+    """
+    offset = 0
+    moov = None
+    while offset + 8 <= object_size:
+        header = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + 15}")['Body'].read()
+        size = int.from_bytes(header[0:4], 'big')
+        box_type = header[4:8]
+        if size == 1:
+            size = int.from_bytes(header[8:16], 'big')
+        elif size == 0:
+            size = object_size - offset
+        if size < 8:
+            return None
+        if box_type == b'moov':
+            if size > MAX_MOOV_SIZE:
+                return None
+            moov = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + size - 1}")['Body'].read()
+            break
+        offset += size
+    if moov is None:
+        return None
+
+    duration = None
+    width = height = 0
+    for box_type, start, end in iter_boxes(moov, 0):
+        if box_type != b'moov':
+            continue
+        for child_type, child_start, child_end in iter_boxes(moov, start, end):
+            if child_type == b'mvhd':
+                # Version 1 boxes have 64-bit times and duration
+                if moov[child_start] == 1:
+                    timescale = int.from_bytes(moov[child_start + 20:child_start + 24], 'big')
+                    length = int.from_bytes(moov[child_start + 24:child_start + 32], 'big')
+                else:
+                    timescale = int.from_bytes(moov[child_start + 12:child_start + 16], 'big')
+                    length = int.from_bytes(moov[child_start + 16:child_start + 20], 'big')
+                duration = length / timescale if timescale else None
+            elif child_type == b'trak':
+                for track_type, track_start, track_end in iter_boxes(moov, child_start, child_end):
+                    if track_type == b'tkhd':
+                        # Width and height end the box, in 16.16 fixed point, and are 0 for audio tracks
+                        width = max(width, int.from_bytes(moov[track_end - 8:track_end - 4], 'big') >> 16)
+                        height = max(height, int.from_bytes(moov[track_end - 4:track_end], 'big') >> 16)
+    if not duration or not width or not height:
+        return None
+    return duration, width, height
+
+
+def plan_parts(object_size, header):
+    """
+    Split the transcode of an upload into the environment overrides of the tasks to start.
+
+    A single task with no override encodes the whole job. Fanned-out tasks get RUN_MODE "part",
+    their index among the parts and their share: the rungs or the time range they encode, and
+    whether they encode the audio and the previews of the whole video.
+    """
+    if FANOUT_MODE == 'off' or object_size < FANOUT_MIN_BYTES or header is None:
+        return [{}]
+    duration, width, height = header
+    # Time ranges of an fMP4 rendition would all write its single media file, its rungs are split instead
+    mode = 'rungs' if FANOUT_MODE == 'chunks' and HLS_PACKAGING == 'fmp4' else FANOUT_MODE
+
+    if mode == 'rungs':
+        short_side = min(width, height)
+        rungs = [label for label, rung_height in LADDER if rung_height <= short_side]
+        # The lowest rungs cost a fraction of the top one, they share the last part with the extras
+        if len(rungs) > FANOUT_MAX_PARTS:
+            parts = [[label] for label in rungs[:FANOUT_MAX_PARTS - 1]] + [rungs[FANOUT_MAX_PARTS - 1:]]
+        elif len(rungs) > 2:
+            parts = [[label] for label in rungs[:-2]] + [rungs[-2:]]
+        else:
+            parts = [[label] for label in rungs]
+        overrides = [
+            {"PART_RENDITIONS": ",".join(labels), "PART_EXTRAS": str(index == len(parts) - 1).lower()}
+            for index, labels in enumerate(parts)
+        ]
+    else:
+        # Ranges of equal length, a whole number of segments each, the last one runs to the end of the video
+        count = min(FANOUT_MAX_PARTS, math.ceil(duration / max(FANOUT_CHUNK_SECONDS, SEGMENT_DURATION)))
+        chunk = math.ceil(duration / max(count, 1) / SEGMENT_DURATION) * SEGMENT_DURATION
+        count = math.ceil(duration / chunk)
+        overrides = [
             {
-                "name": task_container_name,  
-                "environment": [
-                    {"name": "S3_BUCKET_NAME", "value": s3_bucket_name},
-                    {"name": "VIDEO_ID", "value": video_id},
-                    {"name": "STATUS_TOPIC", "value": status_topic},
-                    {"name": "VIDEO_PATH", "value": object_key},
-                ],
+                "PART_START": str(index * chunk),
+                "PART_END": str((index + 1) * chunk) if index < count - 1 else "",
+                "PART_EXTRAS": str(index == 0).lower(),
             }
+            for index in range(count)
         ]
 
-        response = ecs_client.run_task(
-            cluster=cluster_name,
-            taskDefinition=task_definition,
-            overrides={"containerOverrides": container_overrides},
-            launchType="FARGATE", 
-            networkConfiguration={
-                "awsvpcConfiguration": {
-                    "subnets": subnets,  
-                    "securityGroups": security_groups, 
-                    "assignPublicIp": "DISABLED",
-                }
-            },
+    if len(overrides) < 2:
+        return [{}]
+    for index, override in enumerate(overrides):
+        override.update({"RUN_MODE": "part", "PART_INDEX": str(index), "PART_COUNT": str(len(overrides))})
+    return overrides
+
+
+def abort_transcode(ecs_client, s3_client, sns_client, bucket_name, video_id, task_arns, error):
+    """
+    Undo a transcode whose tasks did not all start: stop the ones that did, so no merge waits for the
+    missing parts, remove what they reported, and send the ERROR status the transcoder would have sent.
+    """
+    for task_arn in task_arns:
+        try:
+            ecs_client.stop_task(cluster=os.environ['ECS_CLUSTER_NAME'], task=task_arn, reason="Another part of the job failed to start")
+        except (BotoCoreError, ClientError) as e:
+            print(f"Could not stop task {task_arn}: {e}")
+
+    try:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        keys = [
+            item['Key']
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{FANOUT_PREFIX}/{video_id}/")
+            for item in page.get('Contents', [])
+        ]
+        if keys:
+            s3_client.delete_objects(Bucket=bucket_name, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+    except (BotoCoreError, ClientError) as e:
+        print(f"Could not clear the fan-out of {video_id}: {e}")
+
+    try:
+        sns_client.publish(
+            TopicArn=os.environ['STATUS_TOPIC'],
+            Message=json.dumps({"videoId": video_id, "progress": None, "status": "ERROR", "error": error})
         )
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error sending SNS message: {e}")
+
+
+def start_transcode(ecs_client, s3_client, bucket_name, object_key, sns_client=None):
+    """
+    Plan the transcode of an upload and start its tasks, returns the number of tasks started.
+    Raises RuntimeError when a task cannot be started, after aborting the transcode.
+    """
+    status_topic = os.environ['STATUS_TOPIC']
+    cluster_name = os.environ['ECS_CLUSTER_NAME']
+    task_definition = os.environ['ECS_TASK_DEFINITION']
+    task_container_name = os.environ['ECS_TASK_CONTAINER_NAME']
+    subnets = os.environ['SUBNETS'].split(',')
+    security_groups = os.environ['SECURITY_GROUPS'].split(',')
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": "ECS task started successfully"
-            })
+    video_id = object_key.split('/')[0]
+
+    header = None
+    object_size = 0
+    if FANOUT_MODE != 'off':
+        object_size = s3_client.head_object(Bucket=bucket_name, Key=object_key)['ContentLength']
+        if object_size >= FANOUT_MIN_BYTES:
+            try:
+                header = read_mp4_header(s3_client, bucket_name, object_key, object_size)
+            except (BotoCoreError, ClientError) as e:
+                print(f"Could not read the header of {object_key}, starting a single task: {e}")
+    parts = plan_parts(object_size, header)
+    print(f"Starting {len(parts)} tasks for {object_key}")
+
+    task_arns = []
+    for part in parts:
+        environment = {
+            "S3_BUCKET_NAME": bucket_name,
+            "VIDEO_ID": video_id,
+            "STATUS_TOPIC": status_topic,
+            "VIDEO_PATH": object_key,
+            **part,
         }
+        container_overrides = [
+            {
+                "name": task_container_name,
+                "environment": [{"name": name, "value": value} for name, value in environment.items()],
+            }
+        ]
 
-    except KeyError as e:
-        error_message = f"Missing key in event or environment: {str(e)}"
-        print(error_message)
-        return {"statusCode": 400, "body": error_message}
+        try:
+            response = ecs_client.run_task(
+                cluster=cluster_name,
+                taskDefinition=task_definition,
+                overrides={"containerOverrides": container_overrides},
+                launchType="FARGATE",
+                networkConfiguration={
+                    "awsvpcConfiguration": {
+                        "subnets": subnets,
+                        "securityGroups": security_groups,
+                        "assignPublicIp": "DISABLED",
+                    }
+                },
+            )
+            failures = response.get('failures', [])
+            if not failures and not response.get('tasks'):
+                failures = [{"reason": "No task was started"}]
+        except (BotoCoreError, ClientError) as e:
+            response, failures = {}, [{"reason": str(e)}]
+        task_arns += [task['taskArn'] for task in response.get('tasks', [])]
 
-    except (BotoCoreError, ClientError) as e:
-        error_message = f"Error interacting with AWS: {str(e)}"
-        print(error_message)
-        return {"statusCode": 500, "body": error_message}
-
-    except Exception as e:
-        error_message = f"Unexpected error: {str(e)}"
-        print(error_message)
-        return {"statusCode": 500, "body": error_message}
+        if failures:
+            # The merge waits for every part, without this one the video would stay TRANSCODING forever
+            error = f"Could not start the task of part {part.get('PART_INDEX', 0)}: {failures}"
+            print(error)
+            abort_transcode(ecs_client, s3_client, sns_client or boto3.client('sns'), bucket_name, video_id, task_arns, error)
+            raise RuntimeError(error)
+    return len(parts)
+
+
+def start_uploads(sns_message):
+    """Start the transcode of every upload of an S3 event, the test event S3 sends on setup has none."""
+    ecs_client = boto3.client('ecs')
+    s3_client = boto3.client('s3')
+    for record in sns_message.get('Records', []):
+        bucket_name = record['s3']['bucket']['name']
+        object_key = record['s3']['object']['key']
+        start_transcode(ecs_client, s3_client, bucket_name, object_key)
+
+
+def lambda_handler(event, context):
+    # Each upload is started on its own, a failed one is reported without retrying the others
+    return process_batch(event, start_uploads)
@@ -1,19 +1,17 @@
-import json
 import boto3
-from botocore.exceptions import BotoCoreError, ClientError
+from lambda_batch import process_batch
 
-def lambda_handler(event, context):
-    try:
-        sns_message = json.loads(event['Records'][0]['Sns']['Message'])
-        record = sns_message['Records'][0]
+def start_transcription(sns_message):
+    """Start the transcription of every upload of an S3 event, the test event S3 sends on setup has none."""
+    transcribe_client = boto3.client('transcribe')
+
+    for record in sns_message.get('Records', []):
         bucket_name = record['s3']['bucket']['name']
         object_key = record['s3']['object']['key']
 
         video_id = object_key.split('/')[0]
         s3_bucket_name = bucket_name
 
-        transcribe_client = boto3.client('transcribe')
-
         job_name = f"transcribe-{video_id}"
         output_key = f"{video_id}/transcripts/transcription"
         input_s3_uri = f"s3://{s3_bucket_name}/{video_id}/original.mp4"
@@ -28,22 +26,7 @@ def lambda_handler(event, context):
                 'Formats': ['vtt']
             }
         )
+        print(f"Transcription job {job_name}: {response['TranscriptionJob']['TranscriptionJobStatus']}")
 
-        return {
-            'statusCode': 200,
-            'jobName': job_name,
-            'status': response['TranscriptionJob']['TranscriptionJobStatus'],
-            "body": json.dumps({
-                "message": "Transcription job started successfully"
-            })
-        }
-
-    except (BotoCoreError, ClientError) as e:
-        error_message = f"Error interacting with AWS: {str(e)}"
-        print(error_message)
-        return {"statusCode": 500, "body": error_message}
-
-    except Exception as e:
-        error_message = f"Unexpected error: {str(e)}"
-        print(error_message)
-        return {"statusCode": 500, "body": error_message}
+def lambda_handler(event, context):
+    return process_batch(event, start_transcription)
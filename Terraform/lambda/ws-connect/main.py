@@ -1,11 +1,14 @@
 import json
 import os
+import time
 from datetime import datetime
 import boto3
 
 dynamodb_connections_table = os.environ.get("dynamodb_connections_table")
 if not dynamodb_connections_table:
     raise ValueError("dynamodb_connections_table environment variable is required")
+# Seconds after which DynamoDB deletes a connection whose disconnect was missed, API Gateway closes them after 2 hours
+connection_ttl = int(os.environ.get("connection_ttl_seconds", "7200"))
 
 
 dynamodb = boto3.resource("dynamodb")
@@ -22,7 +25,8 @@ def lambda_handler(event, context):
             Item={
                 'connectionId': connectionId,
                 'videoId': videoId,
-                'timestamp': timestamp
+                'timestamp': timestamp,
+                'expiresAt': int(time.time()) + connection_ttl
             }
         )
 
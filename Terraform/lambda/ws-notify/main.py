@@ -1,115 +1,123 @@
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from boto3.dynamodb.conditions import Key
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from lambda_batch import merge_progress, process_batch, progress_key
 
 # Environment variables
 dynamodb_connections_table = os.environ.get("dynamodb_connections_table")
+dynamodb_connections_index = os.environ.get("dynamodb_connections_index", "videoId-index")
 websocket_api_endpoint = os.environ.get("websocket_api_endpoint")
 publish_lambda_name = os.environ.get("publish_lambda_name")
+# Seconds the connections of a video are cached for, progress messages of a job come every few seconds
+subscribers_ttl = float(os.environ.get("subscribers_ttl_seconds", "5"))
 
 if not dynamodb_connections_table:
     raise ValueError("dynamodb_connections_table environment variable is required")
 if not websocket_api_endpoint:
     raise ValueError("websocket_api_endpoint environment variable is required")
 
-# Initialize AWS clients
+# Connections a message is posted to at the same time
+MAX_CONCURRENT_POSTS = 16
+
+# Initialize AWS clients, reused by the warm invocations like the cache and the thread pool below
 dynamodb = boto3.resource("dynamodb")
 lambda_client = boto3.client('lambda')
 table = dynamodb.Table(dynamodb_connections_table)
 apigatewaymanagementapi = boto3.client(
     'apigatewaymanagementapi',
-    endpoint_url=websocket_api_endpoint
+    endpoint_url=websocket_api_endpoint,
+    config=Config(max_pool_connections=MAX_CONCURRENT_POSTS)
 )
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_POSTS)
+
+# videoId -> (expiry on the monotonic clock, connectionIds)
+subscribers = {}
 
-def get_connection_id(video_id):
-    """Get connectionId for a given videoId from DynamoDB"""
+def get_connection_ids(video_id):
+    """Get the connectionIds subscribed to a videoId, from the videoId index of DynamoDB"""
+    cached = subscribers.get(video_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    connection_ids = []
+    query = {
+        'IndexName': dynamodb_connections_index,
+        'KeyConditionExpression': Key('videoId').eq(video_id),
+        'ProjectionExpression': 'connectionId'
+    }
     try:
-        # Query using the videoId (GSI might be more efficient in production)
-        response = table.scan(
-            FilterExpression=Key('videoId').eq(video_id)
-        )
-        
-        items = response.get('Items', [])
-        if items:
-            return items[0]['connectionId']
-        return None
-        
+        while True:
+            response = table.query(**query)
+            connection_ids += [item['connectionId'] for item in response.get('Items', [])]
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
     except ClientError as e:
         print(f"DynamoDB error: {str(e)}")
-        return None
+        return []
 
-def send_to_connection(connection_id, data):
-    """Send data to a WebSocket connection"""
+    subscribers[video_id] = (time.monotonic() + subscribers_ttl, connection_ids)
+    return connection_ids
+
+def send_to_connection(connection_id, payload):
+    """Send a payload to a WebSocket connection, returns its status: sent, gone or failed"""
     try:
         apigatewaymanagementapi.post_to_connection(
             ConnectionId=connection_id,
-            Data=json.dumps(data)
+            Data=payload
         )
-        return True
+        return "sent"
     except ClientError as e:
         if e.response['Error']['Code'] == 'GoneException':
-            try:
-                table.delete_item(
-                    Key={'connectionId': connection_id}
-                )
-            except ClientError as del_error:
-                print(f"Error deleting stale connection: {str(del_error)}")
-        else:
-            print(f"Error sending message: {str(e)}")
-        return False
+            return "gone"
+        print(f"Error sending message: {str(e)}")
+        return "failed"
 
-def lambda_handler(event, context):
+def delete_stale_connections(video_id, connection_ids):
+    """Delete the connections that are gone, 25 per BatchWriteItem request"""
     try:
-        message = json.loads(event['Records'][0]['Sns']['Message'])
-        if isinstance(message, str):
-            event_data = json.loads(message)
-        else:
-            event_data = message
-            
-        video_id = event_data.get('videoId')
-        if not video_id:
-            raise ValueError("videoId is required in the event")
-
-        connection_id = get_connection_id(video_id)
-        if not connection_id:
-            print(f"No connection found for videoId: {video_id}")
-            return {
-                'statusCode': 404,
-                'body': json.dumps({
-                    'message': 'No connection found for videoId',
-                    'videoId': video_id
-                })
-            }
-
-        success = send_to_connection(connection_id, event_data)
-        
-        if success:
-            return {
-                'statusCode': 200,
-                'body': json.dumps({
-                    'message': 'Successfully sent message',
-                    'videoId': video_id,
-                    'connectionId': connection_id
-                })
-            }
-        else:
-            return {
-                'statusCode': 500,
-                'body': json.dumps({
-                    'message': 'Failed to send message',
-                    'videoId': video_id,
-                    'connectionId': connection_id
-                })
-            }
-
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'message': 'Error processing request',
-                'error': str(e)
-            })
-        }
\ No newline at end of file
+        with table.batch_writer() as batch:
+            for connection_id in connection_ids:
+                batch.delete_item(Key={'connectionId': connection_id})
+    except ClientError as del_error:
+        print(f"Error deleting stale connections: {str(del_error)}")
+
+    cached = subscribers.get(video_id)
+    if cached is not None:
+        subscribers[video_id] = (cached[0], [connection_id for connection_id in cached[1] if connection_id not in connection_ids])
+
+def send_to_subscribers(video_id, data):
+    """Send data to every connection subscribed to a videoId at the same time, returns the status of each one"""
+    connection_ids = get_connection_ids(video_id)
+    payload = json.dumps(data)
+    statuses = dict(zip(connection_ids, executor.map(lambda connection_id: send_to_connection(connection_id, payload), connection_ids)))
+
+    gone = [connection_id for connection_id, status in statuses.items() if status == "gone"]
+    if gone:
+        delete_stale_connections(video_id, gone)
+    return statuses
+
+def notify(event_data):
+    """Send a status message to the subscribers of its video, raises when every connection failed"""
+    video_id = event_data.get('videoId')
+    if not video_id:
+        raise ValueError("videoId is required in the event")
+
+    statuses = send_to_subscribers(video_id, event_data)
+    if not statuses:
+        print(f"No connection found for videoId: {video_id}")
+        return
+
+    sent = [connection_id for connection_id, status in statuses.items() if status == "sent"]
+    failed = [connection_id for connection_id, status in statuses.items() if status == "failed"]
+    if failed and not sent:
+        raise RuntimeError(f"Failed to send message for videoId {video_id} to {failed}")
+
+def lambda_handler(event, context):
+    # Every record of the batch is sent, progress updates of a video are collapsed into its latest state
+    return process_batch(event, notify, key=progress_key, merge=merge_progress)
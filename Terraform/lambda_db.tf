@@ -59,6 +59,8 @@ resource "null_resource" "copy_layer_files" {
       }
       
       Copy-Item -Path $source -Destination $destination -Recurse -Force
+      # Runtime shared by the database Lambdas: cached secrets, clients and connection
+      Copy-Item -Path "lambda_runtime.py" -Destination $destination -Force
     EOT
 
     interpreter = ["PowerShell", "-Command"]
@@ -80,9 +82,10 @@ resource "aws_lambda_layer_version" "mysql_layer" {
   filename            = data.archive_file.mysql-layer.output_path
   layer_name          = "mysql-layer"
   compatible_runtimes = ["python3.13"]
-  description         = "Installs PyMySQL for Lambda functions"
+  description         = "Installs PyMySQL and the shared runtime for Lambda functions"
 
-//  source_code_hash = filebase64sha256(data.archive_file.mysql-layer.output_path)
+  # Hash of the archive as built, the zip does not exist yet when the plan is made
+  source_code_hash = data.archive_file.mysql-layer.output_base64sha256
 }
 
 
@@ -95,13 +98,16 @@ data "archive_file" "packaging_dependecies" {
 
 
 resource "aws_lambda_function" "publish_video" {
-  filename      = data.archive_file.packaging_dependecies_publish_video.output_path
-  function_name = "publish-video"
-  role          = aws_iam_role.lambda_role.arn
-  handler       = "main.lambda_handler"
-  runtime       = "python3.13"
+  filename         = data.archive_file.packaging_dependecies_publish_video.output_path
+  function_name    = "publish-video"
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "main.lambda_handler"
+  runtime          = "python3.13"
+  source_code_hash = data.archive_file.packaging_dependecies_publish_video.output_base64sha256
+  # Batches of status messages come from an SQS queue, see status_queues.tf
+  timeout          = 30
 
-  layers = [aws_lambda_layer_version.mysql_layer.arn]
+  layers = [aws_lambda_layer_version.mysql_layer.arn, aws_lambda_layer_version.batch_layer.arn]
 
   vpc_config {
     subnet_ids         = aws_subnet.private[*].id
@@ -0,0 +1,118 @@
+# The Lambdas reading the transcoder status topic sit behind SQS queues: a burst of progress messages
+# is delivered in batches, and the messages of a batch that fail are retried on their own
+
+resource "aws_sqs_queue" "notify-dlq" {
+  name                      = "sunomi-ws-notify-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "notify" {
+  name = "sunomi-ws-notify"
+  # Six times the timeout of the Lambda, as advised for SQS event sources
+  visibility_timeout_seconds = 180
+  # Progress is only worth sending while the job runs
+  message_retention_seconds = 3600
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.notify-dlq.arn
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_sqs_queue" "publish-video-dlq" {
+  name                      = "sunomi-publish-video-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "publish-video" {
+  name                       = "sunomi-publish-video"
+  visibility_timeout_seconds = 180
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.publish-video-dlq.arn
+    maxReceiveCount     = 5
+  })
+}
+
+# Allow the status topic to send to the queues
+resource "aws_sqs_queue_policy" "status_queues" {
+  for_each = {
+    notify        = aws_sqs_queue.notify
+    publish-video = aws_sqs_queue.publish-video
+  }
+  queue_url = each.value.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Sid    = "AllowTranscoderStatusTopic"
+        Effect = "Allow"
+        Principal = {
+          Service = "sns.amazonaws.com"
+        }
+        Action   = "sqs:SendMessage"
+        Resource = each.value.arn
+        Condition = {
+          ArnEquals = {
+            "aws:SourceArn" = aws_sns_topic.transcoder_status.arn
+          }
+        }
+      }
+    ]
+  })
+}
+
+resource "aws_sns_topic_subscription" "notify_queue" {
+  topic_arn            = aws_sns_topic.transcoder_status.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.notify.arn
+  raw_message_delivery = true
+}
+
+resource "aws_sns_topic_subscription" "publish_video_queue" {
+  topic_arn            = aws_sns_topic.transcoder_status.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.publish-video.arn
+  raw_message_delivery = true
+  # PLAYABLE is sent by fast-first jobs once the lowest rung is uploaded
+  filter_policy = jsonencode({
+    status = [
+      {
+        prefix = "COMPLETED"
+      },
+      {
+        prefix = "PLAYABLE"
+      }
+    ]
+  })
+  filter_policy_scope = "MessageBody"
+}
+
+# Batches of up to 100 messages, gathered for at most status_batch_window_seconds. The handlers report the
+# messages that failed, the others are deleted from the queue
+resource "aws_lambda_event_source_mapping" "notify" {
+  event_source_arn                   = aws_sqs_queue.notify.arn
+  function_name                      = aws_lambda_function.sunomi-ws-lambda-notify.arn
+  batch_size                         = 100
+  maximum_batching_window_in_seconds = var.status_batch_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "publish_video" {
+  event_source_arn                   = aws_sqs_queue.publish-video.arn
+  function_name                      = aws_lambda_function.publish_video.arn
+  batch_size                         = 100
+  maximum_batching_window_in_seconds = var.status_batch_window_seconds
+  function_response_types            = ["ReportBatchItemFailures"]
+}
+
+resource "aws_iam_role_policy_attachment" "notify_sqs" {
+  role       = aws_iam_role.sunomi-ws-notify-lambda-role.name
+  policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaSQSQueueExecutionRole"
+}
+
+resource "aws_iam_role_policy_attachment" "publish_video_sqs" {
+  role       = aws_iam_role.lambda_role.name
+  policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaSQSQueueExecutionRole"
+}
@@ -0,0 +1,166 @@
+"""
+Harness for lambda_runtime: boto3 and PyMySQL are stubbed and count their external calls, so the reuse
+across warm invocations can be checked without AWS or a database.
+
+Kept out of lambda-layers/mysql, which the layer is built from.
+
+Usage: python -m unittest test_lambda_runtime (from this directory)
+"""
+import importlib
+import json
+import os
+import sys
+import types
+import unittest
+
+# Directory of the shipped module
+RUNTIME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-layers", "mysql")
+
+
+class OperationalError(Exception):
+    pass
+
+
+class FakeConnection:
+    def __init__(self, calls):
+        self.calls = calls
+        self.alive = True
+
+    def ping(self, reconnect=False):
+        self.calls["ping"] += 1
+        if not self.alive:
+            raise OperationalError(2006, "MySQL server has gone away")
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, query, args=None):
+                connection.calls["execute"] += 1
+
+        return Cursor()
+
+    def commit(self):
+        self.calls["commit"] += 1
+
+    def rollback(self):
+        self.calls["rollback"] += 1
+
+    def close(self):
+        self.calls["close"] += 1
+
+
+class FakeSecretsManager:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_secret_value(self, SecretId):
+        self.calls["get_secret_value"] += 1
+        return {"SecretString": json.dumps({"username": "user", "password": f"password-{self.calls['get_secret_value']}"})}
+
+
+class LambdaRuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = {name: 0 for name in ("client", "get_secret_value", "connect", "ping", "execute", "commit", "rollback", "close")}
+        self.now = 1000.0
+        self.connections = []
+
+        def connect(**kwargs):
+            self.calls["connect"] += 1
+            self.connections.append(FakeConnection(self.calls))
+            return self.connections[-1]
+
+        def client(service_name, region_name=None):
+            self.calls["client"] += 1
+            return FakeSecretsManager(self.calls)
+
+        pymysql = types.ModuleType("pymysql")
+        pymysql.Error = Exception
+        pymysql.OperationalError = OperationalError
+        pymysql.connect = connect
+        boto3 = types.ModuleType("boto3")
+        boto3.client = client
+        self.modules = {name: sys.modules.get(name) for name in ("pymysql", "boto3")}
+        sys.modules.update(pymysql=pymysql, boto3=boto3)
+
+        os.environ.update(SECRET_NAME="secret", REGION_NAME="eu-west-1", DB_HOST="db", DB_NAME="sunomi", SECRET_TTL="300")
+        sys.path.insert(0, RUNTIME_DIR)
+        sys.modules.pop("lambda_runtime", None)
+        self.runtime = importlib.import_module("lambda_runtime")
+        self.runtime.time = types.SimpleNamespace(monotonic=lambda: self.now, sleep=lambda seconds: None)
+
+    def tearDown(self):
+        sys.path.pop(0)
+        sys.modules.pop("lambda_runtime", None)
+        for name, module in self.modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def invoke(self):
+        """One warm invocation of a database Lambda."""
+        with self.runtime.transaction() as cursor:
+            cursor.execute("UPDATE videos SET status = 'PUBLIC' WHERE id = %s", ("video",))
+
+    def test_warm_invocations_reuse_secret_and_connection(self):
+        for _ in range(10):
+            self.invoke()
+            self.now += 1
+        self.assertEqual(self.calls["client"], 1)
+        self.assertEqual(self.calls["get_secret_value"], 1)
+        self.assertEqual(self.calls["connect"], 1)
+        # Every reuse of the cached connection is checked first
+        self.assertEqual(self.calls["ping"], 9)
+        self.assertEqual(self.calls["commit"], 10)
+
+    def test_secret_is_read_again_after_ttl(self):
+        self.runtime.get_secret("secret", "eu-west-1")
+        self.now += self.runtime.SECRET_TTL - 1
+        self.runtime.get_secret("secret", "eu-west-1")
+        self.assertEqual(self.calls["get_secret_value"], 1)
+        self.now += 2
+        secret = self.runtime.get_secret("secret", "eu-west-1")
+        self.assertEqual(self.calls["get_secret_value"], 2)
+        self.assertEqual(secret["password"], "password-2")
+
+    def test_failed_ping_reconnects(self):
+        self.invoke()
+        self.connections[0].alive = False
+        self.invoke()
+        self.assertEqual(self.calls["connect"], 2)
+        self.assertEqual(self.calls["close"], 1)
+        self.assertEqual(self.calls["get_secret_value"], 1)
+        self.invoke()
+        self.assertEqual(self.calls["connect"], 2)
+
+    def test_access_denied_reads_the_secret_again(self):
+        connect = sys.modules["pymysql"].connect
+
+        def rotated(**kwargs):
+            if kwargs["password"] == "password-1":
+                self.calls["connect"] += 1
+                raise OperationalError(self.runtime.ACCESS_DENIED, "Access denied")
+            return connect(**kwargs)
+
+        sys.modules["pymysql"].connect = rotated
+        self.invoke()
+        self.assertEqual(self.calls["get_secret_value"], 2)
+        self.assertEqual(self.calls["connect"], 2)
+
+    def test_failed_block_rolls_back(self):
+        with self.assertRaises(ValueError):
+            with self.runtime.transaction():
+                raise ValueError("failed")
+        self.assertEqual(self.calls["rollback"], 1)
+        self.assertEqual(self.calls["commit"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -65,7 +65,8 @@ resource "aws_iam_role_policy" "ecs-ecr-policy" {
           "s3:GetObject",
           "s3:HeadObject",
           "s3:ListBucket",
-          "s3:PutObject"
+          "s3:PutObject",
+          "s3:DeleteObject"
         ]
         Resource = [
           "${aws_s3_bucket.video_bucket.arn}/*",
@@ -103,6 +104,8 @@ resource "aws_ecs_task_definition" "sunomi-ecs-tdf-transcoder" {
       name      = var.sunomi-ecs-tdf-transcoder-container-name
       image     = var.ecr_transcoder
       essential = true
+      # Seconds between SIGTERM and SIGKILL, the transcoder saves its checkpoint in between
+      stopTimeout = 120
       environment = [
         {
           name  = "S3_BUCKET_NAME"
@@ -119,6 +122,17 @@ resource "aws_ecs_task_definition" "sunomi-ecs-tdf-transcoder" {
         {
           name  = "VIDEO_PATH"
           value = ""
+        },
+        {
+          # Unlike the local worker, which defaults to pool, the task decodes the source once for the whole
+          # ladder: its few vCPUs are better spent encoding than decoding the same source once per rung
+          name  = "TRANSCODE_ENGINE"
+          value = "single_pass"
+        },
+        {
+          # Read by the start-transcoder Lambda as well, to plan the fan-out
+          name  = "HLS_PACKAGING"
+          value = var.transcoder_hls_packaging
         }
       ]
       logConfiguration = {
@@ -47,6 +47,22 @@ data "archive_file" "sunomi-rekognition-results" {
   output_path = "lambda/out/rekognition-results.zip"
 }
 
+# Batch handling shared by the Lambdas fed by SNS topics
+data "archive_file" "batch-layer" {
+  type        = "zip"
+  source_dir  = "lambda-layers/batch"
+  output_path = "lambda/out/batch-layer.zip"
+  excludes    = ["python/__pycache__"]
+}
+
+resource "aws_lambda_layer_version" "batch_layer" {
+  filename            = data.archive_file.batch-layer.output_path
+  layer_name          = "batch-layer"
+  compatible_runtimes = ["python3.13"]
+  description         = "Handles every record of SNS and SQS deliveries, with partial batch failures"
+  source_code_hash    = data.archive_file.batch-layer.output_base64sha256
+}
+
 
 resource "aws_lambda_function" "sunomi-start-transcoder" {
   filename         = data.archive_file.sunomi-start-transcoder.output_path
@@ -58,6 +74,8 @@ resource "aws_lambda_function" "sunomi-start-transcoder" {
 
   timeout = 60
 
+  layers = [aws_lambda_layer_version.batch_layer.arn]
+
   environment {
     variables = {
       STATUS_TOPIC            = aws_sns_topic.transcoder_status.arn
@@ -66,6 +84,8 @@ resource "aws_lambda_function" "sunomi-start-transcoder" {
       ECS_TASK_CONTAINER_NAME = var.sunomi-ecs-tdf-transcoder-container-name
       SUBNETS                 = join(",", aws_subnet.private[*].id)
       SECURITY_GROUPS         = aws_security_group.sunomi-ecs-sg-transcoder.id
+      FANOUT_MODE             = var.transcoder_fanout_mode
+      HLS_PACKAGING           = var.transcoder_hls_packaging
     }
   }
 }
@@ -79,6 +99,8 @@ resource "aws_lambda_function" "sunomi-start-transcription" {
   source_code_hash = filebase64sha256(data.archive_file.sunomi-start-transcription.output_path)
 
   timeout = 60
+
+  layers = [aws_lambda_layer_version.batch_layer.arn]
 }
 
 resource "aws_lambda_function" "sunomi-start-rekognition" {
@@ -91,6 +113,8 @@ resource "aws_lambda_function" "sunomi-start-rekognition" {
 
   timeout = 60
 
+  layers = [aws_lambda_layer_version.batch_layer.arn]
+
   environment {
     variables = {
       SNS_TOPIC_ARN         = aws_sns_topic.moderation_results.arn
@@ -108,7 +132,7 @@ resource "aws_lambda_function" "sunomi-rekognition-results" {
   source_code_hash = filebase64sha256(data.archive_file.sunomi-rekognition-results.output_path)
   timeout          = 60
 
-  layers = [aws_lambda_layer_version.mysql_layer.arn]
+  layers = [aws_lambda_layer_version.mysql_layer.arn, aws_lambda_layer_version.batch_layer.arn]
 
   vpc_config {
     subnet_ids         = aws_subnet.private[*].id
@@ -278,6 +302,40 @@ resource "aws_iam_role_policy" "sunomi-start-transcoder-policy" {
         Resource = [
           aws_iam_role.sunomi-ecs-task-role.arn
         ]
+      },
+      {
+        # Ranged reads of the upload header, to plan the fan-out
+        Effect = "Allow"
+        Action = "s3:GetObject"
+        Resource = "arn:aws:s3:::${aws_s3_bucket.video_bucket.bucket}/*"
+      },
+      {
+        # Tasks of a fan-out whose other parts did not start are stopped
+        Effect = "Allow"
+        Action = "ecs:StopTask"
+        Resource = "*"
+        Condition = {
+          ArnEquals = {
+            "ecs:cluster" = aws_ecs_cluster.sunomi-ecs-cluster-transcoder.arn
+          }
+        }
+      },
+      {
+        # Cleanup of a fan-out whose tasks did not all start
+        Effect = "Allow"
+        Action = "s3:ListBucket"
+        Resource = "arn:aws:s3:::${aws_s3_bucket.video_bucket.bucket}"
+      },
+      {
+        Effect = "Allow"
+        Action = "s3:DeleteObject"
+        Resource = "arn:aws:s3:::${aws_s3_bucket.video_bucket.bucket}/fanout/*"
+      },
+      {
+        # ERROR status of a transcode that could not be started
+        Effect = "Allow"
+        Action = "sns:Publish"
+        Resource = aws_sns_topic.transcoder_status.arn
       }
     ]
   })
@@ -532,27 +590,3 @@ resource "aws_iam_role_policy" "rekognition_policy" {
     ]
   })
 }
-
-# Add SNS subscription for publish-video Lambda with filter policy
-resource "aws_sns_topic_subscription" "publish_video_subscription" {
-  topic_arn = aws_sns_topic.transcoder_status.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.publish_video.arn
-  filter_policy = jsonencode({
-    status = [
-      {
-        prefix = "COMPLETED"
-      }
-    ]
-  })
-  filter_policy_scope = "MessageBody"
-}
-
-# Add permission for SNS to invoke Lambda
-resource "aws_lambda_permission" "allow_sns_publish_video" {
-  statement_id  = "AllowExecutionFromSNS"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.publish_video.arn
-  principal     = "sns.amazonaws.com"
-  source_arn    = aws_sns_topic.transcoder_status.arn
-}
\ No newline at end of file
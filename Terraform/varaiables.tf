@@ -49,4 +49,20 @@ variable "ecr_controller" {
 
 variable "use_free_db" {
   default = true
-}
\ No newline at end of file
+}
+
+# Fan-out of large uploads over several transcoder tasks: "off", "rungs" (one task per rung) or "chunks" (one task per
+# time range, MPEG-TS packaging only, fMP4 jobs are split by rung instead). Opt-in, every upload runs in a single task by default
+variable "transcoder_fanout_mode" {
+  default = "off"
+}
+
+# HLS packaging of the transcoder, "ts" or "fmp4"
+variable "transcoder_hls_packaging" {
+  default = "ts"
+}
+
+# Seconds the SQS event sources of the transcoder status Lambdas gather messages before invoking them with a batch
+variable "status_batch_window_seconds" {
+  default = 1
+}
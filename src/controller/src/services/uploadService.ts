@@ -84,14 +84,22 @@ export class UploadService {
 
     try {
       const queueName = process.env.TRANSCODE_QUEUE_NAME!;
+      // The transcoder shares its slots fairly between the users who uploaded the videos
+      const video = await getPrisma().videos.findUnique({
+        where: { id: videoId },
+        select: { userId: true },
+      });
       const message = {
         videoId,
+        userId: video?.userId,
         bucket: "video",
         path: `${videoId}/original.mp4`,
       };
       await channel.assertQueue(queueName, { durable: true });
       channel.sendToQueue(queueName, Buffer.from(JSON.stringify(message)), {
         contentType: "application/json",
+        // Seconds since the epoch, the transcoder measures the queue lag from it
+        timestamp: Math.floor(Date.now() / 1000),
       });
       channel.close();
       console.log(`Published video processing message for videoId: ${videoId}`);
@@ -138,7 +146,8 @@ export class UploadService {
                 callback(content); // Trigger callback with filtered message
               }
 
-              if (content.status === "COMPLETED") {
+              // Fast-first jobs are playable from their lowest rung before they complete
+              if (content.status === "COMPLETED" || content.status === "PLAYABLE") {
                 this.updateVideoStatus(videoId, "PUBLIC");
               }
 
@@ -13,7 +13,7 @@ export interface VideoProgress {
   progress: {
     [key: string]: number;
   } | null;
-  status: "TRANSCODING" | "UPLOADING" | "COMPLETED" | "ERROR";
+  status: "TRANSCODING" | "UPLOADING" | "PLAYABLE" | "COMPLETED" | "ERROR";
   error: string | null;
 }
 
@@ -121,8 +121,13 @@ export default function UploadForm({ file, onCancel }: UploadFormProps) {
       setUploadState(UploadState.PROVISIONING);
 
       UploadService.getTranscodeProgress(videoId, (progress) => {
-        setTranscodeProgress(progress);
-        if (progress.status === "TRANSCODING") {
+        // Progress messages only carry the qualities that changed since the previous one
+        setTranscodeProgress((previous) => ({
+          ...progress,
+          progress: progress.progress ? { ...previous?.progress, ...progress.progress } : previous?.progress ?? null,
+        }));
+        // A playable video keeps transcoding its higher qualities
+        if (progress.status === "TRANSCODING" || progress.status === "PLAYABLE") {
           setUploadState(UploadState.TRANSCODING);
         } else if (progress.status === "COMPLETED") {
           setUploadState(UploadState.COMPLETED);
@@ -1,13 +1,32 @@
-from config import s3_client
+from config import s3_client, SOURCE_INPUT, UPLOAD_CONCURRENCY, UPLOAD_HEDGE_AFTER
+import math
 import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from boto3.s3.transfer import TransferConfig
 from progress import send_combined_progress, ProgressStatus   
 
-def download_s3_file(bucket, object_path):
-    """Download file from S3 given the object name."""
+MB = 1024 * 1024
+MULTIPART_THRESHOLD = 16 * MB
+MAX_MULTIPART_PARTS = 10000
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * MB  # Largest object a single CopyObject request copies
+SOURCE_URL_EXPIRATION = 6 * 60 * 60  # Long enough for the longest transcode
+
+# Closed MPEG-TS segments are streamed during the encode, single-file fMP4 renditions grow until the end and go with the playlists
+SEGMENT_EXTENSIONS = (".ts",)
+# Suffix of the files ffmpeg is still writing, left behind when it fails, they are never uploaded
+TEMP_EXTENSION = ".tmp"
+MASTER_PLAYLIST = "master.m3u8"
+
+
+def download_s3_file(bucket, object_path, temp_dir='./tmp'):
+    """Download file from S3 given the object name, returns None when the download fails."""
     file_name = object_path.split('/')[-1]  # Extract filename from object path
 
     # Ensure the temporary directory exists
-    temp_dir = './tmp'
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
 
@@ -17,25 +36,356 @@ def download_s3_file(bucket, object_path):
     print(f"Downloading {object_path} from S3 bucket '{bucket}' to {local_path}...")
 
     try:
-        # Attempt to download the file
-        s3_client.download_file(bucket, object_path, local_path)
+        # Download with parallel ranged GETs, sharing the connection budget of the uploads
+        config = TransferConfig(multipart_chunksize=16 * MB, max_concurrency=UPLOAD_CONCURRENCY, use_threads=True)
+        s3_client.download_file(bucket, object_path, local_path, Config=config)
         print(f"Downloaded {object_path} to {local_path}")
         return local_path
     except Exception as e:
-        send_combined_progress(ProgressStatus.ERROR, error=str(e))
+        # The caller reports the failure with the ID of the video
         print(f"Error: {e}")
         return None
+
+
+def object_size(bucket, object_path) -> int:
+    """Size of an object in bytes."""
+    return s3_client.head_object(Bucket=bucket, Key=object_path)["ContentLength"]
+
+
+def is_streamable(bucket, object_path, max_boxes: int = 16):
+    """
+    Check whether ffmpeg can read the source front to back without seeking.
+
+    Only MP4/MOV sources with their moov atom after the media data need seeking. The top-level
+    boxes are walked with small ranged GETs, without reading the media data itself.
+    """
+    size = object_size(bucket, object_path)
+    offset = 0
+    for index in range(max_boxes):
+        if offset + 8 > size:
+            return True
+        header = s3_client.get_object(Bucket=bucket, Key=object_path, Range=f"bytes={offset}-{offset + 15}")["Body"].read()
+        box_size = int.from_bytes(header[0:4], "big")
+        box_type = header[4:8]
+        if index == 0 and box_type != b"ftyp":
+            # Not an ISO base media file, let ffmpeg stream it
+            return True
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if box_size == 1:
+            box_size = int.from_bytes(header[8:16], "big")
+        elif box_size == 0:
+            return True
+        offset += box_size
+    return True
+
+
+def open_s3_source(bucket, object_path, temp_dir='./tmp'):
+    """
+    Return the input ffmpeg and ffprobe should read the source from.
+
+    Streamable sources are read through a presigned URL so probing and encoding start on the
+    first bytes. Sources that need seeking, or every source when SOURCE_INPUT is "download",
+    are downloaded to temp_dir first. Returns None when the source cannot be read.
+    """
+    if SOURCE_INPUT == "stream":
+        try:
+            if is_streamable(bucket, object_path):
+                url = s3_client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": bucket, "Key": object_path},
+                    ExpiresIn=SOURCE_URL_EXPIRATION
+                )
+                print(f"Streaming {object_path} from S3 bucket '{bucket}'")
+                return url
+            print(f"{object_path} needs seeking, falling back to a download")
+        except Exception as e:
+            print(f"Could not stream {object_path}, falling back to a download: {e}")
+
+    return download_s3_file(bucket, object_path, temp_dir)
     
 
-def upload_s3_folder(local_path, object_name, encoded_bucked):
-    for root, dirs, files in os.walk(local_path):
-        for file in files:
-            local = os.path.join(root, file)
-            relative = os.path.relpath(local, local_path)
-            s3_path = os.path.join(object_name, relative).replace("\\", "/")
+@dataclass
+class UploadResult:
+    """Outcome of the upload of a single file."""
+    local_path: str
+    s3_path: str
+    size: int
+    attempts: int = 0
+    hedged: bool = False
+    seconds: float = 0.0
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def transfer_config_for(size: int) -> TransferConfig:
+    """Size the transfer of an object: a single PUT for small files, multipart with bounded parts for large ones."""
+    if size < MULTIPART_THRESHOLD:
+        # The bulk uploader already runs files in parallel, do not spawn extra threads per segment
+        return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, use_threads=False)
+
+    chunk_size = max(8 * MB, math.ceil(size / MAX_MULTIPART_PARTS / MB) * MB)
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=chunk_size,
+        max_concurrency=4,
+        use_threads=True
+    )
+
+
+class BulkUploader:
+    """
+    Upload many files to S3 concurrently on a bounded thread pool.
+
+    Every file is retried with exponential backoff. Single-PUT uploads that take longer than
+    hedge_after seconds get a second, hedged request and the first one to finish wins.
+    """
+
+    def __init__(self, encoded_bucket, max_workers: int = UPLOAD_CONCURRENCY, retries: int = 3,
+                 backoff_in_seconds: float = 0.5, hedge_after: float = UPLOAD_HEDGE_AFTER):
+        self.encoded_bucket = encoded_bucket
+        self.retries = retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.hedge_after = hedge_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        # Room for a primary and a hedged request per upload worker
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_workers * 2, thread_name_prefix="upload-hedge")
+
+    def _put(self, local, s3_path, config: TransferConfig):
+        s3_client.upload_file(local, self.encoded_bucket, s3_path, Config=config)
+
+    def _attempt(self, local, s3_path, size: int, result: UploadResult):
+        config = transfer_config_for(size)
+        if not self.hedge_after or size >= MULTIPART_THRESHOLD:
+            self._put(local, s3_path, config)
+            return
+
+        primary = self._hedge_executor.submit(self._put, local, s3_path, config)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            primary.result()
+            return
+
+        # The request is slow, race it against a hedged one and keep whichever finishes first
+        result.hedged = True
+        hedge = self._hedge_executor.submit(self._put, local, s3_path, config)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return
+                error = future.exception()
+        raise error
+
+    def _upload(self, local, s3_path, delete: bool) -> UploadResult:
+        result = UploadResult(local, s3_path, 0)
+        started = time.monotonic()
+        while True:
+            result.attempts += 1
             try:
-                s3_client.upload_file(local, encoded_bucked, s3_path)
-                print(f"Uploaded {s3_path} to S3 bucket '{encoded_bucked}'")
+                result.size = os.path.getsize(local)
+                self._attempt(local, s3_path, result.size, result)
+                result.error = None
+                break
+            except FileNotFoundError as e:
+                # Retrying cannot bring the file back, the upload fails right away
+                result.error = str(e)
+                break
             except Exception as e:
-                send_combined_progress(ProgressStatus.ERROR, error=str(e))
-                print(f"Bucket {encoded_bucked} does not exist or file {s3_path} could not be uploaded.")
\ No newline at end of file
+                result.error = str(e)
+                if result.attempts > self.retries:
+                    break
+                wait_time = self.backoff_in_seconds * 2 ** (result.attempts - 1) * (1 + random.random())
+                print(f"Upload attempt {result.attempts} of {s3_path} failed. Retrying in {wait_time:.1f} seconds...")
+                time.sleep(wait_time)
+
+        result.seconds = time.monotonic() - started
+        if result.ok:
+            print(f"Uploaded {s3_path} to S3 bucket '{self.encoded_bucket}'")
+            if delete:
+                os.remove(local)
+        else:
+            print(f"Bucket {self.encoded_bucket} does not exist or file {s3_path} could not be uploaded: {result.error}")
+        return result
+
+    def submit(self, local, s3_path, delete: bool = False) -> "Future[UploadResult]":
+        """Queue a file for upload, optionally deleting it locally once uploaded."""
+        return self._executor.submit(self._upload, local, s3_path, delete)
+
+    def upload_all(self, files: list[tuple[str, str]], delete: bool = False) -> list[UploadResult]:
+        """Upload (local path, S3 path) pairs concurrently and wait for all of them."""
+        futures = [self.submit(local, s3_path, delete) for local, s3_path in files]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self._hedge_executor.shutdown(wait=True)
+
+
+def s3_key(local, local_path, object_name):
+    relative = os.path.relpath(local, local_path)
+    return os.path.join(object_name, relative).replace("\\", "/")
+
+
+def upload_s3_folder(local_path, object_name, encoded_bucked) -> list[UploadResult]:
+    """Upload a folder to S3 concurrently and return the result of every file."""
+    files = [
+        (os.path.join(root, file), s3_key(os.path.join(root, file), local_path, object_name))
+        for root, dirs, files in os.walk(local_path)
+        for file in files
+    ]
+    # The master playlist goes last so players never see it before the playlists it references
+    master = [item for item in files if os.path.basename(item[0]) == MASTER_PLAYLIST]
+    others = [item for item in files if os.path.basename(item[0]) != MASTER_PLAYLIST]
+
+    uploader = BulkUploader(encoded_bucked)
+    try:
+        results = uploader.upload_all(others)
+        results += uploader.upload_all(master)
+    finally:
+        uploader.shutdown()
+
+    failed = [result for result in results if not result.ok]
+    if failed:
+        send_combined_progress(ProgressStatus.ERROR, error=f"{len(failed)} of {len(results)} files could not be uploaded")
+    return results
+
+
+def copy_s3_prefix(bucket, source_prefix, destination_prefix) -> int:
+    """Server-side copy every object under a prefix to another prefix of the same bucket, returns the number of objects."""
+    items = [
+        item
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=source_prefix)
+        for item in page.get("Contents", [])
+    ]
+
+    def copy(item):
+        key = item["Key"]
+        destination = destination_prefix + key[len(source_prefix):]
+        if item["Size"] < MAX_COPY_OBJECT_SIZE:
+            s3_client.copy_object(Bucket=bucket, Key=destination, CopySource={"Bucket": bucket, "Key": key})
+        else:
+            # A single CopyObject is limited to 5 GB, the managed copy copies larger objects in parts
+            config = TransferConfig(multipart_chunksize=64 * MB, max_concurrency=UPLOAD_CONCURRENCY, use_threads=True)
+            s3_client.copy({"Bucket": bucket, "Key": key}, bucket, destination, Config=config)
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="copy") as executor:
+        list(executor.map(copy, items))
+    return len(items)
+
+
+class StreamingUploader:
+    """
+    Upload HLS segments to S3 while ffmpeg is still encoding.
+
+    ffmpeg writes every segment to a .tmp file and renames it once it is closed, so any
+    segment found under its final name is complete. Uploaded segments are deleted locally.
+    Playlists and thumbnails are uploaded by finish(), with the master playlist last.
+    """
+
+    def __init__(self, local_path, object_name, encoded_bucket, poll_interval: float = 1.0):
+        self.local_path = local_path
+        self.object_name = object_name
+        self.encoded_bucket = encoded_bucket
+        self.poll_interval = poll_interval
+        self.results: list[UploadResult] = []
+        self._submitted: dict[str, Future] = {}
+        # Playlists already uploaded by publish(), with the mtime they were uploaded at
+        self._published: dict[str, float] = {}
+        self._published_results: list[UploadResult] = []
+        # publish() may queue segments from another thread than the watcher
+        self._lock = threading.Lock()
+        self._uploader = BulkUploader(encoded_bucket)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            self.upload_segments()
+
+    def upload_segments(self):
+        """Queue every closed segment found under the local path that is not queued yet."""
+        if not os.path.exists(self.local_path):
+            return
+        with self._lock:
+            for root, dirs, files in os.walk(self.local_path):
+                for file in sorted(files):
+                    local = os.path.join(root, file)
+                    if file.endswith(SEGMENT_EXTENSIONS) and not file.endswith(TEMP_EXTENSION) and local not in self._submitted:
+                        s3_path = s3_key(local, self.local_path, self.object_name)
+                        self._submitted[local] = self._uploader.submit(local, s3_path, delete=True)
+
+    def uploaded_segments(self) -> set[str]:
+        """Local paths of the segments whose upload already succeeded."""
+        with self._lock:
+            futures = list(self._submitted.items())
+        return {local for local, future in futures if future.done() and future.result().ok}
+
+    def publish(self, directories: list[str]) -> list[UploadResult]:
+        """
+        Make finished renditions playable before the job ends: upload their remaining segments,
+        then their playlists, then the master playlist.
+
+        Parameters:
+        - directories (list[str]): Sub-directories of the local path holding the finished renditions.
+        """
+        self.upload_segments()
+        roots = [os.path.join(self.local_path, directory) + os.sep for directory in directories]
+        with self._lock:
+            segments = [future for local, future in self._submitted.items() if local.startswith(tuple(roots))]
+        results = [future.result() for future in segments]
+
+        playlists = [
+            os.path.join(root, file)
+            for root in roots if os.path.isdir(root)
+            for file in os.listdir(root)
+            if not file.endswith(SEGMENT_EXTENSIONS) and not file.endswith(TEMP_EXTENSION)
+        ]
+        master = os.path.join(self.local_path, MASTER_PLAYLIST)
+        for files in (playlists, [master] if os.path.exists(master) else []):
+            uploaded = self._uploader.upload_all([(local, s3_key(local, self.local_path, self.object_name)) for local in files])
+            for result in uploaded:
+                if result.ok:
+                    self._published[result.local_path] = os.path.getmtime(result.local_path)
+            self._published_results += uploaded
+            results += uploaded
+        return results
+
+    def finish(self) -> list[UploadResult]:
+        """Stop watching, upload the remaining segments, then the playlists with the master playlist last."""
+        self._stop.set()
+        self._thread.join()
+        self.upload_segments()
+        self.results = [future.result() for future in self._submitted.values()] + self._published_results
+
+        # Playlists published earlier are only uploaded again if they were rewritten since
+        remaining = [
+            os.path.join(root, file)
+            for root, dirs, files in os.walk(self.local_path)
+            for file in files
+            if not file.endswith(SEGMENT_EXTENSIONS) and not file.endswith(TEMP_EXTENSION)
+            and self._published.get(os.path.join(root, file)) != os.path.getmtime(os.path.join(root, file))
+        ]
+        others = [(local, s3_key(local, self.local_path, self.object_name)) for local in remaining if os.path.basename(local) != MASTER_PLAYLIST]
+        master = [(local, s3_key(local, self.local_path, self.object_name)) for local in remaining if os.path.basename(local) == MASTER_PLAYLIST]
+        try:
+            self.results += self._uploader.upload_all(others)
+            self.results += self._uploader.upload_all(master)
+        finally:
+            self._uploader.shutdown()
+
+        failed = [result for result in self.results if not result.ok]
+        if failed:
+            # Reported from the calling thread, the progress channel is not thread-safe
+            send_combined_progress(ProgressStatus.ERROR, error=f"{len(failed)} of {len(self.results)} files could not be uploaded")
+        return self.results
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import tempfile
+from rendition_planner import fit_dimensions
+from transcode_flow import MediaInfo, source_input_options
+from video_quality import VideoQuality
+
+# The probe encodes a few short samples at a constant quality, the bitrate they need measures the complexity
+PROBE_SAMPLE_DURATION = 4
+PROBE_CRF = 23
+PROBE_PRESET = "veryfast"
+# Rung the samples are encoded at, smaller sources use their own rung
+PROBE_RUNG = VideoQuality.HD
+# Bounds of the bitrate factor: static content never drops below a quarter of the ladder, busy content never exceeds it
+MIN_COMPLEXITY = 0.25
+MAX_COMPLEXITY = 1.0
+
+
+def sample_times(duration: float, samples: int) -> list[float]:
+    """Start times of samples spread evenly over the video, away from intros and end credits."""
+    if duration <= PROBE_SAMPLE_DURATION * samples:
+        return [0.0]
+    margin = duration * 0.05
+    span = duration - 2 * margin - PROBE_SAMPLE_DURATION
+    return [margin + span * (index + 0.5) / samples for index in range(samples)]
+
+
+def encode_sample(file_path, start: float, width: int, height: int, output_path: str) -> float:
+    """Encode one sample at constant quality and return the bitrate it needed, in kbps."""
+    input_options = [arg for key, value in source_input_options(file_path).items() for arg in (f"-{key}", str(value))]
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        *input_options,
+        "-ss", f"{start:.3f}",  # Input seeking, only the sample is decoded
+        "-t", str(PROBE_SAMPLE_DURATION),
+        "-i", file_path,
+        "-map", "0:v:0",
+        "-vf", f"scale={width}:{height}",
+        "-c:v", "libx264", "-preset", PROBE_PRESET, "-crf", str(PROBE_CRF),
+        "-f", "mp4", output_path
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return os.path.getsize(output_path) * 8 / PROBE_SAMPLE_DURATION / 1000
+
+
+def measure_complexity(file_path, media_info: MediaInfo, samples: int) -> float:
+    """
+    Estimate how many bits the content needs compared to the fixed ladder.
+
+    Parameters:
+    - file_path (str): Path or URL of the source video.
+    - media_info (MediaInfo): Probed source video.
+    - samples (int): Number of samples to encode.
+
+    Returns:
+    - float: Factor applied to the ladder bitrates, 1.0 when the probe fails.
+    """
+    rung = VideoQuality.from_height(min(PROBE_RUNG.height, media_info.width, media_info.height)) or VideoQuality.LOW
+    width, height = fit_dimensions(rung, media_info.width, media_info.height)
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bitrates = [
+                encode_sample(file_path, start, width, height, os.path.join(temp_dir, f"sample_{index}.mp4"))
+                for index, start in enumerate(sample_times(media_info.duration, samples))
+            ]
+    except Exception as e:
+        # The probe is an optimization, the fixed ladder still works without it
+        print(f"Complexity probe failed, using the fixed ladder: {e}")
+        return 1.0
+
+    # The busiest sample decides, so short action scenes in a calm video keep their quality
+    needed = max(bitrates)
+    complexity = min(MAX_COMPLEXITY, max(MIN_COMPLEXITY, needed / int(rung.bitrate[:-1])))
+    print(f"Complexity probe: {needed:.0f}k needed at {rung.label} against {rung.bitrate}, factor {complexity:.2f}")
+    return complexity
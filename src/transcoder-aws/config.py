@@ -11,10 +11,78 @@ VIDEO_ID = os.environ.get("VIDEO_ID")
 STATUS_TOPIC = os.environ.get("STATUS_TOPIC")
 VIDEO_PATH = os.environ.get("VIDEO_PATH")
 
+# "full" encodes the whole job. The start-transcoder Lambda fans large uploads out over several tasks, each with
+# RUN_MODE "part", and "merge" writes the master playlist of a fanned-out job once every part reported
+RUN_MODE = os.environ.get("RUN_MODE", "full")
+# Part of a fanned-out job: its index among PART_COUNT parts, the rungs it encodes (all of them when empty), the time
+# range it encodes in seconds (PART_END empty for the rest of the video), and whether it also encodes the audio and previews
+PART_INDEX = int(os.environ.get("PART_INDEX", "0"))
+PART_COUNT = int(os.environ.get("PART_COUNT", "1"))
+PART_RENDITIONS = [label for label in os.environ.get("PART_RENDITIONS", "").split(",") if label]
+PART_START = float(os.environ.get("PART_START", "0"))
+PART_END = float(os.environ["PART_END"]) if os.environ.get("PART_END") else None
+PART_EXTRAS = os.environ.get("PART_EXTRAS", "true").lower() == "true"
+
+# Directory holding the work directory of the job
+WORK_DIR = os.environ.get("WORK_DIR", "./jobs")
+# Scratch space: a job is admitted when the work volume keeps SCRATCH_MIN_FREE_MB free after reserving SCRATCH_RESERVE_FACTOR
+# bytes per source byte. Its playlists, previews and the segments not uploaded yet are staged in SCRATCH_STAGING_DIR, a tmpfs,
+# when it is set and has SCRATCH_STAGING_RESERVE_MB free for the job on top of the reservations of the other staged jobs
+SCRATCH_RESERVE_FACTOR = float(os.environ.get("SCRATCH_RESERVE_FACTOR", "2"))
+SCRATCH_MIN_FREE_MB = int(os.environ.get("SCRATCH_MIN_FREE_MB", "512"))
+SCRATCH_STAGING_DIR = os.environ.get("SCRATCH_STAGING_DIR", "")
+SCRATCH_STAGING_RESERVE_MB = int(os.environ.get("SCRATCH_STAGING_RESERVE_MB", "128"))
+
+# Transcoding engine: "pool" runs one ffmpeg per quality, "single_pass" decodes once for the whole ladder,
+# "chunked" splits the video at keyframes and encodes the chunks of every quality in parallel
+TRANSCODE_ENGINE = os.environ.get("TRANSCODE_ENGINE", "pool")
+# Number of chunks per quality in chunked mode, 0 uses one chunk per CPU
+TRANSCODE_CHUNKS = int(os.environ.get("TRANSCODE_CHUNKS", "0"))
+
+# Per-title bitrates: encode COMPLEXITY_SAMPLES short samples first and scale the ladder to the content
+CONTENT_ADAPTIVE = os.environ.get("CONTENT_ADAPTIVE", "false").lower() == "true"
+COMPLEXITY_SAMPLES = int(os.environ.get("COMPLEXITY_SAMPLES", "3"))
+
+# HLS packaging: "ts" writes one MPEG-TS object per segment, "fmp4" one fMP4 file per rendition addressed by byte range
+HLS_PACKAGING = os.environ.get("HLS_PACKAGING", "ts")
+
+# Thumbnails: widths written in THUMBNAIL_FORMAT ("webp" or "jpeg") next to the JPEG poster, and one trickplay tile every TRICKPLAY_INTERVAL seconds (0 disables the sprites)
+THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp")
+THUMBNAIL_WIDTHS = [int(width) for width in os.environ.get("THUMBNAIL_WIDTHS", "1280,640,320").split(",")]
+TRICKPLAY_INTERVAL = int(os.environ.get("TRICKPLAY_INTERVAL", "10"))
+
+# Fast-first publishing: encode the lowest rung first at FAST_FIRST_PRESET and publish it before the others, with every engine.
+# The lowest rung keeps the quality of FAST_FIRST_PRESET, it is not encoded again at the preset of the ladder
+FAST_FIRST = os.environ.get("FAST_FIRST", "false").lower() == "true"
+FAST_FIRST_PRESET = os.environ.get("FAST_FIRST_PRESET", "veryfast")
+
+# Transcode cache: reuse the renditions of identical sources, entries unused for CACHE_MAX_AGE_DAYS are evicted.
+# Off by default, every job then hashes its whole source before encoding starts
+TRANSCODE_CACHE = os.environ.get("TRANSCODE_CACHE", "false").lower() == "true"
+CACHE_MAX_AGE_DAYS = int(os.environ.get("CACHE_MAX_AGE_DAYS", "90"))
+
+# Seconds between two saves of the checkpoint manifest a restarted job resumes from, 0 disables checkpoints
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "30"))
+
+# Source input: "stream" feeds ffmpeg from a presigned URL when the container allows it, "download" copies it to ./tmp first
+SOURCE_INPUT = os.environ.get("SOURCE_INPUT", "stream")
+
+# Minimum seconds between two progress messages of a job
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "2"))
+
+# Bulk upload tuning: concurrent uploads per job, and seconds before a slow PUT gets a hedged request (0 disables)
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "16"))
+UPLOAD_HEDGE_AFTER = float(os.environ.get("UPLOAD_HEDGE_AFTER", "10"))
+
 # Initialize the S3 client
 s3_client = boto3.client(
     's3',
-    config=Config(signature_version="s3v4")
+    config=Config(
+        signature_version="s3v4",
+        # Shared connection pool sized for concurrent uploads, their hedged requests and multipart parts
+        max_pool_connections=UPLOAD_CONCURRENCY * 4,
+        retries={"max_attempts": 3, "mode": "standard"}
+    )
 )
 
 # Initialize the SNS client
@@ -0,0 +1,208 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+import m3u8
+from botocore.exceptions import ClientError
+from checkpoint import write_playlist
+from config import s3_client, PART_COUNT, PART_END, PART_EXTRAS, PART_INDEX, PART_RENDITIONS, PART_START
+from progress import send_combined_progress, ProgressStatus
+from rendition_planner import Rendition
+from S3_storage import upload_s3_folder
+from transcode_flow import HLS_SEGMENT_DURATION, create_master_playlist
+
+FANOUT_PREFIX = "fanout"
+# Claimed by the part that merges the job, so two parts reporting at the same time do not both merge it
+MERGE_LOCK = "merge.lock"
+
+
+@dataclass(frozen=True)
+class FanoutPart:
+    """Share of a fanned-out job encoded by one task, as planned by the start-transcoder Lambda."""
+    index: int
+    count: int
+    renditions: tuple[str, ...] = ()  # Labels of the rungs to encode, every rung when empty
+    start: float = 0.0
+    end: float | None = None  # None encodes up to the end of the video
+    extras: bool = True  # Whether the part also encodes the audio, the thumbnails and the trickplay sprites
+
+    @classmethod
+    def from_config(cls) -> "FanoutPart":
+        return cls(PART_INDEX, PART_COUNT, tuple(PART_RENDITIONS), PART_START, PART_END, PART_EXTRAS)
+
+    @property
+    def ranged(self) -> bool:
+        """Whether the part encodes a time range, whose segments the merge lists in the playlists."""
+        return self.start > 0 or self.end is not None
+
+    @property
+    def start_number(self) -> int:
+        # Ranges start on segment boundaries, so the segments of a part are numbered after those of the previous ones
+        return round(self.start / HLS_SEGMENT_DURATION)
+
+    def includes(self, quality: Rendition) -> bool:
+        return not self.renditions or quality.label in self.renditions
+
+
+def fanout_prefix(video_id: str) -> str:
+    return f"{FANOUT_PREFIX}/{video_id}/"
+
+
+def report_part(part: FanoutPart, base_path: str, renditions: list[Rendition], audio: bool) -> dict:
+    """
+    Describe the renditions a part encoded, for the merge.
+
+    The playlists of a ranged part only list its own segments. They are read into the report and
+    removed, the merge uploads the playlists of the whole video instead.
+
+    Parameters:
+    - part (FanoutPart): The part.
+    - base_path (str): Directory of the encoded video.
+    - renditions (list[Rendition]): Renditions the part encoded.
+    - audio (bool): Whether the video has an audio rendition, encoded by the part with the extras.
+
+    Returns:
+    - dict: The report, "ok" is false when a rendition has no complete playlist.
+    """
+    report = {
+        "index": part.index,
+        "start": part.start,
+        "renditions": [asdict(rendition) for rendition in renditions],
+        "audio": audio,
+        "segments": {},
+        "ok": True,
+    }
+    for rendition in renditions:
+        playlist_path = os.path.join(base_path, rendition.label, "playlist.m3u8")
+        try:
+            playlist = m3u8.load(playlist_path)
+        except Exception as e:
+            print(f"Error reading the playlist of {rendition.label}: {e}")
+            report["ok"] = False
+            continue
+        if not playlist.is_endlist:
+            report["ok"] = False
+        if part.ranged:
+            report["segments"][rendition.label] = [
+                [segment.uri, segment.duration] + ([segment.byterange] if segment.byterange else [])
+                for segment in playlist.segments
+            ]
+            os.remove(playlist_path)
+    return report
+
+
+def save_report(bucket, video_id: str, report: dict):
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{fanout_prefix(video_id)}part-{report['index']:03d}.json",
+        Body=json.dumps(report).encode("utf-8"),
+        ContentType="application/json"
+    )
+
+
+def list_fanout(bucket, video_id: str) -> list[str]:
+    """Keys of the reports and lock of a fanned-out job."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return [
+        item["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=fanout_prefix(video_id))
+        for item in page.get("Contents", [])
+    ]
+
+
+def claim_merge(bucket, video_id: str, count: int) -> bool:
+    """
+    Whether this task should merge the job: every part reported and no other task claimed the merge.
+    The claim is a conditional write, only the first task creating the lock gets it.
+    """
+    reports = [key for key in list_fanout(bucket, video_id) if os.path.basename(key).startswith("part-")]
+    if len(reports) < count:
+        print(f"{len(reports)} of {count} parts reported, the last one merges the job")
+        return False
+    try:
+        s3_client.put_object(Bucket=bucket, Key=fanout_prefix(video_id) + MERGE_LOCK, Body=b"", IfNoneMatch="*")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+            print("Another part is merging the job")
+            return False
+        raise
+    return True
+
+
+def clear_fanout(bucket, video_id: str):
+    """Delete the reports and lock of a merged job."""
+    keys = list_fanout(bucket, video_id)
+    for index in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[index:index + 1000]], "Quiet": True}
+        )
+
+
+def merge_parts(bucket, video_id: str, local_path: str) -> dict | None:
+    """
+    Merge the parts of a fanned-out job: write the playlists of the ranged renditions from the
+    segments of every part, then the master playlist, and upload them.
+
+    Parameters:
+    - bucket (str): Bucket of the encoded video.
+    - video_id (str): ID of the video.
+    - local_path (str): Empty directory to write the playlists in.
+
+    Returns:
+    - dict | None: The timings of every part, None when the job failed.
+    """
+    print(f"Merging the parts of {video_id}...")
+    prefix = fanout_prefix(video_id)
+    reports = []
+    for key in list_fanout(bucket, video_id):
+        if os.path.basename(key).startswith("part-"):
+            reports.append(json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()))
+    reports.sort(key=lambda report: report["start"])
+
+    failed = [report["index"] for report in reports if not report["ok"]]
+    if failed:
+        send_combined_progress(ProgressStatus.ERROR, video_id, error=f"Parts {failed} of the job failed")
+        print(f"Error: parts {failed} of {prefix} failed")
+        clear_fanout(bucket, video_id)
+        return None
+
+    # Every part plans the same ladder, a rung advertises the highest bitrate any part measured for it
+    renditions: dict[str, Rendition] = {}
+    segments: dict[str, list[list]] = {}
+    for report in reports:
+        for fields in report["renditions"]:
+            rendition = Rendition(**fields)
+            if rendition.label not in renditions or rendition.bandwidth > renditions[rendition.label].bandwidth:
+                renditions[rendition.label] = rendition
+        for label, part_segments in report["segments"].items():
+            segments.setdefault(label, []).extend(part_segments)
+    if not renditions:
+        send_combined_progress(ProgressStatus.ERROR, video_id, error="No rendition was encoded")
+        print("Error: no rendition was encoded")
+        clear_fanout(bucket, video_id)
+        return None
+
+    for label, label_segments in segments.items():
+        # Byte ranges of a single file are distinct segments, the same range twice is not
+        if len({(segment[0], tuple(segment[2:])) for segment in label_segments}) != len(label_segments):
+            # Two parts numbered their segments alike, one overwrote the other in the bucket
+            send_combined_progress(ProgressStatus.ERROR, video_id, error=f"The parts of {label} overlap")
+            print(f"Error: the parts of {label} overlap")
+            clear_fanout(bucket, video_id)
+            return None
+        os.makedirs(os.path.join(local_path, label), exist_ok=True)
+        write_playlist(os.path.join(local_path, label, "playlist.m3u8"), label_segments)
+
+    qualities = sorted(renditions.values(), key=lambda rendition: rendition.bandwidth, reverse=True)
+    create_master_playlist(local_path, qualities, "master.m3u8", any(report["audio"] for report in reports))
+    results = upload_s3_folder(local_path, video_id, bucket)
+    failed_uploads = [result.s3_path for result in results if not result.ok]
+    if failed_uploads:
+        send_combined_progress(ProgressStatus.ERROR, video_id, error=f"Could not upload {', '.join(failed_uploads)}")
+        print(f"Error: could not upload {', '.join(failed_uploads)}")
+        clear_fanout(bucket, video_id)
+        return None
+
+    clear_fanout(bucket, video_id)
+    print(f"Merged {len(reports)} parts into {', '.join(quality.label for quality in qualities)}")
+    return {"parts": [report.get("timings", {}) for report in reports]}
@@ -0,0 +1,77 @@
+"""
+Run the fan-out of an upload locally: the start-transcoder Lambda plans the job, and every ECS task
+it starts runs main.py as a subprocess with the environment overrides of its container.
+
+The S3 and SNS settings of the transcoder are read from the environment as usual, point them at
+MinIO or a moto server with AWS_ENDPOINT_URL to run without AWS.
+
+Usage: python fanout_local.py <bucket> <object key>
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+from config import s3_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_PATH = os.path.join(HERE, "..", "..", "Terraform", "lambda", "start-transcoder", "main.py")
+# Layer the Lambda imports its batch handling from
+LAYER_PATH = os.path.join(HERE, "..", "..", "Terraform", "lambda-layers", "batch", "python")
+# Settings of the Lambda that only matter to ECS, the local client ignores them
+LAMBDA_ENVIRONMENT = {
+    "STATUS_TOPIC": os.environ.get("STATUS_TOPIC", "local"),
+    "ECS_CLUSTER_NAME": "local",
+    "ECS_TASK_DEFINITION": "local",
+    "ECS_TASK_CONTAINER_NAME": "transcoder",
+    "SUBNETS": "local",
+    "SECURITY_GROUPS": "local",
+}
+
+
+class LocalEcsClient:
+    """Stands in for the ECS client of the Lambda, each task is a main.py process."""
+
+    def __init__(self):
+        self.processes: list[subprocess.Popen] = []
+
+    def run_task(self, **kwargs):
+        environment = dict(os.environ)
+        for container in kwargs["overrides"]["containerOverrides"]:
+            environment.update({item["name"]: item["value"] for item in container["environment"]})
+        # Parts share this machine, each one gets its own work directory
+        environment["WORK_DIR"] = os.path.join(os.environ.get("WORK_DIR", "./jobs"), f"task-{len(self.processes)}")
+        self.processes.append(subprocess.Popen([sys.executable, "main.py"], env=environment, cwd=HERE))
+        return {"tasks": [{"taskArn": f"local/{len(self.processes)}"}], "failures": []}
+
+    def stop_task(self, **kwargs):
+        self.processes[int(kwargs["task"].split("/")[1]) - 1].terminate()
+
+    def wait(self) -> int:
+        """Wait for every task, returns the highest exit code."""
+        return max((process.wait() for process in self.processes), default=0)
+
+
+def load_lambda():
+    if LAYER_PATH not in sys.path:
+        sys.path.append(LAYER_PATH)
+    spec = importlib.util.spec_from_file_location("start_transcoder", LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(2)
+    bucket, object_key = sys.argv[1:]
+    os.environ.update({name: value for name, value in LAMBDA_ENVIRONMENT.items() if name not in os.environ})
+
+    ecs_client = LocalEcsClient()
+    tasks = load_lambda().start_transcode(ecs_client, s3_client, bucket, object_key)
+    print(f"Started {tasks} local tasks, waiting for them...")
+    sys.exit(ecs_client.wait())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import math
+import os
+from dataclasses import dataclass, field
+from rendition_planner import Rendition
+
+# Memory an ffmpeg process needs regardless of the resolution
+FFMPEG_BASE_MEMORY = 150 * 1024 * 1024
+# Raw frames x264 keeps in flight: the default rc-lookahead plus a few reference frames
+FRAMES_IN_FLIGHT = 50
+# Share of the memory limit the encoders may use, the rest is left to Python, the uploads and the page cache
+MEMORY_HEADROOM = 0.8
+
+
+def read_cpu_limit() -> float:
+    """Number of CPUs the container may use, from the cgroup CPU quota (v2 or v1) or the CPU affinity."""
+    available = float(len(os.sched_getaffinity(0))) if hasattr(os, "sched_getaffinity") else float(os.cpu_count() or 1)
+
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return min(available, int(quota) / int(period))
+        return available
+    except (OSError, ValueError):
+        pass
+
+    try:
+        # cgroup v1: a quota of -1 means unlimited
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return min(available, quota / period)
+    except (OSError, ValueError):
+        pass
+
+    return available
+
+
+def read_memory_limit() -> int:
+    """Bytes of memory the container may use, from the cgroup memory limit (v2 or v1) or the physical memory."""
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            # "max" on v2, a number close to 2^63 on v1 when unlimited
+            if value != "max":
+                return min(physical, int(value))
+            return physical
+        except (OSError, ValueError):
+            continue
+
+    return physical
+
+
+def encode_cost(quality: Rendition) -> float:
+    """Relative CPU cost of encoding a quality, proportional to its pixel count (1080p = 1)."""
+    return (quality.width * quality.height) / (1920 * 1080)
+
+
+def encode_memory(quality: Rendition, source: Rendition) -> int:
+    """Estimated peak memory of an ffmpeg process decoding the source and encoding one quality."""
+    source_frame = source.width * source.height * 3 // 2  # yuv420p
+    output_frame = quality.width * quality.height * 3 // 2
+    return FFMPEG_BASE_MEMORY + (source_frame + output_frame) * FRAMES_IN_FLIGHT
+
+
+@dataclass
+class ResourcePlan:
+    """How a job spreads its ffmpeg processes over the CPUs and memory of the container."""
+    cpus: float
+    memory: int
+    pool_size: int
+    # Qualities in the order they should be started, most expensive first
+    order: list[Rendition]
+    # -threads of the encoder of every quality
+    threads: dict[Rendition, int] = field(default_factory=dict)
+
+    def describe(self) -> str:
+        threads = ", ".join(f"{quality.label}={self.threads[quality]}" for quality in self.order)
+        return (f"{self.cpus:g} CPUs, {self.memory // (1024 * 1024)} MB: "
+                f"{self.pool_size} concurrent ffmpeg processes, threads {threads}")
+
+
+def plan_resources(qualities: list[Rendition], source: Rendition, engine: str) -> ResourcePlan:
+    """
+    Plan the parallelism of a job so the container stays busy without oversubscribing it.
+
+    Parameters:
+    - qualities (list[Rendition]): Qualities the job encodes.
+    - source (Rendition): Top rendition, the size of the source every process decodes.
+    - engine (str): Transcoding engine, "pool", "single_pass" or "chunked".
+
+    Returns:
+    - ResourcePlan: Pool size, admission order and encoder threads of every quality.
+    """
+    cpus = read_cpu_limit()
+    memory = read_memory_limit()
+    slots = max(1, math.floor(cpus))
+    budget = memory * MEMORY_HEADROOM
+
+    # Longest job first, so the smaller qualities fill the CPUs around the expensive one
+    order = sorted(qualities, key=encode_cost, reverse=True)
+
+    if engine == "single_pass":
+        # A single process, its encoders share the CPUs in proportion to their cost
+        total_cost = sum(encode_cost(quality) for quality in order)
+        threads = {quality: max(1, round(slots * encode_cost(quality) / total_cost)) for quality in order}
+        plan = ResourcePlan(cpus, memory, 1, order, threads)
+    elif engine == "chunked":
+        # Many short single-quality processes: as many as the CPUs and the most expensive one allow
+        fits = max(1, int(budget // encode_memory(order[0], source)))
+        pool_size = max(1, min(slots, fits))
+        threads = {quality: max(1, slots // pool_size) for quality in order}
+        plan = ResourcePlan(cpus, memory, pool_size, order, threads)
+    else:
+        # One process per quality, shrink the pool until the most expensive processes fit in memory together
+        pool_size = min(len(order), slots)
+        while pool_size > 1 and sum(encode_memory(quality, source) for quality in order[:pool_size]) > budget:
+            pool_size -= 1
+
+        concurrent_cost = sum(encode_cost(quality) for quality in order[:pool_size])
+        threads = {
+            quality: min(slots, max(1, round(slots * encode_cost(quality) / concurrent_cost)))
+            for quality in order
+        }
+        plan = ResourcePlan(cpus, memory, pool_size, order, threads)
+
+    print(f"Resource plan ({engine}): {plan.describe()}")
+    return plan
@@ -1,51 +1,274 @@
 from __future__ import annotations
 import os
-from multiprocessing import Pool, Manager
-from S3_storage import download_s3_file, upload_s3_folder
-from transcode_flow import create_master_playlist, get_total_frames, get_video_quality, transcode_to_quality
-from video_quality import VideoQuality
-from progress import send_combined_progress, ProgressStatus
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from multiprocessing import Pool
+from S3_storage import object_size, open_s3_source, StreamingUploader
+from transcode_flow import AUDIO_LABEL, create_master_playlist, max_chunks, probe_media, TranscodeError, transcode_audio, transcode_chunked, transcode_ladder, transcode_to_quality_task
+from rendition_planner import Rendition, plan_renditions
+from complexity import measure_complexity
+from governor import plan_resources
+from cache import CacheUpdate, TranscodeCache, source_digest
+from checkpoint import JobCheckpoint, ResumePoint
+from fanout import FanoutPart, claim_merge, merge_parts, report_part, save_report
+from scratch import ScratchSpace, ScratchSpaceError
+from thumbnails import create_previews
+from timings import JobTimings, Span
+from progress import send_combined_progress, ProgressPublisher, ProgressStatus, SharedProgress
 from config import (
     S3_BUCKET_NAME,
     VIDEO_ID,
-    VIDEO_PATH
+    VIDEO_PATH,
+    CONTENT_ADAPTIVE,
+    COMPLEXITY_SAMPLES,
+    FAST_FIRST,
+    FAST_FIRST_PRESET,
+    TRANSCODE_CACHE,
+    TRANSCODE_ENGINE,
+    CHECKPOINT_INTERVAL,
+    HLS_PACKAGING,
+    RUN_MODE
 )
 
 
-def process_file(file_path, output, videoId):
-    """Transcode the video into all qualities equal to or lower than its actual quality."""
+def process_file(file_path, output, videoId, timings: JobTimings | None = None, uploader: StreamingUploader | None = None, checkpoint: JobCheckpoint | None = None):
+    """
+    Transcode the video into all qualities equal to or lower than its actual quality.
+    Returns the cache entry to register, if any, and raises TranscodeError when the source cannot be transcoded.
+    """
     basePath = os.path.dirname(output)
     os.makedirs(basePath, exist_ok=True)
+    timings = timings if timings is not None else JobTimings()
 
     print(f"Processing file at {file_path}...")
 
-    # Get video total frames
-    video_total_frame = get_total_frames(file_path)
-    if video_total_frame == 0:
+    # Probe the video once, the result is shared with every worker
+    with timings.span("probe"):
+        media_info = probe_media(file_path)
+    if media_info is None or media_info.duration == 0:
+        raise TranscodeError("Unable to get video duration")
+
+    # Scale the bitrates to the content when the complexity probe is enabled
+    complexity = 1.0
+    if CONTENT_ADAPTIVE:
+        if checkpoint is not None and checkpoint.complexity is not None:
+            # A resumed job keeps the ladder of its earlier attempts
+            complexity = checkpoint.complexity
+        else:
+            with timings.span("complexity"):
+                complexity = measure_complexity(file_path, media_info, COMPLEXITY_SAMPLES)
+        if checkpoint is not None:
+            checkpoint.complexity = complexity
+
+    # Fit the ladder to the source, the top rendition is the actual quality of the video
+    qualities_to_process = plan_renditions(media_info, complexity)
+    if not qualities_to_process:
+        raise TranscodeError("Could not determine video quality")
+    actual_quality = qualities_to_process[0]
+    if FAST_FIRST and uploader is not None and len(qualities_to_process) > 1:
+        # The lowest rung is encoded at the fast preset for good, the cache and the checkpoint key it with that preset
+        qualities_to_process[-1] = replace(qualities_to_process[-1], preset=FAST_FIRST_PRESET)
+
+    # Reuse the renditions of an identical source transcoded before, only the missing ones are encoded
+    digest = None
+    qualities_to_encode = qualities_to_process
+    has_audio = media_info.has_audio
+    audio_cached = False
+    if TRANSCODE_CACHE:
+        with timings.span("cache"):
+            digest = source_digest(file_path)
+            cached, audio_cached = TranscodeCache(S3_BUCKET_NAME).restore(digest, qualities_to_process, videoId, has_audio)
+        qualities_to_encode = [quality for quality in qualities_to_process if quality not in cached]
+    encode_audio = has_audio and not audio_cached
+
+    # Renditions completed by an earlier attempt of this job are kept, partial ones resume after their last uploaded segment
+    pending = qualities_to_encode
+    pending_audio = encode_audio
+    resume_points = {}
+    if checkpoint is not None:
+        completed, resume_points = checkpoint.resume(qualities_to_encode, encode_audio, TRANSCODE_ENGINE)
+        pending = [quality for quality in qualities_to_encode if quality.label not in completed]
+        pending_audio = encode_audio and AUDIO_LABEL not in completed
+    audio_resume = resume_points.get(AUDIO_LABEL, ResumePoint())
+
+    # The audio is encoded once, next to the video-only renditions that share it, and the thumbnails
+    # and trickplay sprites come from a keyframe-only decode of their own
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio_future = executor.submit(transcode_audio, file_path, basePath, audio_resume.start, audio_resume.start_number) if pending_audio else None
+        previews_future = executor.submit(create_previews, file_path, basePath, media_info)
+
+        def publish(renditions: list[Rendition]):
+            # Variants may only be published once the audio rendition they reference is complete
+            if audio_future is not None:
+                audio_future.result()
+            publish_renditions(basePath, renditions, uploader, has_audio)
+
+        if FAST_FIRST and uploader is not None and len(pending) > 1:
+            # Make the video playable from its lowest pending rung, then add the others as they finish
+            first = pending[-1]
+            timings.add(encode_qualities(file_path, basePath, [first], actual_quality, media_info, videoId, resume_points=resume_points))
+            playable = [quality for quality in qualities_to_process if quality not in pending] + [first]
+            with timings.span("publish"):
+                publish(playable)
+            send_combined_progress(ProgressStatus.PLAYABLE, videoId)
+
+            def on_rendition_done(quality: Rendition):
+                playable.append(quality)
+                publish(playable)
+
+            timings.add(encode_qualities(file_path, basePath, pending[:-1], actual_quality, media_info, videoId, on_rendition_done, resume_points))
+        elif pending:
+            timings.add(encode_qualities(file_path, basePath, pending, actual_quality, media_info, videoId, resume_points=resume_points))
+
+        if audio_future is not None:
+            timings.add(audio_future.result())
+        timings.add(previews_future.result())
+
+    if checkpoint is not None:
+        checkpoint.complete_resumed()
+
+    # Create a master playlist for all qualities
+    create_master_playlist(basePath, qualities_to_process, "master.m3u8", has_audio)
+
+    if digest is not None:
+        return CacheUpdate(digest, qualities_to_encode, encode_audio)
+    return None
+
+
+def process_part(file_path, output, videoId, part: FanoutPart, timings: JobTimings) -> dict | None:
+    """
+    Transcode the share of a fanned-out job assigned to this task and return its report.
+
+    Every part probes the source and plans the same ladder, then encodes the rungs and the time
+    range of its share. The part with the extras also encodes the audio and the previews of the
+    whole video. The transcode cache and checkpoints are left to unsplit jobs.
+    """
+    basePath = os.path.dirname(output)
+    os.makedirs(basePath, exist_ok=True)
+
+    print(f"Processing part {part.index + 1} of {part.count} of the file at {file_path}...")
+
+    if part.ranged and HLS_PACKAGING == "fmp4":
+        # Every time range would write the single media file of each rendition, the Lambda splits fMP4 jobs by rung
+        print("Error: time ranges cannot be encoded with fMP4 packaging")
+        return None
+
+    with timings.span("probe"):
+        media_info = probe_media(file_path)
+    if media_info is None or media_info.duration == 0:
         print("Unable to get video duration. Exiting.")
-        return
+        return None
+
+    # The complexity probe samples the same frames in every part, they all get the same bitrates
+    complexity = 1.0
+    if CONTENT_ADAPTIVE:
+        with timings.span("complexity"):
+            complexity = measure_complexity(file_path, media_info, COMPLEXITY_SAMPLES)
 
-    # Determine the actual quality of the video
-    actual_quality = get_video_quality(file_path)
-    if not actual_quality:
+    qualities_to_process = plan_renditions(media_info, complexity)
+    if not qualities_to_process:
         print("Could not determine video quality. Exiting.")
-        return
+        return None
+    actual_quality = qualities_to_process[0]
+    qualities = [quality for quality in qualities_to_process if part.includes(quality)]
+    # The Lambda plans the time ranges from the container header, the last one may start past the probed duration
+    if part.start >= media_info.duration:
+        qualities = []
 
-    # Transcode to all qualities below or equal to the actual quality in parallel
-    qualities_to_process = VideoQuality.qualities_below(actual_quality)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio_future = executor.submit(transcode_audio, file_path, basePath) if part.extras and media_info.has_audio else None
+        previews_future = executor.submit(create_previews, file_path, basePath, media_info) if part.extras else None
+        if qualities:
+            points = {quality.label: ResumePoint(part.start, part.start_number) for quality in qualities}
+            timings.add(encode_qualities(file_path, basePath, qualities, actual_quality, media_info, videoId, resume_points=points, end=part.end))
+        else:
+            print("No rendition of the ladder falls in this part")
+        if audio_future is not None:
+            timings.add(audio_future.result())
+        if previews_future is not None:
+            timings.add(previews_future.result())
 
-    # Create a manager for shared progress dictionary
-    with Manager() as manager:
-        shared_progress = manager.dict()
-        
-        # Create a pool of workers (one per transcoding task)
-        with Pool(processes=len(qualities_to_process)) as pool:
-            pool.starmap(transcode_to_quality, [(file_path, basePath, quality, actual_quality, videoId, shared_progress) for quality in qualities_to_process])
+    return report_part(part, basePath, qualities, media_info.has_audio)
 
 
-    # Create a master playlist for all qualities
-    create_master_playlist(basePath, qualities_to_process, "master.m3u8")
+def publish_renditions(basePath, renditions: list[Rendition], uploader: StreamingUploader, audio: bool):
+    """Upload finished renditions, and the audio they share, with a master playlist listing only them."""
+    renditions = sorted(renditions, key=lambda rendition: rendition.bandwidth, reverse=True)
+    create_master_playlist(basePath, renditions, "master.m3u8", audio)
+    uploader.publish([rendition.label for rendition in renditions] + ([AUDIO_LABEL] if audio else []))
+    print(f"Published {', '.join(rendition.label for rendition in renditions)}")
+
+
+def encode_qualities(file_path, basePath, qualities_to_process, actual_quality, media_info, videoId, on_rendition_done=None, resume_points=None, end=None) -> list[Span]:
+    """
+    Encode the given qualities with the configured transcoding engine and return the spans of the work.
+    on_rendition_done is called in this process as soon as each quality is done with the pool engine,
+    and for every quality once the single pass or the chunked encode is done.
+    Qualities with a resume point, by label, continue the encode of an earlier attempt.
+    A part of a fanned-out job starts at its resume points and stops at end.
+    """
+    points = {quality: (resume_points or {}).get(quality.label, ResumePoint()) for quality in qualities_to_process}
+
+    # Size the parallelism to the CPU and memory limits of the container
+    # The time range of a fanned-out part is already a chunk, the pool encodes it
+    engine = "pool" if TRANSCODE_ENGINE == "chunked" and end is not None else TRANSCODE_ENGINE
+    plan = plan_resources(qualities_to_process, actual_quality, engine)
+
+    # Workers write their progress into shared memory, a single publisher thread sends it
+    shared_progress = SharedProgress(
+        [quality.label for quality in qualities_to_process],
+        parts=max_chunks() if engine == "chunked" else 1
+    )
+    publisher = ProgressPublisher(videoId, shared_progress)
+    publisher.start()
 
+    try:
+        if engine == "single_pass":
+            # Decode the source once and encode every quality from the same ffmpeg process
+            # The checkpoint resumes every quality of the pass from the same segment
+            point = points[qualities_to_process[0]]
+            spans = transcode_ladder(file_path, basePath, qualities_to_process, media_info, videoId, shared_progress, plan, point.start, point.start_number, end)
+        elif engine == "chunked":
+            # Encode keyframe-aligned chunks of every quality in parallel and stitch them afterwards
+            spans = transcode_chunked(file_path, basePath, qualities_to_process, media_info, videoId, shared_progress, plan)
+        else:
+            # Create a pool of workers sized by the resource plan, most expensive qualities first
+            spans = []
+            with Pool(processes=plan.pool_size) as pool:
+                tasks = [
+                    (file_path, basePath, quality, media_info, videoId, shared_progress, plan.threads[quality], points[quality].start, points[quality].start_number, end)
+                    for quality in plan.order
+                ]
+                for quality, quality_spans in pool.imap_unordered(transcode_to_quality_task, tasks, chunksize=1):
+                    spans += quality_spans
+                    if on_rendition_done is not None:
+                        on_rendition_done(quality)
+            return spans
+        # The qualities of a single pass or a chunked encode are done together
+        if on_rendition_done is not None:
+            for quality in qualities_to_process:
+                on_rendition_done(quality)
+        return spans
+    finally:
+        publisher.stop()
+        shared_progress.close()
+
+
+
+def save_checkpoint_on_sigterm(checkpoint: JobCheckpoint):
+    """Flush the checkpoint when ECS stops the task (Spot reclamation, deployments, scale-in), then exit."""
+    main_pid = os.getpid()
+
+    def handler(signum, frame):
+        # Pool workers inherit the handler, only the main process owns the checkpoint
+        if os.getpid() == main_pid:
+            print("Task stopping, saving the checkpoint...")
+            checkpoint.stop()
+        # Exit without waiting for the encoders, the next task for this video resumes from the checkpoint
+        os._exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
 
 
 def main():
@@ -55,14 +278,118 @@ def main():
 
     print(f"Received message with object_name: {object_id}")
 
-    # Download the file from S3 and process it
-    file_path = download_s3_file(object_bucket, object_path)
-    output = f"./encoded/{object_id}"
-    process_file(file_path, output, object_id)
-    send_combined_progress(ProgressStatus.UPLOADING, object_id)
-    upload_s3_folder("./encoded/", object_id, S3_BUCKET_NAME)
-    send_combined_progress(ProgressStatus.COMPLETED, object_id)
+    timings = JobTimings()
+
+    # The job works in its own scratch space, removed when it ends whether it failed or not
+    with ScratchSpace(object_id) as scratch:
+        try:
+            scratch.admit(object_size(object_bucket, object_path))
+        except ScratchSpaceError as e:
+            send_combined_progress(ProgressStatus.ERROR, object_id, error=str(e))
+            print(f"Error: {e}")
+            return
+
+        # Stream the file from S3, or download it when it cannot be streamed, and process it
+        with timings.span("source") as span:
+            file_path = open_s3_source(object_bucket, object_path, scratch.source_dir)
+            if file_path and os.path.exists(file_path):
+                span.bytes = os.path.getsize(file_path)
+        if file_path is None:
+            send_combined_progress(ProgressStatus.ERROR, object_id, error=f"Could not read {object_path} from S3")
+            print(f"Error: could not read {object_path} from S3")
+            return
+        output = os.path.join(scratch.encoded_dir, object_id)
+        # Upload the segments while they are being encoded, the playlists follow once everything is done
+        with timings.span("upload") as upload_span:
+            uploader = StreamingUploader(scratch.encoded_dir, object_id, S3_BUCKET_NAME)
+            uploader.start()
+            # Record the uploaded segments in the bucket, so a task started again for this video resumes after them
+            checkpoint = None
+            if CHECKPOINT_INTERVAL > 0:
+                checkpoint = JobCheckpoint(S3_BUCKET_NAME, object_id, scratch.encoded_dir)
+                checkpoint.load()
+                checkpoint.start(uploader)
+                save_checkpoint_on_sigterm(checkpoint)
+            error = None
+            try:
+                cache_update = process_file(file_path, output, object_id, timings, uploader, checkpoint)
+                send_combined_progress(ProgressStatus.UPLOADING, object_id)
+            except TranscodeError as e:
+                cache_update, error = None, str(e)
+            with timings.span("upload_tail"):
+                results = uploader.finish()
+            upload_span.bytes = sum(result.size for result in results if result.ok)
+        # Only renditions that made it to the bucket may be served to later duplicates
+        if cache_update is not None and all(result.ok for result in results):
+            TranscodeCache(S3_BUCKET_NAME).register(cache_update, object_id)
+        if checkpoint is not None:
+            checkpoint.clear()
+        summary = timings.summary()
+        summary["scratch"] = scratch.summary()
+    if error is not None:
+        send_combined_progress(ProgressStatus.ERROR, object_id, error=error)
+        print(f"Error: {error}")
+        return
+    send_combined_progress(ProgressStatus.COMPLETED, object_id, timings=summary)
+
+
+def run_part():
+    """Entry point of a task encoding one part of a fanned-out job, the last part to report merges the job."""
+    part = FanoutPart.from_config()
+    object_id = VIDEO_ID
+    object_path = VIDEO_PATH
+    object_bucket = S3_BUCKET_NAME
+
+    print(f"Received part {part.index} of {part.count} for object_name: {object_id}")
+
+    timings = JobTimings()
+
+    with ScratchSpace(object_id) as scratch:
+        try:
+            scratch.admit(object_size(object_bucket, object_path))
+        except ScratchSpaceError as e:
+            send_combined_progress(ProgressStatus.ERROR, object_id, error=str(e))
+            print(f"Error: {e}")
+            return
+
+        with timings.span("source") as span:
+            file_path = open_s3_source(object_bucket, object_path, scratch.source_dir)
+            if file_path and os.path.exists(file_path):
+                span.bytes = os.path.getsize(file_path)
+        output = os.path.join(scratch.encoded_dir, object_id)
+        with timings.span("upload") as upload_span:
+            uploader = StreamingUploader(scratch.encoded_dir, object_id, S3_BUCKET_NAME)
+            uploader.start()
+            # A part whose source could not be read fails, the merge sends the error
+            report = process_part(file_path, output, object_id, part, timings) if file_path else None
+            with timings.span("upload_tail"):
+                results = uploader.finish()
+            upload_span.bytes = sum(result.size for result in results if result.ok)
+        # A part that failed still reports, so the merge sends the error instead of waiting for it forever
+        if report is None:
+            report = {"index": part.index, "start": part.start, "renditions": [], "audio": False, "segments": {}, "ok": False}
+        report["ok"] = report["ok"] and all(result.ok for result in results)
+        report["timings"] = timings.summary()
+        save_report(object_bucket, object_id, report)
+
+        if claim_merge(object_bucket, object_id, part.count):
+            summary = merge_parts(object_bucket, object_id, os.path.join(scratch.path, "merge"))
+            if summary is not None:
+                send_combined_progress(ProgressStatus.COMPLETED, object_id, timings=summary)
+
+
+def run_merge():
+    """Entry point of a task merging a fanned-out job whose parts all reported."""
+    with ScratchSpace(VIDEO_ID) as scratch:
+        summary = merge_parts(S3_BUCKET_NAME, VIDEO_ID, os.path.join(scratch.path, "merge"))
+    if summary is not None:
+        send_combined_progress(ProgressStatus.COMPLETED, VIDEO_ID, timings=summary)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if RUN_MODE == "part":
+        run_part()
+    elif RUN_MODE == "merge":
+        run_merge()
+    else:
+        main()
\ No newline at end of file
@@ -1,7 +1,12 @@
 import enum
 import json
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
 import boto3
-from config import STATUS_TOPIC, sns_client
+from config import STATUS_TOPIC, PROGRESS_INTERVAL, sns_client
 
 class ProgressStatus(enum.Enum):
     TRANSCODING = 0
@@ -9,22 +14,126 @@ class ProgressStatus(enum.Enum):
     COMPLETED = 2
     ERROR = 3
     UPLOADED = 4
+    PLAYABLE = 5
 
 
-def send_combined_progress(status: ProgressStatus, video_id=None, progress_dict=None, error=None):
+# Publishing client of the current process. Pool workers are forked from the parent, so they
+# must create their own client instead of reusing the connections they inherited.
+_publisher_state = {"pid": os.getpid(), "client": sns_client}
+
+def _publishing_client():
+    """Return the SNS client this process publishes with."""
+    if _publisher_state["pid"] != os.getpid():
+        _publisher_state.update(pid=os.getpid(), client=boto3.client('sns'))
+    return _publisher_state["client"]
+
+
+def send_combined_progress(status: ProgressStatus, video_id=None, progress_dict=None, error=None, timings=None):
     """Send combined transcoding progress for all qualities."""
 
     message = {
         "videoId": video_id if video_id else None,
-        "progress": progress_dict.copy() if progress_dict else None,  # Create a copy of the dict to avoid any threading issues
+        "progress": dict(progress_dict) if progress_dict else None,  # Create a copy of the dict to avoid any threading issues
         "status": status.name,
         "error": error
     }
+    if timings is not None:
+        # Per-stage timing summary of the job, sent with the COMPLETED message
+        message["timings"] = timings
 
     try:
-        sns_client.publish(
+        _publishing_client().publish(
             TopicArn=STATUS_TOPIC,
             Message=json.dumps(message)
         )
     except Exception as e:
-        print(f"Error sending SNS message: {str(e)}")
\ No newline at end of file
+        print(f"Error sending SNS message: {str(e)}")
+
+
+class SharedProgress:
+    """
+    Progress of every quality in a shared-memory array, written by the workers without any IPC.
+
+    Each quality has one slot per part (a chunk in the chunked engine) holding the part's share
+    of the quality's progress in basis points. The object can be passed to pool workers: it is
+    pickled by the name of its shared memory block, which the worker attaches to.
+    """
+
+    def __init__(self, labels: list[str], parts: int = 1, name: str | None = None):
+        self.labels = list(labels)
+        self.parts = parts
+        self._owner = name is None
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=max(1, len(self.labels) * parts) * 4)
+            self._memory.buf[:] = bytes(len(self._memory.buf))
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+
+    def __reduce__(self):
+        return (SharedProgress, (self.labels, self.parts, self._memory.name))
+
+    def set_part(self, label: str, part: int, basis_points: int):
+        struct.pack_into("i", self._memory.buf, (self.labels.index(label) * self.parts + part) * 4, int(basis_points))
+
+    def __setitem__(self, label: str, percentage: int):
+        self.set_part(label, 0, int(percentage) * 100)
+
+    def __getitem__(self, label: str) -> int:
+        values = struct.unpack_from(f"{self.parts}i", self._memory.buf, self.labels.index(label) * self.parts * 4)
+        return min(100, sum(values) // 100)
+
+    def snapshot(self) -> dict[str, int]:
+        return {label: self[label] for label in self.labels}
+
+    def close(self):
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+class ProgressPublisher:
+    """
+    Publish the progress of a job from a single thread of the parent process.
+
+    The shared progress is sampled frequently but a message is sent at most once per interval,
+    carrying only the qualities that changed. A quality reaching 100% is sent right away.
+    """
+
+    def __init__(self, video_id: str, shared_progress: SharedProgress, interval: float = PROGRESS_INTERVAL):
+        self.video_id = video_id
+        self.shared_progress = shared_progress
+        self.interval = interval
+        self._sent: dict[str, int] = {}
+        self._last_sent = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # Announce every quality at 0% so clients can draw them before the first update
+        self.publish(force=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(min(0.25, self.interval)):
+            self.publish()
+
+    def publish(self, force: bool = False):
+        snapshot = self.shared_progress.snapshot()
+        delta = {label: value for label, value in snapshot.items() if self._sent.get(label) != value}
+        finished = any(value == 100 for value in delta.values())
+        due = time.monotonic() - self._last_sent >= self.interval
+        if not (force or (delta and (due or finished))):
+            return
+
+        try:
+            send_combined_progress(ProgressStatus.TRANSCODING, self.video_id, delta)
+            self._sent.update(delta)
+            self._last_sent = time.monotonic()
+        except Exception as e:
+            print(f"Error publishing progress: {e}")
+
+    def stop(self):
+        """Stop the publisher thread and flush the last changes."""
+        self._stop.set()
+        self._thread.join()
+        self.publish()
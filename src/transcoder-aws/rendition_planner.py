@@ -0,0 +1,104 @@
+import math
+from dataclasses import dataclass
+from video_quality import VideoQuality
+
+# Rungs below this height do not need more than MAX_LOW_RUNG_FPS frames per second
+HIGH_FPS_MIN_HEIGHT = 720
+MAX_LOW_RUNG_FPS = 30
+# A rung is only worth encoding if the rung above it has at least this many times its bitrate
+MIN_BITRATE_STEP = 1.25
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """A rung of the ladder fitted to a source: output size, video bitrate and frame rate."""
+    label: str
+    width: int
+    height: int
+    bitrate: str  # ffmpeg notation, e.g. "2500k"
+    fps: float | None = None  # None keeps the frame rate of the source
+    preset: str | None = None  # x264 preset, None keeps the encoder default
+
+    @property
+    def bitrate_kbps(self) -> int:
+        return int(self.bitrate[:-1])
+
+    @property
+    def bandwidth(self) -> int:
+        """Video bitrate in bits per second, as advertised in the master playlist."""
+        return self.bitrate_kbps * 1000
+
+    @property
+    def encoder_options(self) -> dict:
+        """Extra ffmpeg output options of the rendition."""
+        return {"preset": self.preset} if self.preset else {}
+
+    @property
+    def video_filter(self) -> str:
+        """ffmpeg filter chain scaling the source to the rendition."""
+        if self.fps:
+            return f"scale={self.width}:{self.height},fps={self.fps:g}"
+        return f"scale={self.width}:{self.height}"
+
+
+def even(value: float) -> int:
+    """Round to the nearest even number, as required by yuv420p."""
+    return max(2, int(round(value / 2)) * 2)
+
+
+def fit_dimensions(rung: VideoQuality, width: int, height: int) -> tuple[int, int]:
+    """Scale the source so its short side matches the rung, keeping the aspect ratio."""
+    short_side = min(width, height)
+    if short_side <= rung.height:
+        return even(width), even(height)
+    scale = rung.height / short_side
+    return even(width * scale), even(height * scale)
+
+
+def cap_frame_rate(rung: VideoQuality, fps: float) -> float | None:
+    """Frame rate of a rung, an integer fraction of the source on the lower rungs so the cadence stays even."""
+    if rung.height >= HIGH_FPS_MIN_HEIGHT or fps <= MAX_LOW_RUNG_FPS:
+        return None
+    return round(fps / math.ceil(fps / MAX_LOW_RUNG_FPS), 3)
+
+
+def plan_renditions(media_info, complexity: float = 1.0) -> list[Rendition]:
+    """
+    Fit the quality ladder to a probed source.
+
+    Rungs are picked on the short side of the source so portrait videos get the same ladder as
+    landscape ones, scaled with the aspect ratio of the source. Bitrates are scaled by the
+    complexity of the content and capped at the bitrate of the source, the lower rungs get at most
+    MAX_LOW_RUNG_FPS frames per second, and rungs whose bitrate is too close to the rung above them
+    are dropped.
+
+    Parameters:
+    - media_info (MediaInfo): Probed source video.
+    - complexity (float): Factor applied to the ladder bitrates, from the complexity probe.
+
+    Returns:
+    - list[Rendition]: Renditions to encode in descending order, empty if the source is too small.
+    """
+    top = VideoQuality.from_height(min(media_info.width, media_info.height))
+    if top is None:
+        return []
+
+    source_kbps = media_info.bitrate // 1000
+    renditions = []
+    for rung in VideoQuality.qualities_below(top):
+        kbps = round(int(rung.bitrate[:-1]) * complexity)
+        if source_kbps > 0:
+            kbps = min(kbps, source_kbps)
+        width, height = fit_dimensions(rung, media_info.width, media_info.height)
+        rendition = Rendition(rung.label, width, height, f"{kbps}k", cap_frame_rate(rung, media_info.fps))
+
+        # The rung above already covers this bitrate, encoding it would only cost CPU
+        if renditions and renditions[-1].bitrate_kbps < rendition.bitrate_kbps * MIN_BITRATE_STEP:
+            print(f"Skipping {rung.label}: {kbps}k is too close to {renditions[-1].label} at {renditions[-1].bitrate}")
+            continue
+        renditions.append(rendition)
+
+    print("Renditions: " + ", ".join(
+        f"{r.label} {r.width}x{r.height} {r.bitrate}" + (f" {r.fps:g}fps" if r.fps else "") for r in renditions
+    ))
+    return renditions
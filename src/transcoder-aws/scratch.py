@@ -0,0 +1,230 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+from config import WORK_DIR, HLS_PACKAGING, SCRATCH_MIN_FREE_MB, SCRATCH_RESERVE_FACTOR, SCRATCH_STAGING_DIR, SCRATCH_STAGING_RESERVE_MB
+
+MB = 1024 * 1024
+# Seconds between two measures of the space used by a job
+SAMPLE_INTERVAL = 2.0
+# Seconds between two admission attempts while waiting for space
+ADMISSION_RETRY_INTERVAL = 10.0
+ADMISSION_LOCK = ".admission.lock"
+RESERVATION_FILE = ".reservation"
+# Held by a running job on its work directory, so a sweep never removes it
+JOB_LOCK = ".job.lock"
+# Jobs get their own directory under this one in the staging tmpfs, which other programs may use too
+STAGING_SUBDIR = "transcoder-jobs"
+
+
+class ScratchSpaceError(Exception):
+    """The work volume does not have room for a job."""
+
+
+def directory_size(path: str) -> int:
+    """Bytes used by the files under a directory, 0 if it does not exist."""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += directory_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    # Segments are deleted by the uploader while they are being counted
+                    continue
+    except FileNotFoundError:
+        pass
+    return total
+
+
+def outstanding_reservations(root: str, exclude: str) -> int:
+    """Bytes the other jobs under root reserved and have not used yet."""
+    outstanding = 0
+    if not os.path.isdir(root):
+        return 0
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.path == exclude:
+                continue
+            try:
+                with open(os.path.join(entry.path, RESERVATION_FILE)) as f:
+                    reserved = int(f.read())
+            except (FileNotFoundError, ValueError):
+                continue
+            outstanding += max(0, reserved - directory_size(entry.path))
+    return outstanding
+
+
+def job_is_live(path: str) -> bool:
+    """Whether a job, of this process or another one, still holds the lock of a work directory."""
+    try:
+        fd = os.open(os.path.join(path, JOB_LOCK), os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+class ScratchSpace:
+    """
+    Work directories of a job: the source on the work volume, the encoded output on a tmpfs when
+    SCRATCH_STAGING_DIR is set and has room for the job.
+
+    A job is admitted once the work volume can hold its reservation, SCRATCH_RESERVE_FACTOR bytes
+    per source byte, on top of what the running jobs reserved and SCRATCH_MIN_FREE_MB. Its output
+    is staged when the tmpfs also has SCRATCH_STAGING_RESERVE_MB left over the reservations of the
+    other staged jobs, and stays on the work volume otherwise. The space used is sampled while the
+    job runs, and the directories are removed when it ends, whether it failed or not. Used as a
+    context manager.
+
+    The directories are named after the job and a random suffix, a redelivered message of a video
+    still being transcoded gets directories of its own instead of sharing, and removing, the others.
+    """
+
+    def __init__(self, job_id: str, root: str = WORK_DIR, staging_root: str = SCRATCH_STAGING_DIR):
+        self.job_id = job_id
+        self.name = f"{job_id}-{uuid.uuid4().hex[:12]}"
+        self.root = root
+        self.path = os.path.join(root, self.name)
+        self.source_dir = os.path.join(self.path, "source")
+        # Playlists, previews and the segments not uploaded yet are small and rewritten often, they are staged in memory
+        # when admit finds room. A single fMP4 file per rendition is as large as the rendition, it stays on the work volume.
+        self.staging_root = None
+        if staging_root and HLS_PACKAGING == "ts" and os.path.isdir(staging_root):
+            self.staging_root = os.path.join(staging_root, STAGING_SUBDIR)
+        self.staging_path = None
+        self.encoded_dir = os.path.join(self.path, "encoded")
+        self.reserved = 0
+        self.staging_reserved = 0
+        self.disk_high_water = 0
+        self.staging_high_water = 0
+        self._lock = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        os.makedirs(self.source_dir, exist_ok=True)
+        os.makedirs(self.encoded_dir, exist_ok=True)
+        self._lock = open(os.path.join(self.path, JOB_LOCK), "w")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.cleanup()
+        return False
+
+    def admit(self, source_bytes: int, timeout: float = 0.0):
+        """
+        Reserve the space of a job for a source of the given size, waiting up to timeout seconds for
+        the running jobs to free it. Called inside the with block, once the directories exist.
+
+        Raises:
+        - ScratchSpaceError: The space could not be reserved in time.
+        """
+        required = int(source_bytes * SCRATCH_RESERVE_FACTOR)
+        deadline = time.time() + timeout
+        while True:
+            # Jobs of other processes admit themselves under the same lock, so two of them never count the same free space
+            with open(os.path.join(self.root, ADMISSION_LOCK), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                free = shutil.disk_usage(self.root).free - outstanding_reservations(self.root, self.path)
+                if free - required >= SCRATCH_MIN_FREE_MB * MB:
+                    with open(os.path.join(self.path, RESERVATION_FILE), "w") as f:
+                        f.write(str(required))
+                    self.reserved = required
+                    print(f"Reserved {required / MB:.0f} MB of scratch space, {free / MB:.0f} MB available")
+                    self._admit_staging()
+                    return
+            if time.time() >= deadline:
+                raise ScratchSpaceError(
+                    f"Job {self.job_id} needs {required / MB:.0f} MB of scratch space, "
+                    f"{max(0, free) / MB:.0f} MB available with {SCRATCH_MIN_FREE_MB} MB kept free"
+                )
+            print(f"Waiting for {required / MB:.0f} MB of scratch space...")
+            time.sleep(ADMISSION_RETRY_INTERVAL)
+
+    def _admit_staging(self):
+        """Stage the output of the job in the tmpfs if its reservation fits, called under the admission lock."""
+        if self.staging_root is None:
+            return
+        required = SCRATCH_STAGING_RESERVE_MB * MB
+        staging_path = os.path.join(self.staging_root, self.name)
+        os.makedirs(self.staging_root, exist_ok=True)
+        free = shutil.disk_usage(self.staging_root).free - outstanding_reservations(self.staging_root, staging_path)
+        if free < required:
+            print(f"Not enough room in {self.staging_root}, {max(0, free) / MB:.0f} MB available, staging on the work volume")
+            return
+        self.staging_path = staging_path
+        self.encoded_dir = os.path.join(staging_path, "encoded")
+        os.makedirs(self.encoded_dir, exist_ok=True)
+        with open(os.path.join(staging_path, RESERVATION_FILE), "w") as f:
+            f.write(str(required))
+        self.staging_reserved = required
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        self.disk_high_water = max(self.disk_high_water, directory_size(self.path))
+        if self.staging_path is not None:
+            self.staging_high_water = max(self.staging_high_water, directory_size(self.staging_path))
+
+    def summary(self) -> dict:
+        """Reservation and high-water marks of the job, as sent with the COMPLETED status message."""
+        self.sample()
+        summary = {"reserved_bytes": self.reserved, "disk_high_water_bytes": self.disk_high_water}
+        if self.staging_path is not None:
+            summary["staging_reserved_bytes"] = self.staging_reserved
+            summary["staging_high_water_bytes"] = self.staging_high_water
+        return summary
+
+    def cleanup(self):
+        """Stop sampling and remove the directories of the job."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for path in (self.path, self.staging_path):
+            if path is None:
+                continue
+            try:
+                shutil.rmtree(path, ignore_errors=False)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error deleting {path}: {e}")
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+        print(f"Cleaned up the scratch space of {self.job_id}, high water {self.disk_high_water / MB:.0f} MB on disk"
+              + (f", {self.staging_high_water / MB:.0f} MB staged" if self.staging_path is not None else ""))
+
+
+def sweep(root: str = WORK_DIR, staging_root: str = SCRATCH_STAGING_DIR):
+    """
+    Remove the work directories left by jobs of a worker that died. Jobs still running, in this
+    process or another one sharing the volume, hold the lock of their work directory and are kept.
+    """
+    for directory in (root, os.path.join(staging_root, STAGING_SUBDIR) if staging_root else None):
+        if not directory or not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                # The staged output of a job is kept while the lock on its work directory is held
+                if job_is_live(os.path.join(root, entry.name)):
+                    continue
+                print(f"Removing stale work directory {entry.path}")
+                shutil.rmtree(entry.path, ignore_errors=True)
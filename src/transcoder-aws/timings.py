@@ -0,0 +1,79 @@
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Span:
+    """Timing of one stage of a job, with the bytes and frames it produced where they apply."""
+    name: str
+    start: float
+    seconds: float = 0.0
+    bytes: int | None = None
+    frames: int | None = None
+
+    @property
+    def end(self) -> float:
+        return self.start + self.seconds
+
+    @property
+    def fps(self) -> float | None:
+        if not self.frames or self.seconds <= 0:
+            return None
+        return self.frames / self.seconds
+
+    def summary(self) -> dict:
+        summary = {"seconds": round(self.seconds, 3)}
+        if self.bytes is not None:
+            summary["bytes"] = self.bytes
+            if self.seconds > 0:
+                summary["bytes_per_second"] = round(self.bytes / self.seconds)
+        if self.frames is not None:
+            summary["frames"] = self.frames
+            if self.fps is not None:
+                summary["fps"] = round(self.fps, 2)
+        return summary
+
+
+def merge_spans(name: str, spans: list[Span]) -> Span:
+    """Combine the spans of parallel work into one, from the first start to the last end."""
+    start = min(span.start for span in spans)
+    sizes = [span.bytes for span in spans if span.bytes is not None]
+    frames = [span.frames for span in spans if span.frames is not None]
+    return Span(
+        name,
+        start,
+        max(span.end for span in spans) - start,
+        sum(sizes) if sizes else None,
+        sum(frames) if frames else None
+    )
+
+
+@dataclass
+class JobTimings:
+    """
+    Spans recorded by a job. Pool workers record into their own instance and return its spans,
+    which the job adds to its own.
+    """
+    started: float = field(default_factory=time.time)
+    spans: list[Span] = field(default_factory=list)
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the enclosed block. The yielded span can be given its bytes and frames."""
+        span = Span(name, time.time())
+        try:
+            yield span
+        finally:
+            span.seconds = time.time() - span.start
+            self.spans.append(span)
+
+    def add(self, spans: list[Span]):
+        self.spans.extend(spans)
+
+    def summary(self) -> dict:
+        """Spans by name, as sent with the COMPLETED status message."""
+        return {
+            "total_seconds": round(time.time() - self.started, 3),
+            "stages": {span.name: span.summary() for span in sorted(self.spans, key=lambda span: span.start)},
+        }
@@ -0,0 +1,306 @@
+"""
+Benchmark of the transcoding pipeline on synthetic sources.
+
+    python benchmark.py run --output baseline.json [--resolutions 360p 1080p] [--durations 10 60] [--moto]
+    python benchmark.py compare baseline.json current.json [--threshold 0.1]
+
+Sources are generated once with the ffmpeg lavfi testsrc2 and sine generators, so every run encodes
+the same content. Each case runs in a fresh process: the source is uploaded to the bucket, then
+opened, transcoded by process_file and uploaded exactly like a worker job, with progress messages
+going to a no-op sink. The S3 stand-in is the S3_ENDPOINT of the environment (the MinIO of
+docker-compose), or an in-process moto server with --moto.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+RESOLUTIONS = {"360p": (640, 360), "1080p": (1920, 1080), "2160p": (3840, 2160)}
+DEFAULT_RESOLUTIONS = ["360p", "1080p"]
+DEFAULT_DURATIONS = [10, 60]
+SOURCE_DIR = "./benchmark-sources"
+BENCHMARK_DIR = "./benchmark-jobs"
+BENCHMARK_BUCKET = "benchmark"
+# Seconds between two checks that a case process is still running while its result is awaited
+RESULT_POLL_SECONDS = 5
+
+# Metrics compared by the compare command, and whether a higher value is better
+METRICS = {
+    "wall_seconds": False,
+    "cpu_seconds": False,
+    "peak_rss_mb": False,
+    "bytes_uploaded": False,
+    "requests": False,
+    "encode_fps": True,
+}
+
+
+def generate_source(resolution: str, duration: int) -> str:
+    """Generate a deterministic test video with a tone, reused by later runs."""
+    width, height = RESOLUTIONS[resolution]
+    path = os.path.join(SOURCE_DIR, f"testsrc2_{resolution}_{duration}s.mp4")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(SOURCE_DIR, exist_ok=True)
+    print(f"Generating {path}...")
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p", "-threads", "1",
+        "-c:a", "aac", "-b:a", "128k",
+        "-map_metadata", "-1", "-fflags", "+bitexact", "-flags", "+bitexact",
+        "-movflags", "+faststart",
+        path + ".tmp.mp4"
+    ]
+    subprocess.run(command, check=True)
+    os.replace(path + ".tmp.mp4", path)
+    return path
+
+
+def rung_metrics(base_path: str, started: float, source_fps: float) -> dict:
+    """Frames and encode fps of every rendition, timed from the job start to its final playlist."""
+    import m3u8
+
+    master = m3u8.load(os.path.join(base_path, "master.m3u8"))
+    rungs = {}
+    for variant in master.playlists:
+        playlist_path = os.path.join(base_path, variant.uri)
+        playlist = m3u8.load(playlist_path)
+        seconds = sum(segment.duration for segment in playlist.segments)
+        frames = int(seconds * (variant.stream_info.frame_rate or source_fps))
+        elapsed = max(0.001, os.path.getmtime(playlist_path) - started)
+        rungs[os.path.dirname(variant.uri)] = {
+            "frames": frames,
+            "encode_seconds": round(elapsed, 3),
+            "encode_fps": round(frames / elapsed, 2),
+            "bandwidth": variant.stream_info.bandwidth,
+        }
+    return rungs
+
+
+def run_case(name: str, source: str, results):
+    """Run one job in this process and put its metrics on the results queue."""
+    # Imported here so the environment prepared by the parent applies to the job modules
+    from config import s3_client, S3_BUCKET_NAME
+    from S3_storage import open_s3_source, StreamingUploader
+    from transcoder import process_file
+    from transcode_flow import probe_media
+    from timings import JobTimings
+
+    video_id = f"benchmark-{name}"
+    work_dir = os.path.join(BENCHMARK_DIR, video_id)
+    encoded_dir = os.path.join(work_dir, "encoded")
+    object_path = f"sources/{os.path.basename(source)}"
+
+    # Every request the job sends to S3, multipart parts and retries included
+    requests = {"count": 0}
+    def count_request(**kwargs):
+        requests["count"] += 1
+
+    try:
+        s3_client.upload_file(source, S3_BUCKET_NAME, object_path)
+        source_fps = probe_media(source).fps
+        s3_client.meta.events.register("before-send.s3", count_request)
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.time()
+
+        file_path = open_s3_source(S3_BUCKET_NAME, object_path, os.path.join(work_dir, "tmp"))
+        output = os.path.join(encoded_dir, video_id)
+        uploader = StreamingUploader(encoded_dir, video_id, S3_BUCKET_NAME)
+        uploader.start()
+        timings = JobTimings()
+        process_file(file_path, output, video_id, timings)
+        uploads = uploader.finish()
+        wall = time.time() - started
+
+        s3_client.meta.events.unregister("before-send.s3", count_request)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ffmpeg and the pool workers have exited and been waited for, their usage is complete
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rungs = rung_metrics(os.path.join(encoded_dir, video_id), started, source_fps)
+        frames = sum(rung["frames"] for rung in rungs.values())
+
+        results.put((name, {
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(usage.ru_utime - usage_before.ru_utime + usage.ru_stime - usage_before.ru_stime
+                                 + children.ru_utime + children.ru_stime, 3),
+            # ru_maxrss is in KB on Linux, children report their largest process, not their sum
+            "peak_rss_mb": round(max(usage.ru_maxrss, children.ru_maxrss) / 1024, 1),
+            "bytes_uploaded": sum(upload.size for upload in uploads if upload.ok),
+            "requests": requests["count"],
+            "failed_uploads": sum(1 for upload in uploads if not upload.ok),
+            "encode_fps": round(frames / wall, 2),
+            "rungs": rungs,
+            "stages": timings.summary()["stages"],
+        }))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        delete_prefix(s3_client, S3_BUCKET_NAME, f"{video_id}/")
+        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=object_path)
+
+
+def delete_prefix(s3_client, bucket, prefix):
+    """Remove the objects a case uploaded, so the bucket does not grow across runs."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if keys:
+            s3_client.delete_objects(Bucket=bucket, Delete={"Objects": keys})
+
+
+def read_result(process, results):
+    """
+    Wait for the result of a case process, None when it exits without one. The result is read
+    before the process is joined: a child cannot exit while the data it put on a queue is unread.
+    """
+    while True:
+        alive = process.is_alive()
+        try:
+            return results.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            # A process that had already exited flushed its result before, the last get would have read it
+            if not alive:
+                return None
+
+
+def prepare_environment(use_moto: bool):
+    """Point the job modules at the S3 stand-in, mute progress messages and disable the transcode cache."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    os.environ["PROGRESS_SINK"] = "none"
+    os.environ["TRANSCODE_CACHE"] = "false"
+    os.environ.setdefault("RABBITMQ_HOST", "localhost")
+    os.environ.setdefault("S3_BUCKET_NAME", BENCHMARK_BUCKET)
+
+    server = None
+    if use_moto:
+        from moto.server import ThreadedMotoServer
+
+        server = ThreadedMotoServer(port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        os.environ["S3_ENDPOINT"] = f"http://{host}:{port}"
+        os.environ["S3_ACCESS_KEY"] = "testing"
+        os.environ["S3_SECRET_KEY"] = "testing"
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    import boto3
+    s3 = boto3.client(
+        "s3",
+        endpoint_url=os.environ.get("S3_ENDPOINT"),
+        aws_access_key_id=os.environ.get("S3_ACCESS_KEY"),
+        aws_secret_access_key=os.environ.get("S3_SECRET_KEY"),
+    )
+    try:
+        s3.head_bucket(Bucket=os.environ["S3_BUCKET_NAME"])
+    except Exception:
+        s3.create_bucket(Bucket=os.environ["S3_BUCKET_NAME"])
+    return server
+
+
+def run(args):
+    server = prepare_environment(args.moto)
+    from governor import read_cpu_limit, read_memory_limit
+    from config import TRANSCODE_ENGINE, CONTENT_ADAPTIVE
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": {
+            "platform": platform.platform(),
+            "cpus": read_cpu_limit(),
+            "memory_mb": read_memory_limit() // (1024 * 1024),
+        },
+        "settings": {"engine": TRANSCODE_ENGINE, "content_adaptive": CONTENT_ADAPTIVE},
+        "cases": {},
+    }
+
+    # A fresh process per case keeps the resource usage of the cases apart
+    context = multiprocessing.get_context("spawn")
+    try:
+        for resolution in args.resolutions:
+            for duration in args.durations:
+                name = f"{resolution}_{duration}s"
+                source = generate_source(resolution, duration)
+                print(f"Running {name}...")
+                results = context.Queue()
+                process = context.Process(target=run_case, args=(name, source, results))
+                process.start()
+                result = read_result(process, results)
+                process.join()
+                if result is None or process.exitcode != 0:
+                    print(f"{name} failed with exit code {process.exitcode}")
+                    continue
+                case, metrics = result
+                report["cases"][case] = metrics
+                print(f"{case}: {metrics['wall_seconds']}s wall, {metrics['cpu_seconds']} CPU-s, "
+                      f"{metrics['peak_rss_mb']} MB, {metrics['encode_fps']} fps")
+    finally:
+        if server is not None:
+            server.stop()
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def compare(args) -> int:
+    """Print the change of every metric and return the number of regressions beyond the threshold."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = 0
+    for case, metrics in current["cases"].items():
+        base = baseline["cases"].get(case)
+        if base is None:
+            print(f"{case}: not in the baseline")
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before, after = base.get(metric), metrics.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = change < -args.threshold if higher_is_better else change > args.threshold
+            regressions += regressed
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{case:>14} {metric:>15}: {before:>14} -> {after:<14} ({change:+.1%}){flag}")
+
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transcoding pipeline on synthetic sources.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmark and write the results to a JSON file.")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), default=DEFAULT_RESOLUTIONS)
+    run_parser.add_argument("--durations", nargs="+", type=int, default=DEFAULT_DURATIONS)
+    run_parser.add_argument("--moto", action="store_true", help="Use an in-process moto server instead of S3_ENDPOINT.")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files and flag regressions.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args) else 0)
+
+
+if __name__ == "__main__":
+    main()
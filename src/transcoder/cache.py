@@ -0,0 +1,214 @@
+import hashlib
+import json
+import mmap
+import time
+import urllib.request
+from dataclasses import dataclass
+from botocore.exceptions import ClientError
+from config import s3_client, CACHE_MAX_AGE_DAYS, HLS_PACKAGING
+from S3_storage import MB, copy_s3_prefix
+from transcode_flow import AUDIO_BITRATE, AUDIO_LABEL, HLS_SEGMENT_DURATION, is_remote_source
+from rendition_planner import Rendition
+
+CACHE_PREFIX = "transcode-cache"
+# Attempts at updating an index that other workers keep changing
+INDEX_UPDATE_ATTEMPTS = 5
+# Error codes of a conditional write that lost to a concurrent one
+CONDITION_FAILED = ("PreconditionFailed", "ConditionalRequestConflict")
+# Bump when the encoding pipeline changes in a way the parameters below do not capture
+ENCODER_VERSION = 3
+
+
+def source_digest(file_path) -> str:
+    """SHA-256 of the source, memory-mapped for local files and streamed for presigned URLs."""
+    digest = hashlib.sha256()
+    if is_remote_source(file_path):
+        with urllib.request.urlopen(file_path) as response:
+            for chunk in iter(lambda: response.read(8 * MB), b""):
+                digest.update(chunk)
+    else:
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            digest.update(mapped)
+    return digest.hexdigest()
+
+
+def rendition_key(quality: Rendition) -> str:
+    """Cache key of a quality: its label and every encoder parameter that changes the output."""
+    return f"{quality.label}:v{ENCODER_VERSION}:h264:{quality.width}x{quality.height}:{quality.bitrate}:{quality.fps or 'src'}fps:{quality.preset or 'medium'}:an:hls{HLS_SEGMENT_DURATION}:{HLS_PACKAGING}"
+
+
+def audio_key() -> str:
+    """Cache key of the audio rendition shared by the video renditions."""
+    return f"{AUDIO_LABEL}:v{ENCODER_VERSION}:aac{AUDIO_BITRATE}:hls{HLS_SEGMENT_DURATION}:{HLS_PACKAGING}"
+
+
+@dataclass
+class CacheUpdate:
+    """Renditions a job encoded, to be registered in the cache once they are uploaded."""
+    digest: str
+    qualities: list[Rendition]
+    audio: bool = False
+
+
+class TranscodeCache:
+    """
+    Index of the renditions already encoded from each source, stored in the bucket.
+
+    Every source digest has an index object listing, per rendition key, the video whose prefix
+    holds the rendition. Entries unused for CACHE_MAX_AGE_DAYS are evicted. Eviction only drops
+    index entries, the renditions stay with the video they belong to.
+
+    Workers update an index with conditional writes on its ETag: a write that lost to another one
+    reads the index again and applies its change to the new version, so no entry is lost.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.max_age = CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+
+    def _index_key(self, digest):
+        return f"{CACHE_PREFIX}/{digest}.json"
+
+    def _load(self, digest) -> tuple[dict, str | None]:
+        """The index of a digest and its ETag, None when it does not exist yet."""
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=self._index_key(digest))
+            return json.loads(response["Body"].read()), response["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {"renditions": {}}, None
+            raise
+
+    def _save(self, digest, index: dict, etag: str | None) -> str:
+        """Write the index if it is still the version read with etag, returns the ETag of the new version."""
+        condition = {"IfMatch": etag} if etag is not None else {"IfNoneMatch": "*"}
+        response = s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self._index_key(digest),
+            Body=json.dumps(index).encode("utf-8"),
+            ContentType="application/json",
+            **condition
+        )
+        return response["ETag"]
+
+    def _update(self, digest, change) -> tuple[dict, str | None]:
+        """
+        Apply change to the index of a digest and save it, again on a fresh copy when another worker
+        wrote the index in between. change returns whether it modified the index, nothing is written otherwise.
+
+        Returns:
+        - tuple[dict, str | None]: The index as saved and its ETag.
+        """
+        for attempt in range(INDEX_UPDATE_ATTEMPTS):
+            index, etag = self._load(digest)
+            if not change(index):
+                return index, etag
+            try:
+                return index, self._save(digest, index, etag)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in CONDITION_FAILED or attempt == INDEX_UPDATE_ATTEMPTS - 1:
+                    raise
+                print(f"The transcode cache of {digest} changed, updating it again...")
+
+    def _evict_expired(self, index: dict) -> bool:
+        now = time.time()
+        expired = [key for key, entry in index["renditions"].items() if now - entry["last_used"] > self.max_age]
+        for key in expired:
+            del index["renditions"][key]
+        return bool(expired)
+
+    def restore(self, digest, qualities: list[Rendition], video_id, audio: bool = False) -> tuple[list[Rendition], bool]:
+        """
+        Copy the cached renditions of the given qualities, and the audio rendition if asked, to the prefix of a new video.
+
+        Returns:
+        - list[Rendition]: Qualities restored from the cache, the others still need encoding.
+        - bool: Whether the audio rendition was restored.
+        """
+        try:
+            index, _ = self._load(digest)
+        except Exception as e:
+            print(f"Could not read the transcode cache: {e}")
+            return [], False
+
+        expired = self._evict_expired(index)
+        wanted = [(rendition_key(quality), quality.label, quality) for quality in qualities]
+        if audio:
+            wanted.append((audio_key(), AUDIO_LABEL, None))
+
+        restored = []
+        audio_restored = False
+        # Entries to refresh, and entries whose video is gone with the video they pointed to
+        used = []
+        dropped = {}
+        for key, label, quality in wanted:
+            entry = index["renditions"].get(key)
+            if entry is None:
+                continue
+            try:
+                copied = copy_s3_prefix(self.bucket, f"{entry['videoId']}/{label}/", f"{video_id}/{label}/")
+                if copied == 0:
+                    raise ValueError(f"{entry['videoId']}/{label} no longer exists")
+            except Exception as e:
+                # The video holding the rendition is gone, forget it
+                print(f"Dropping cached {label} rendition: {e}")
+                dropped[key] = entry["videoId"]
+                continue
+
+            used.append(key)
+            if quality is None:
+                audio_restored = True
+            else:
+                restored.append(quality)
+            print(f"Restored {label} from the transcode cache of video {entry['videoId']}")
+
+        def apply(index: dict) -> bool:
+            changed = self._evict_expired(index)
+            for key, dropped_video in dropped.items():
+                # Another worker may have registered the rendition again meanwhile
+                if index["renditions"].get(key, {}).get("videoId") == dropped_video:
+                    del index["renditions"][key]
+                    changed = True
+            now = time.time()
+            for key in used:
+                if key in index["renditions"]:
+                    index["renditions"][key]["last_used"] = now
+                    changed = True
+            return changed
+
+        if expired or used or dropped:
+            try:
+                self._update(digest, apply)
+            except Exception as e:
+                print(f"Could not update the transcode cache: {e}")
+        return restored, audio_restored
+
+    def register(self, update: CacheUpdate, video_id):
+        """Record the renditions of a video that was just transcoded and uploaded."""
+        keys = [rendition_key(quality) for quality in update.qualities] + ([audio_key()] if update.audio else [])
+
+        def apply(index: dict) -> bool:
+            self._evict_expired(index)
+            now = time.time()
+            for key in keys:
+                index["renditions"][key] = {"videoId": video_id, "created": now, "last_used": now}
+            return True
+
+        try:
+            self._update(update.digest, apply)
+        except Exception as e:
+            print(f"Could not update the transcode cache: {e}")
+
+    def evict_expired(self):
+        """Sweep every index object and drop the entries that expired, deleting indexes left empty."""
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{CACHE_PREFIX}/"):
+            for item in page.get("Contents", []):
+                digest = item["Key"][len(CACHE_PREFIX) + 1:-len(".json")]
+                try:
+                    index, etag = self._update(digest, self._evict_expired)
+                    if not index["renditions"]:
+                        # Only the version found empty is deleted, not one a worker registered renditions in since
+                        s3_client.delete_object(Bucket=self.bucket, Key=item["Key"], IfMatch=etag)
+                except Exception as e:
+                    print(f"Could not evict {item['Key']}: {e}")
@@ -0,0 +1,214 @@
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+import m3u8
+from botocore.exceptions import ClientError
+from cache import audio_key, rendition_key
+from config import s3_client, CHECKPOINT_INTERVAL
+from rendition_planner import Rendition
+from transcode_flow import AUDIO_LABEL, HLS_SEGMENT_DURATION
+
+CHECKPOINT_PREFIX = "checkpoints"
+
+
+@dataclass(frozen=True)
+class ResumePoint:
+    """Where the encode of a rendition resumes: after the segments uploaded by earlier attempts."""
+    start: float = 0.0
+    start_number: int = 0
+
+
+def write_playlist(path: str, segments: list[list]):
+    """Write a VOD playlist listing the given [uri, duration] segments, [uri, duration, byterange] for byte ranges."""
+    playlist = m3u8.M3U8()
+    playlist.version = 3
+    playlist.media_sequence = 0
+    playlist.playlist_type = "vod"
+    playlist.is_endlist = True
+    playlist.target_duration = max([HLS_SEGMENT_DURATION] + [math.ceil(segment[1]) for segment in segments])
+    for uri, duration, *byterange in segments:
+        playlist.segments.append(m3u8.Segment(uri=uri, duration=duration, byterange=byterange[0] if byterange else None))
+    playlist.dump(path)
+
+
+class JobCheckpoint:
+    """
+    Manifest of the work done by a job, stored in the bucket so a restarted job for the same video
+    resumes it instead of starting over.
+
+    The manifest lists, per rendition key, the segments already uploaded and whether the rendition
+    is complete. It is saved every CHECKPOINT_INTERVAL seconds and when the task is stopped.
+    Segments are only checkpointed with MPEG-TS packaging, an fMP4 rendition is a single file
+    uploaded at the end of the job.
+    """
+
+    def __init__(self, bucket, video_id, local_path):
+        self.bucket = bucket
+        self.video_id = video_id
+        self.local_path = local_path
+        self.manifest = {"renditions": {}}
+        self._uploader = None
+        # Renditions encoded by this attempt, by label, and the segments earlier attempts uploaded for the resumed ones
+        self._tracked: dict[str, str] = {}
+        self._previous: dict[str, list[list]] = {}
+        # Reentrant, the SIGTERM handler may flush from the main thread while it completes the playlists
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def key(self) -> str:
+        return f"{CHECKPOINT_PREFIX}/{self.video_id}.json"
+
+    @property
+    def complexity(self) -> float | None:
+        """Complexity measured by an earlier attempt, reused so the ladder and its keys stay the same."""
+        return self.manifest.get("complexity")
+
+    @complexity.setter
+    def complexity(self, value: float):
+        self.manifest["complexity"] = value
+
+    def load(self):
+        """Read the manifest left by an earlier attempt of the job, if any."""
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=self.key)
+            self.manifest = json.loads(response["Body"].read())
+            print(f"Resuming from the checkpoint of {time.ctime(self.manifest.get('updated', 0))}")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                print(f"Could not read the checkpoint: {e}")
+        except Exception as e:
+            print(f"Could not read the checkpoint: {e}")
+
+    def resume(self, qualities: list[Rendition], audio: bool, engine: str) -> tuple[set[str], dict[str, ResumePoint]]:
+        """
+        Restore the playlists of the renditions completed by earlier attempts and find where the others resume.
+
+        Parameters:
+        - qualities (list[Rendition]): Qualities the job still has to encode.
+        - audio (bool): Whether the job still has to encode the audio rendition.
+        - engine (str): Transcoding engine. The single pass resumes every quality from the same segment,
+          chunked encodes restart their unfinished qualities.
+
+        Returns:
+        - set[str]: Labels of the completed renditions, the audio one included.
+        - dict[str, ResumePoint]: Resume point of every partially uploaded rendition, by label.
+        """
+        wanted = {quality.label: rendition_key(quality) for quality in qualities}
+        if audio:
+            wanted[AUDIO_LABEL] = audio_key()
+
+        completed = set()
+        partial = {}
+        for label, key in wanted.items():
+            entry = self.manifest["renditions"].get(key)
+            if entry is not None and entry["complete"]:
+                # Its segments are in the bucket, only the playlist is written again to be uploaded with the others
+                os.makedirs(os.path.join(self.local_path, label), exist_ok=True)
+                write_playlist(os.path.join(self.local_path, label, "playlist.m3u8"), entry["segments"])
+                completed.add(label)
+                print(f"{label} was completed by an earlier attempt")
+                continue
+            self._tracked[label] = key
+            if entry is not None and entry["segments"]:
+                partial[label] = entry["segments"]
+
+        video_labels = [quality.label for quality in qualities if quality.label not in completed]
+        if engine == "chunked":
+            partial = {label: segments for label, segments in partial.items() if label == AUDIO_LABEL}
+        elif engine == "single_pass" and video_labels:
+            # Every quality comes out of the same process, they restart together from the least advanced one
+            count = min(len(partial.get(label, [])) for label in video_labels)
+            for label in video_labels:
+                if count:
+                    partial[label] = partial[label][:count]
+                else:
+                    partial.pop(label, None)
+
+        points = {}
+        for label, segments in partial.items():
+            self._previous[label] = segments
+            points[label] = ResumePoint(sum(duration for _, duration in segments), len(segments))
+            print(f"Resuming {label} after {len(segments)} segments, at {points[label].start:.1f}s")
+        # Segments past the resume points are encoded again, they no longer count as uploaded
+        for label, key in self._tracked.items():
+            self.manifest["renditions"][key] = {"label": label, "segments": self._previous.get(label, []), "complete": False}
+        return completed, points
+
+    def complete_resumed(self):
+        """Prepend the segments of earlier attempts to the playlists of the resumed renditions."""
+        with self._lock:
+            for label, segments in self._previous.items():
+                playlist_path = os.path.join(self.local_path, label, "playlist.m3u8")
+                try:
+                    resumed = m3u8.load(playlist_path)
+                    write_playlist(playlist_path, segments + [[segment.uri, segment.duration] for segment in resumed.segments])
+                except Exception as e:
+                    print(f"Error completing the playlist of {label}: {e}")
+            self._previous = {}
+
+    def start(self, uploader):
+        """Save the manifest periodically, with the segments the uploader has uploaded."""
+        self._uploader = uploader
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(CHECKPOINT_INTERVAL):
+            self.flush()
+
+    def stop(self, flush: bool = True):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Save the uploaded segments of every tracked rendition to the manifest."""
+        if self._uploader is None:
+            return
+        with self._lock:
+            uploaded = self._uploader.uploaded_segments()
+            for label, key in self._tracked.items():
+                segments = list(self._previous.get(label, []))
+                known = {uri for uri, _ in self.manifest["renditions"].get(key, {}).get("segments", [])}
+                complete = False
+                playlist_path = os.path.join(self.local_path, label, "playlist.m3u8")
+                if os.path.exists(playlist_path):
+                    try:
+                        playlist = m3u8.load(playlist_path)
+                    except Exception as e:
+                        print(f"Could not read the playlist of {label}: {e}")
+                        continue
+                    done = 0
+                    # Only the segments up to the first one still uploading count, the job resumes after them
+                    for segment in playlist.segments:
+                        if segment.uri not in known and os.path.join(self.local_path, label, segment.uri) not in uploaded:
+                            break
+                        segments.append([segment.uri, segment.duration])
+                        done += 1
+                    complete = playlist.is_endlist and done == len(playlist.segments)
+                self.manifest["renditions"][key] = {"label": label, "segments": segments, "complete": complete}
+
+            self.manifest["updated"] = time.time()
+            try:
+                s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=json.dumps(self.manifest).encode("utf-8"),
+                    ContentType="application/json"
+                )
+            except Exception as e:
+                print(f"Could not save the checkpoint: {e}")
+
+    def clear(self):
+        """Delete the manifest once the job is complete."""
+        self.stop(flush=False)
+        try:
+            s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+        except Exception as e:
+            print(f"Could not delete the checkpoint: {e}")
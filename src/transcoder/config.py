@@ -2,7 +2,6 @@ import os
 import boto3
 from botocore.client import Config
 from dotenv import load_dotenv
-import pika
 
 load_dotenv()
 
@@ -15,17 +14,83 @@ S3_ENDPOINT = os.getenv('S3_ENDPOINT')
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
 
+# Number of videos a worker transcodes at the same time
+TRANSCODE_CONCURRENCY = int(os.getenv('TRANSCODE_CONCURRENCY', '1'))
+# Transcode messages a worker holds beyond TRANSCODE_CONCURRENCY to pick the next job from, 0 runs them in queue order.
+# A buffered job's cost halves after SCHEDULER_AGING_SECONDS of waiting, after SCHEDULER_MAX_WAIT seconds it goes first
+SCHEDULER_WINDOW = int(os.getenv('SCHEDULER_WINDOW', '8'))
+SCHEDULER_AGING_SECONDS = float(os.getenv('SCHEDULER_AGING_SECONDS', '300'))
+SCHEDULER_MAX_WAIT = float(os.getenv('SCHEDULER_MAX_WAIT', '1800'))
+# Directory holding one work directory per job
+WORK_DIR = os.getenv('WORK_DIR', './jobs')
+# Scratch space: a job is admitted when the work volume keeps SCRATCH_MIN_FREE_MB free after reserving SCRATCH_RESERVE_FACTOR
+# bytes per source byte. Its playlists, previews and the segments not uploaded yet are staged in SCRATCH_STAGING_DIR, a tmpfs,
+# when it is set and has SCRATCH_STAGING_RESERVE_MB free for the job on top of the reservations of the other staged jobs
+SCRATCH_RESERVE_FACTOR = float(os.getenv('SCRATCH_RESERVE_FACTOR', '2'))
+SCRATCH_MIN_FREE_MB = int(os.getenv('SCRATCH_MIN_FREE_MB', '512'))
+SCRATCH_STAGING_DIR = os.getenv('SCRATCH_STAGING_DIR', '')
+SCRATCH_STAGING_RESERVE_MB = int(os.getenv('SCRATCH_STAGING_RESERVE_MB', '128'))
+# Seconds a job waits for scratch space before it goes back to the queue
+SCRATCH_ADMISSION_TIMEOUT = float(os.getenv('SCRATCH_ADMISSION_TIMEOUT', '600'))
+# Port of the Prometheus /metrics endpoint of the worker, 0 disables it
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+# Transcoding engine: "pool" runs one ffmpeg per quality, "single_pass" decodes once for the whole ladder,
+# "chunked" splits the video at keyframes and encodes the chunks of every quality in parallel
+TRANSCODE_ENGINE = os.getenv('TRANSCODE_ENGINE', 'pool')
+# Number of chunks per quality in chunked mode, 0 uses one chunk per CPU
+TRANSCODE_CHUNKS = int(os.getenv('TRANSCODE_CHUNKS', '0'))
+
+# Per-title bitrates: encode COMPLEXITY_SAMPLES short samples first and scale the ladder to the content
+CONTENT_ADAPTIVE = os.getenv('CONTENT_ADAPTIVE', 'false').lower() == "true"
+COMPLEXITY_SAMPLES = int(os.getenv('COMPLEXITY_SAMPLES', '3'))
+
+# HLS packaging: "ts" writes one MPEG-TS object per segment, "fmp4" one fMP4 file per rendition addressed by byte range
+HLS_PACKAGING = os.getenv('HLS_PACKAGING', 'ts')
+
+# Thumbnails: widths written in THUMBNAIL_FORMAT ("webp" or "jpeg") next to the JPEG poster, and one trickplay tile every TRICKPLAY_INTERVAL seconds (0 disables the sprites)
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'webp')
+THUMBNAIL_WIDTHS = [int(width) for width in os.getenv('THUMBNAIL_WIDTHS', '1280,640,320').split(',')]
+TRICKPLAY_INTERVAL = int(os.getenv('TRICKPLAY_INTERVAL', '10'))
+
+# Fast-first publishing: encode the lowest rung first at FAST_FIRST_PRESET and publish it before the others, with every engine.
+# The lowest rung keeps the quality of FAST_FIRST_PRESET, it is not encoded again at the preset of the ladder
+FAST_FIRST = os.getenv('FAST_FIRST', 'false').lower() == "true"
+FAST_FIRST_PRESET = os.getenv('FAST_FIRST_PRESET', 'veryfast')
+
+# Transcode cache: reuse the renditions of identical sources, entries unused for CACHE_MAX_AGE_DAYS are evicted.
+# Off by default, every job then hashes its whole source before encoding starts
+TRANSCODE_CACHE = os.getenv('TRANSCODE_CACHE', 'false').lower() == "true"
+CACHE_MAX_AGE_DAYS = int(os.getenv('CACHE_MAX_AGE_DAYS', '90'))
+
+# Seconds between two saves of the checkpoint manifest a restarted job resumes from, 0 disables checkpoints
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '30'))
+
+# Source input: "stream" feeds ffmpeg from a presigned URL when the container allows it, "download" copies it to ./tmp first
+SOURCE_INPUT = os.getenv('SOURCE_INPUT', 'stream')
+
+# Minimum seconds between two progress messages of a job
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '2'))
+# Where progress messages go: "rabbitmq", or "none" to only print them (benchmarks)
+PROGRESS_SINK = os.getenv('PROGRESS_SINK', 'rabbitmq')
+
+# Bulk upload tuning: concurrent uploads per job, and seconds before a slow PUT gets a hedged request (0 disables)
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '16'))
+UPLOAD_HEDGE_AFTER = float(os.getenv('UPLOAD_HEDGE_AFTER', '10'))
+
 # Initialize the S3 client
 s3_client = boto3.client(
     's3',
     endpoint_url=S3_ENDPOINT,
     aws_access_key_id=S3_ACCESS_KEY,
     aws_secret_access_key=S3_SECRET_KEY,
-    config=Config(signature_version="s3v4")
+    config=Config(
+        signature_version="s3v4",
+        # Shared connection pool sized for concurrent uploads, their hedged requests and multipart parts
+        max_pool_connections=UPLOAD_CONCURRENCY * 4,
+        retries={"max_attempts": 3, "mode": "standard"}
+    )
 )
 
 if not isinstance(RABBITMQ_HOST, str):
         raise ValueError("RABBITMQ_HOST must be a string")
-
-RABBITMQ_CONNECTION = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-RABBITMQ_CHANNEL = RABBITMQ_CONNECTION.channel()
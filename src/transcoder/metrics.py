@@ -0,0 +1,152 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metric:
+    """A metric family in the Prometheus text format, optionally split by one label."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label: str | None = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values: dict[str, float] = {}
+
+    def _labels(self, value: str | None, extra: str = "") -> str:
+        pairs = [f'{self.label}="{value}"'] if self.label and value is not None else []
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{self._labels(label)} {value:g}" for label, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, label: str | None = None):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, label: str | None = None):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def dec(self, amount: float = 1, label: str | None = None):
+        self.inc(-amount, label)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: list[float], label: str | None = None):
+        super().__init__(name, help, label)
+        self.buckets = sorted(buckets)
+        self._series: dict[str, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, label: str | None = None):
+        with self._lock:
+            counts, total, count = self._series.get(label, ([0] * len(self.buckets), 0.0, 0))
+            # Buckets are cumulative: the value counts in every bucket whose bound it does not exceed
+            for index in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+                counts[index] += 1
+            self._series[label] = (counts, total + value, count + 1)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for label, (counts, total, count) in sorted(self._series.items(), key=lambda item: str(item[0])):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket_label = self._labels(label, 'le="%g"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket_label} {bucket_count}")
+                inf_label = self._labels(label, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_label} {count}")
+                lines.append(f"{self.name}_sum{self._labels(label)} {total:g}")
+                lines.append(f"{self.name}_count{self._labels(label)} {count}")
+        return lines
+
+
+ACTIVE_JOBS = Gauge("transcoder_active_jobs", "Jobs running on this worker.")
+BUFFERED_JOBS = Gauge("transcoder_buffered_jobs", "Jobs received by this worker and waiting for a free slot.")
+JOBS = Counter("transcoder_jobs_total", "Jobs finished by this worker.", label="status")
+QUEUE_LAG = Histogram(
+    "transcoder_queue_lag_seconds", "Seconds between publishing a job and starting it.",
+    [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+)
+STAGE_SECONDS = Histogram(
+    "transcoder_stage_seconds", "Duration of the stages of a job.",
+    [0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800], label="stage"
+)
+ENCODE_FPS = Histogram(
+    "transcoder_encode_fps", "Frames per second encoded for a rendition.",
+    [5, 10, 25, 50, 100, 200, 400, 800, 1600], label="rendition"
+)
+UPLOAD_THROUGHPUT = Histogram(
+    "transcoder_upload_throughput_bytes_per_second", "Upload throughput of a job.",
+    [2 ** power for power in range(18, 31, 2)]  # 256 KB/s to 1 GB/s
+)
+SCRATCH_HIGH_WATER = Histogram(
+    "transcoder_scratch_high_water_bytes", "Most scratch space used by a job, on the work volume or the staging tmpfs.",
+    [2 ** power for power in range(24, 39, 2)], label="volume"  # 16 MB to 256 GB
+)
+REGISTRY = [ACTIVE_JOBS, BUFFERED_JOBS, JOBS, QUEUE_LAG, STAGE_SECONDS, ENCODE_FPS, UPLOAD_THROUGHPUT, SCRATCH_HIGH_WATER]
+
+
+def record_job(summary: dict):
+    """Fold the timing and scratch space summary of a finished job into the histograms."""
+    for name, stage in summary.get("stages", {}).items():
+        if name.startswith("encode:"):
+            rendition = name.split(":", 1)[1]
+            STAGE_SECONDS.observe(stage["seconds"], "encode")
+            if "fps" in stage:
+                ENCODE_FPS.observe(stage["fps"], rendition)
+        else:
+            STAGE_SECONDS.observe(stage["seconds"], name)
+        if name == "upload" and "bytes_per_second" in stage:
+            UPLOAD_THROUGHPUT.observe(stage["bytes_per_second"])
+
+    scratch = summary.get("scratch", {})
+    if "disk_high_water_bytes" in scratch:
+        SCRATCH_HIGH_WATER.observe(scratch["disk_high_water_bytes"], "disk")
+    if "staging_high_water_bytes" in scratch:
+        SCRATCH_HIGH_WATER.observe(scratch["staging_high_water_bytes"], "staging")
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the worker logs
+        pass
+
+
+def start_metrics_server(port: int):
+    """Serve /metrics from a daemon thread."""
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on port {port}")
+    return server
@@ -1,38 +1,167 @@
 import enum
 import json
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
 import pika
-from config import STATUS_QUEUE_NAME, RABBITMQ_CHANNEL, RABBITMQ_CONNECTION
+from config import STATUS_QUEUE_NAME, RABBITMQ_HOST, PROGRESS_INTERVAL, PROGRESS_SINK
 
 class ProgressStatus(enum.Enum):
     TRANSCODING = 0
     UPLOADING = 1
     COMPLETED = 2
     ERROR = 3
+    UPLOADED = 4
+    PLAYABLE = 5
 
 
-def send_combined_progress(status: ProgressStatus, video_id=None, progress_dict=None, error=None):
-    """Send combined transcoding progress for all qualities."""
+# Publishing state of the current process. Pool workers are forked from the parent, so they
+# must open their own connection instead of writing to the socket they inherited.
+_publisher_state = {"pid": None, "connection": None, "channel": None}
+# Held while the channel is checked, opened and used, by the publisher thread and the main thread alike
+_publisher_lock = threading.Lock()
+
+
+def _reset_publisher_lock():
+    # A forked worker may inherit the lock held by a thread of the parent that does not exist in it
+    global _publisher_lock
+    _publisher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_publisher_lock)
+
+
+def _publishing_channel():
+    """Return the RabbitMQ channel this process publishes with, called with _publisher_lock held."""
+    if _publisher_state["pid"] != os.getpid():
+        _publisher_state.update(pid=os.getpid(), connection=None, channel=None)
+
+    if _publisher_state["channel"] is None or not _publisher_state["channel"].is_open:
+        if _publisher_state["connection"] is None or not _publisher_state["connection"].is_open:
+            _publisher_state["connection"] = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+        _publisher_state["channel"] = _publisher_state["connection"].channel()
+    return _publisher_state["channel"]
 
-    global RABBITMQ_CHANNEL
-    if not RABBITMQ_CHANNEL.is_open:
-        RABBITMQ_CHANNEL = RABBITMQ_CONNECTION.channel()
+
+def send_combined_progress(status: ProgressStatus, video_id=None, progress_dict=None, error=None, timings=None):
+    """Send combined transcoding progress for all qualities."""
 
     message = {
         "videoId": video_id if video_id else None,
-        "progress": progress_dict.copy() if progress_dict else None,  # Create a copy of the dict to avoid any threading issues
+        "progress": dict(progress_dict) if progress_dict else None,  # Create a copy of the dict to avoid any threading issues
         "status": status.name,
         "error": error
     }
+    if timings is not None:
+        # Per-stage timing summary of the job, sent with the COMPLETED message
+        message["timings"] = timings
+
+    if PROGRESS_SINK == "none":
+        print(f"Progress: {message}")
+        return
 
     if not isinstance(STATUS_QUEUE_NAME, str):
         raise ValueError("STATUS_QUEUE_NAME must be a string")
 
-    RABBITMQ_CHANNEL.basic_publish(
-        exchange='',
-        routing_key=STATUS_QUEUE_NAME,
-        body=json.dumps(message),
-        properties=pika.BasicProperties(
-            delivery_mode=2,
+    with _publisher_lock:
+        channel = _publishing_channel()
+        channel.basic_publish(
+            exchange='',
+            routing_key=STATUS_QUEUE_NAME,
+            body=json.dumps(message),
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+            )
         )
-    )
-    print(f"Sent combined progress: {message}")
\ No newline at end of file
+    print(f"Sent combined progress: {message}")
+
+
+class SharedProgress:
+    """
+    Progress of every quality in a shared-memory array, written by the workers without any IPC.
+
+    Each quality has one slot per part (a chunk in the chunked engine) holding the part's share
+    of the quality's progress in basis points. The object can be passed to pool workers: it is
+    pickled by the name of its shared memory block, which the worker attaches to.
+    """
+
+    def __init__(self, labels: list[str], parts: int = 1, name: str | None = None):
+        self.labels = list(labels)
+        self.parts = parts
+        self._owner = name is None
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=max(1, len(self.labels) * parts) * 4)
+            self._memory.buf[:] = bytes(len(self._memory.buf))
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+
+    def __reduce__(self):
+        return (SharedProgress, (self.labels, self.parts, self._memory.name))
+
+    def set_part(self, label: str, part: int, basis_points: int):
+        struct.pack_into("i", self._memory.buf, (self.labels.index(label) * self.parts + part) * 4, int(basis_points))
+
+    def __setitem__(self, label: str, percentage: int):
+        self.set_part(label, 0, int(percentage) * 100)
+
+    def __getitem__(self, label: str) -> int:
+        values = struct.unpack_from(f"{self.parts}i", self._memory.buf, self.labels.index(label) * self.parts * 4)
+        return min(100, sum(values) // 100)
+
+    def snapshot(self) -> dict[str, int]:
+        return {label: self[label] for label in self.labels}
+
+    def close(self):
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+class ProgressPublisher:
+    """
+    Publish the progress of a job from a single thread of the parent process.
+
+    The shared progress is sampled frequently but a message is sent at most once per interval,
+    carrying only the qualities that changed. A quality reaching 100% is sent right away.
+    """
+
+    def __init__(self, video_id: str, shared_progress: SharedProgress, interval: float = PROGRESS_INTERVAL):
+        self.video_id = video_id
+        self.shared_progress = shared_progress
+        self.interval = interval
+        self._sent: dict[str, int] = {}
+        self._last_sent = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # Announce every quality at 0% so clients can draw them before the first update
+        self.publish(force=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(min(0.25, self.interval)):
+            self.publish()
+
+    def publish(self, force: bool = False):
+        snapshot = self.shared_progress.snapshot()
+        delta = {label: value for label, value in snapshot.items() if self._sent.get(label) != value}
+        finished = any(value == 100 for value in delta.values())
+        due = time.monotonic() - self._last_sent >= self.interval
+        if not (force or (delta and (due or finished))):
+            return
+
+        try:
+            send_combined_progress(ProgressStatus.TRANSCODING, self.video_id, delta)
+            self._sent.update(delta)
+            self._last_sent = time.monotonic()
+        except Exception as e:
+            print(f"Error publishing progress: {e}")
+
+    def stop(self):
+        """Stop the publisher thread and flush the last changes."""
+        self._stop.set()
+        self._thread.join()
+        self.publish()
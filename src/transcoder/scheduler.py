@@ -0,0 +1,108 @@
+import json
+import subprocess
+import time
+from dataclasses import dataclass, field
+from config import s3_client, SCHEDULER_AGING_SECONDS, SCHEDULER_MAX_WAIT
+from S3_storage import object_size
+
+# Pixels of the reference frame the cost of a job is expressed in, a second of 1080p costs 1
+REFERENCE_PIXELS = 1920 * 1080
+# Bitrate assumed for a 1080p source when its header cannot be probed
+NOMINAL_BITRATE = 5_000_000
+# The probe reads a few KB, a slow or unreachable source is costed from its size instead
+PROBE_TIMEOUT = 30
+PROBE_URL_EXPIRATION = 5 * 60
+
+
+@dataclass
+class PendingJob:
+    """A transcode message held by the worker until a slot is free."""
+    delivery_tag: int
+    body: bytes
+    properties: object
+    user: str
+    cost: float  # Seconds of 1080p-equivalent video
+    received: float = field(default_factory=time.time)
+
+    def waited(self, now: float) -> float:
+        return now - self.received
+
+    def score(self, now: float) -> float:
+        """Cost discounted by the time the job waited, lower runs first."""
+        return self.cost / (1 + self.waited(now) / SCHEDULER_AGING_SECONDS)
+
+
+def probe_cost(bucket: str, object_path: str) -> float:
+    """
+    Estimate the cost of a job from the header of its source: duration times the frame size,
+    relative to 1080p. Falls back to the object size at NOMINAL_BITRATE when the probe fails.
+    """
+    try:
+        url = s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": object_path},
+            ExpiresIn=PROBE_URL_EXPIRATION
+        )
+        # ffprobe only reads the container header, with ranged reads when it is at the end of the file
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "format=duration:stream=width,height", "-of", "json", url],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=PROBE_TIMEOUT
+        )
+        data = json.loads(result.stdout)
+        stream = data["streams"][0]
+        duration = float(data["format"]["duration"])
+        return duration * stream["width"] * stream["height"] / REFERENCE_PIXELS
+    except Exception as e:
+        print(f"Could not probe the header of {object_path}, estimating its cost from its size: {e}")
+    try:
+        return object_size(bucket, object_path) * 8 / NOMINAL_BITRATE
+    except Exception as e:
+        # The job fails quickly on a missing source, it may as well run early
+        print(f"Could not read the size of {object_path}: {e}")
+        return 0.0
+
+
+class FairShareScheduler:
+    """
+    Prioritized buffer of the transcode messages a worker holds.
+
+    Users with the fewest running jobs go first, so one user uploading many long videos only
+    takes the slots nobody else needs. Among them, the job with the lowest cost goes first, its
+    cost shrinking as it waits so long jobs still make progress, and any job waiting longer than
+    SCHEDULER_MAX_WAIT seconds goes before all the others.
+    """
+
+    def __init__(self):
+        self.pending: list[PendingJob] = []
+        self.running: dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def active(self) -> int:
+        """Number of jobs taken out of the buffer and not done yet."""
+        return sum(self.running.values())
+
+    def add(self, job: PendingJob):
+        self.pending.append(job)
+
+    def next(self) -> PendingJob | None:
+        """Take the job to run next out of the buffer and count it as running."""
+        if not self.pending:
+            return None
+        now = time.time()
+        job = min(self.pending, key=lambda job: (
+            job.waited(now) < SCHEDULER_MAX_WAIT,
+            self.running.get(job.user, 0),
+            job.score(now),
+        ))
+        self.pending.remove(job)
+        self.running[job.user] = self.running.get(job.user, 0) + 1
+        return job
+
+    def done(self, job: PendingJob):
+        self.running[job.user] -= 1
+        if not self.running[job.user]:
+            del self.running[job.user]
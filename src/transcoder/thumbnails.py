@@ -0,0 +1,132 @@
+import math
+import os
+import subprocess
+from config import THUMBNAIL_FORMAT, THUMBNAIL_WIDTHS, TRICKPLAY_INTERVAL
+from progress import send_combined_progress, ProgressStatus
+from rendition_planner import even
+from timings import JobTimings, Span
+from transcode_flow import MediaInfo, source_input_options
+
+# Name kept for the pages that link the poster of a video directly
+POSTER_NAME = "thumbnail.jpg"
+# Keyframes spread over the video, the most representative one becomes the thumbnail
+THUMBNAIL_CANDIDATES = 24
+# Fraction of the video skipped at each end when picking candidates, away from intros and end credits
+THUMBNAIL_MARGIN = 0.05
+# Trickplay sprite sheets: a grid of TRICKPLAY_COLUMNS x TRICKPLAY_ROWS tiles TRICKPLAY_WIDTH pixels wide
+TRICKPLAY_DIR = "trickplay"
+TRICKPLAY_WIDTH = 160
+TRICKPLAY_COLUMNS = 5
+TRICKPLAY_ROWS = 5
+TRICKPLAY_INDEX = "thumbnails.vtt"
+
+IMAGE_OPTIONS = {
+    "jpeg": ("jpg", ["-q:v", "3"]),
+    "webp": ("webp", ["-c:v", "libwebp", "-quality", "80"]),
+}
+
+
+def scaled_size(media_info: MediaInfo, width: int) -> tuple[int, int]:
+    """Size of an image at the given width, never larger than the source."""
+    width = min(width, media_info.width)
+    return even(width), even(width * media_info.height / media_info.width)
+
+
+def vtt_timestamp(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def write_trickplay_index(path: str, duration: float, tile_width: int, tile_height: int):
+    """Write the WebVTT index mapping every interval of the video to its tile in the sprite sheets."""
+    per_sheet = TRICKPLAY_COLUMNS * TRICKPLAY_ROWS
+    lines = ["WEBVTT", ""]
+    for index in range(max(1, math.ceil(duration / TRICKPLAY_INTERVAL))):
+        start = index * TRICKPLAY_INTERVAL
+        end = min(duration, start + TRICKPLAY_INTERVAL)
+        # Sheets are numbered from 1 by the image2 muxer
+        sheet, position = divmod(index, per_sheet)
+        x = (position % TRICKPLAY_COLUMNS) * tile_width
+        y = (position // TRICKPLAY_COLUMNS) * tile_height
+        lines.append(f"{vtt_timestamp(start)} --> {vtt_timestamp(end)}")
+        lines.append(f"sprite_{sheet + 1:03d}.jpg#xywh={x},{y},{tile_width},{tile_height}")
+        lines.append("")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def create_previews(file_path, base_path, media_info: MediaInfo) -> list[Span]:
+    """
+    Create the thumbnails and the trickplay sprite sheets of a video from a single decode.
+
+    Only the keyframes of the source are decoded. The thumbnail is the most representative of
+    THUMBNAIL_CANDIDATES keyframes spread over the video, picked by the ffmpeg thumbnail filter, and
+    is written at every width of THUMBNAIL_WIDTHS in THUMBNAIL_FORMAT, plus the JPEG poster. The
+    sprite sheets hold one tile every TRICKPLAY_INTERVAL seconds, indexed by a WebVTT file.
+
+    Parameters:
+    - file_path (str): Path or URL of the source video.
+    - base_path (str): Directory of the encoded video.
+    - media_info (MediaInfo): Probed source video.
+
+    Returns:
+    - list[Span]: The span of the work done.
+    """
+    print("Creating thumbnails and trickplay sprites...")
+    timings = JobTimings()
+    extension, image_options = IMAGE_OPTIONS[THUMBNAIL_FORMAT]
+    widths = sorted({scaled_size(media_info, width) for width in THUMBNAIL_WIDTHS}, reverse=True)
+    largest_width, largest_height = widths[0]
+    trickplay = TRICKPLAY_INTERVAL > 0
+
+    # Keyframes are scaled once to the largest thumbnail, then split between the thumbnail and the sprites
+    margin = media_info.duration * THUMBNAIL_MARGIN
+    candidate_rate = THUMBNAIL_CANDIDATES / max(media_info.duration - 2 * margin, 1)
+    filter_graph = [
+        f"[0:v]scale={largest_width}:{largest_height}" + (",split=2[candidates][tiles]" if trickplay else "[candidates]"),
+        f"[candidates]trim=start={margin:.3f},fps={candidate_rate:.6f},thumbnail={THUMBNAIL_CANDIDATES},"
+        f"split={len(widths) + 1}" + "".join(f"[t{index}]" for index in range(len(widths) + 1)),
+    ]
+    # The last branch of the split is the poster, at the largest width
+    outputs = ["-map", f"[t{len(widths)}]", "-frames:v", "1", *IMAGE_OPTIONS["jpeg"][1], os.path.join(base_path, POSTER_NAME)]
+    for index, (width, height) in enumerate(widths):
+        filter_graph.append(f"[t{index}]scale={width}:{height}[thumbnail{index}]")
+        outputs += [
+            "-map", f"[thumbnail{index}]", "-frames:v", "1", *image_options,
+            os.path.join(base_path, f"thumbnail_{width}.{extension}")
+        ]
+
+    if trickplay:
+        tile_width, tile_height = scaled_size(media_info, TRICKPLAY_WIDTH)
+        trickplay_path = os.path.join(base_path, TRICKPLAY_DIR)
+        os.makedirs(trickplay_path, exist_ok=True)
+        filter_graph.append(
+            f"[tiles]fps=1/{TRICKPLAY_INTERVAL},scale={tile_width}:{tile_height},"
+            f"tile={TRICKPLAY_COLUMNS}x{TRICKPLAY_ROWS}[sprites]"
+        )
+        outputs += ["-map", "[sprites]", "-q:v", "5", os.path.join(trickplay_path, "sprite_%03d.jpg")]
+
+    input_options = [arg for key, value in source_input_options(file_path).items() for arg in (f"-{key}", str(value))]
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        *input_options,
+        "-skip_frame", "nokey",  # Decode the keyframes only, every other frame is skipped by the decoder
+        "-i", file_path,
+        "-filter_complex", ";".join(filter_graph),
+        *outputs
+    ]
+
+    with timings.span("previews"):
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if trickplay:
+                write_trickplay_index(os.path.join(trickplay_path, TRICKPLAY_INDEX), media_info.duration, tile_width, tile_height)
+            print(f"Thumbnails created in {base_path}")
+        except subprocess.CalledProcessError as e:
+            send_combined_progress(ProgressStatus.ERROR, error=str(e))
+            print(f"Error: ffmpeg command failed. {e.stderr.decode('utf-8', 'replace').strip()}")
+        except Exception as e:
+            send_combined_progress(ProgressStatus.ERROR, error=str(e))
+            print(f"Unexpected error: {e}")
+    return timings.spans
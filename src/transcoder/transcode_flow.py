@@ -1,195 +1,528 @@
+import json
+import math
 import os
 import subprocess
+import time
+from dataclasses import dataclass
+from multiprocessing import Pool
+import m3u8
 from ffmpeg import FFmpeg, Progress
-from video_quality import VideoQuality
-from progress import send_combined_progress, ProgressStatus
-from config import RABBITMQ_HOST
+from rendition_planner import Rendition
+from governor import ResourcePlan, read_cpu_limit
+from progress import send_combined_progress, ProgressStatus, SharedProgress
+from timings import JobTimings, Span, merge_spans
+from config import RABBITMQ_HOST, HLS_PACKAGING, TRANSCODE_CHUNKS
 
-def get_video_quality(file_path):
-    # Get the resolution-based quality of a video using ffprobe and map to VideoQuality.
+HLS_SEGMENT_DURATION = 6
+# The audio is encoded once into its own rendition, shared by every video rendition
+AUDIO_LABEL = "audio"
+AUDIO_BITRATE = "128k"
+AUDIO_GROUP = "audio"
+MIN_CHUNK_DURATION = 30  # Seconds, shorter chunks cost more in ffmpeg startup than they save
+# Keyframes forced on the segment cadence: every rung cuts its segments at the same times, so a chunk or a
+# resumed job can start any rung from a segment boundary
+KEYFRAME_CADENCE = f"expr:gte(t,n_forced*{HLS_SEGMENT_DURATION})"
+
+class TranscodeError(Exception):
+    """The source cannot be transcoded, the job ends with an ERROR status."""
+
+
+def is_remote_source(file_path) -> bool:
+    """Whether the source is streamed over HTTP instead of read from the local disk."""
+    return str(file_path).startswith(("http://", "https://"))
+
+def hls_output_options(segments_path: str, prefix: str = "", start_number: int = 0) -> dict:
+    """
+    HLS muxer options of a rendition for the configured packaging, MPEG-TS segments or a single fMP4 file.
+    start_number numbers the segments of a resumed encode after the ones already uploaded.
+    """
+    options = {"hls_time": HLS_SEGMENT_DURATION, "hls_playlist_type": "vod"}
+    if start_number:
+        options["start_number"] = start_number
+    if HLS_PACKAGING == "fmp4":
+        # One file per rendition starting with its init section, the playlist addresses the segments by byte range
+        options.update(
+            hls_segment_type="fmp4",
+            hls_flags="single_file",
+            hls_segment_filename=os.path.join(segments_path, f"{prefix}media.mp4")
+        )
+    else:
+        options.update(
+            hls_flags="temp_file",  # Segments are renamed once closed, see StreamingUploader
+            hls_segment_filename=os.path.join(segments_path, f"{prefix}s_%03d.ts")
+        )
+    return options
+
+def source_input_options(file_path) -> dict:
+    """ffmpeg input options for the source, reconnecting dropped HTTP streams during long encodes."""
+    if not is_remote_source(file_path):
+        return {}
+    return {"reconnect": 1, "reconnect_on_network_error": 1, "reconnect_delay_max": 10}
+
+def resume_options(start: float, end: float | None = None) -> tuple[dict, dict]:
+    """Input and output options of an encode from start to end, keeping the timestamps of the whole video."""
+    input_options, output_options = {}, {}
+    if start:
+        input_options["ss"] = start
+        output_options["output_ts_offset"] = start
+    if end is not None:
+        # An input option, so end is a position in the source and not a duration of the output
+        input_options["to"] = end
+    return input_options, output_options
+
+def parse_frame_rate(rate: str | None) -> float:
+    """Parse an ffprobe frame rate such as "30000/1001" into frames per second."""
+    if not rate or rate == "0/0":
+        return 0.0
+    parts = rate.split('/')
+    return float(parts[0]) / float(parts[1]) if len(parts) == 2 and float(parts[1]) else float(parts[0])
+
+def display_rotation(video: dict) -> int:
+    """Rotation in degrees, between 0 and 359, of a video stream probed by ffprobe."""
+    for side_data in video.get("side_data_list", []):
+        if "rotation" in side_data:
+            return round(float(side_data["rotation"])) % 360
+    # Older ffprobe versions report it as a stream tag
+    rotate = str(video.get("tags", {}).get("rotate", "0"))
+    return round(float(rotate)) % 360 if rotate.lstrip("-").replace(".", "", 1).isdigit() else 0
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Metadata of a source video, probed once per job and shared with every worker."""
+    width: int
+    height: int
+    duration: float
+    fps: float
+    total_frames: int
+    bitrate: int
+    has_audio: bool
+
+    @classmethod
+    def from_ffprobe(cls, data: dict) -> "MediaInfo":
+        """Build the media info from the JSON output of ffprobe -show_streams -show_format."""
+        streams = data.get("streams", [])
+        container = data.get("format", {})
+        video = next((stream for stream in streams if stream.get("codec_type") == "video"), None)
+        if video is None:
+            raise ValueError("No video stream found.")
+
+        fps = parse_frame_rate(video.get("avg_frame_rate")) or parse_frame_rate(video.get("r_frame_rate"))
+        duration = float(video.get("duration") or container.get("duration") or 0)
+
+        # Prefer the frame count stored in the container, fall back to duration x fps
+        nb_frames = str(video.get("nb_frames", ""))
+        total_frames = int(nb_frames) if nb_frames.isdigit() else int(duration * fps)
+
+        # ffmpeg applies the display rotation when decoding, a portrait phone video stored as landscape
+        # frames is planned and scaled in its displayed orientation
+        width, height = int(video["width"]), int(video["height"])
+        if display_rotation(video) % 180 == 90:
+            width, height = height, width
+
+        return cls(
+            width=width,
+            height=height,
+            duration=duration,
+            fps=fps,
+            total_frames=total_frames,
+            bitrate=int(video.get("bit_rate") or container.get("bit_rate") or 0),
+            has_audio=any(stream.get("codec_type") == "audio" for stream in streams)
+        )
+
+def probe_media(file_path) -> MediaInfo | None:
+    """Probe the streams and container of a video with a single ffprobe run, None when it cannot be probed."""
     try:
-        # Run ffprobe to get video resolution
         result = subprocess.run(
-            [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height",
-                "-of", "csv=p=0",
-                file_path
-            ],
+            ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", file_path],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True
         )
+        if not result.stdout.strip():
+            raise ValueError(f"Could not probe video: {result.stderr.strip()}")
+        return MediaInfo.from_ffprobe(json.loads(result.stdout))
+    except Exception as e:
+        # The caller reports the failure with the ID of the video
+        print(f"Error probing video: {e}")
+        return None
 
-        # Parse the output for width and height
-        output = result.stdout.strip()
-        if not output:
-            raise ValueError("Could not retrieve video resolution.")
-        width, height = map(int, output.split(','))  # Ensure width and height are integers
+def rendition_frames(quality: Rendition, media_info: MediaInfo, duration: float | None = None) -> int:
+    """Number of frames a rendition has over the given duration, the whole video by default."""
+    return int((media_info.duration if duration is None else duration) * (quality.fps or media_info.fps))
 
-        # Use the VideoQuality enum to map the height
-        quality = VideoQuality.from_height(height)
-        return quality if quality else "Unknown quality"
+def progress_percentage(progress: Progress, duration: float) -> int:
+    """Convert the out_time reported by ffmpeg into a percentage of the video duration."""
+    if duration <= 0:
+        return 0
+    return min(100, int((progress.time.total_seconds() / duration) * 100))
 
-    except Exception as e:
-        send_combined_progress(ProgressStatus.ERROR, error=str(e))
-        print(f"Error determining video quality: {e}")
-        return "Unknown quality"
+def resumed_percentage(progress: Progress, fps: float, start: float, duration: float) -> int:
+    """Percentage of the video done by an encode resumed at start, from its frame count since its timestamps are shifted."""
+    if duration <= 0 or not fps:
+        return 0
+    return min(100, int(((start + progress.frame / fps) / duration) * 100))
 
-def transcode_to_quality(file_path, base_path, quality: VideoQuality, actual_quality: VideoQuality, videoId: str, shared_progress):
-    """Transcode the video to a specific quality."""
-    print(f"Transcoding to {quality.label}...")
+def transcode_to_quality(file_path, base_path, quality: Rendition, media_info: MediaInfo, videoId: str, shared_progress: SharedProgress, threads: int, start: float = 0.0, start_number: int = 0, end: float | None = None) -> list[Span]:
+    """
+    Transcode the video to a specific quality and return the spans of the work done.
+    A resumed encode starts at the given time, with its segments numbered from start_number.
+    A part of a fanned-out job also stops at end.
+    """
+    print(f"Transcoding to {quality.label}" + (f" from {start:.1f}s..." if start else "..."))
     segmentsPath = os.path.join(base_path, quality.label)
     os.makedirs(segmentsPath, exist_ok=True)
-    video_total_frame = get_total_frames(file_path)
-
-    if quality == actual_quality:
-        create_video_thumbnail(file_path, os.path.join(base_path, "thumbnail.jpg"))
+    timings = JobTimings()
 
     # Initialize progress for this quality
     shared_progress[quality.label] = 0
+    input_options, output_options = resume_options(start, end)
 
     # Configure FFmpeg command for transcoding
     ffmpeg = (
         FFmpeg()
         .option("y")
-        .input(file_path)
+        .input(file_path, source_input_options(file_path), **input_options)
         .output(
             os.path.join(segmentsPath, "playlist.m3u8"),
+            map="0:v:0",
             codec="h264",
             b=quality.bitrate,
-            acodec="aac",
-            ab="128k",
-            vf=f"scale={quality.width}:{quality.height}",
-            hls_time=6,
-            hls_playlist_type="vod",
-            hls_segment_filename=os.path.join(segmentsPath, "s_%03d.ts")
+            **quality.encoder_options,
+            vf=quality.video_filter,
+            threads=threads,
+            force_key_frames=KEYFRAME_CADENCE,
+            **output_options,
+            **hls_output_options(segmentsPath, start_number=start_number)
         )
     )
 
+    last_progress: dict[str, Progress] = {}
+
     @ffmpeg.on("progress")
     def on_progress(progress: Progress):
-        percentage = int((float(progress.frame) / video_total_frame) * 100)
-        # Update progress in shared dictionary
-        shared_progress[quality.label] = percentage
-        # Send combined progress
-        send_combined_progress(ProgressStatus.TRANSCODING, videoId, shared_progress)
+        # Update progress in shared memory, the parent process publishes it
+        if start:
+            shared_progress[quality.label] = resumed_percentage(progress, quality.fps or media_info.fps, start, media_info.duration)
+        else:
+            shared_progress[quality.label] = progress_percentage(progress, media_info.duration)
+        last_progress["progress"] = progress
 
     @ffmpeg.on("completed")
     def on_completed():
         shared_progress[quality.label] = 100
-        send_combined_progress(ProgressStatus.TRANSCODING, videoId, shared_progress)
 
-    try:
-        ffmpeg.execute()
-    except Exception as e:
-        send_combined_progress(ProgressStatus.ERROR, error=str(e))
-        print(f"Error during transcoding to {quality.label}: {e}")
-
-def get_total_frames(file_path):
-    """Get the total number of frames in a video using ffprobe."""
-    
-    def get_frames_by_duration_and_fps():
-        """Calculate frames using video duration and frame rate."""
-        duration_result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        duration = float(duration_result.stdout.decode('utf-8').strip())
-        
-        fps_result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=avg_frame_rate", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    with timings.span(f"encode:{quality.label}") as span:
+        try:
+            ffmpeg.execute()
+            span.frames = rendition_frames(quality, media_info, (media_info.duration if end is None else end) - start)
+            if "progress" in last_progress:
+                span.bytes = last_progress["progress"].size
+        except Exception as e:
+            send_combined_progress(ProgressStatus.ERROR, error=str(e))
+            print(f"Error during transcoding to {quality.label}: {e}")
+    return timings.spans
+
+def transcode_audio(file_path, base_path, start: float = 0.0, start_number: int = 0) -> list[Span]:
+    """Encode the audio track once into its own HLS rendition and return the span of the work."""
+    print("Transcoding audio" + (f" from {start:.1f}s..." if start else "..."))
+    segmentsPath = os.path.join(base_path, AUDIO_LABEL)
+    os.makedirs(segmentsPath, exist_ok=True)
+    timings = JobTimings()
+    input_options, output_options = resume_options(start)
+
+    ffmpeg = (
+        FFmpeg()
+        .option("y")
+        .input(file_path, source_input_options(file_path), **input_options)
+        .output(
+            os.path.join(segmentsPath, "playlist.m3u8"),
+            map="0:a:0",
+            acodec="aac",
+            ab=AUDIO_BITRATE,
+            **output_options,
+            **hls_output_options(segmentsPath, start_number=start_number)
         )
-        fps_str = fps_result.stdout.decode('utf-8').strip()
-        fps_parts = fps_str.split('/')
-        fps = float(fps_parts[0]) / float(fps_parts[1]) if len(fps_parts) == 2 else float(fps_str)
-        
-        return int(duration * fps)
+    )
+
+    with timings.span(f"encode:{AUDIO_LABEL}"):
+        try:
+            ffmpeg.execute()
+        except Exception as e:
+            send_combined_progress(ProgressStatus.ERROR, error=str(e))
+            print(f"Error during audio transcoding: {e}")
+    return timings.spans
 
+def transcode_to_quality_task(args) -> tuple[Rendition, list[Span]]:
+    """
+    transcode_to_quality for Pool.imap_unordered, which needs to know the rendition each result belongs to.
+    The worker closes its mapping of the shared progress once the rendition is done.
+    """
     try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries", "stream=nb_read_packets", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        return args[2], transcode_to_quality(*args)
+    finally:
+        args[5].close()
+
+def transcode_ladder(file_path, base_path, qualities: list[Rendition], media_info: MediaInfo, videoId: str, shared_progress: SharedProgress, plan: ResourcePlan, start: float = 0.0, start_number: int = 0, end: float | None = None) -> list[Span]:
+    """
+    Transcode the video to every quality with a single ffmpeg process, decoding the source only once.
+    A resumed pass starts every quality at the given time, with their segments numbered from start_number.
+    A part of a fanned-out job also stops at end.
+    """
+    print(f"Transcoding to {', '.join(quality.label for quality in qualities)} in a single pass" + (f" from {start:.1f}s..." if start else "..."))
+    timings = JobTimings()
+    input_options, output_options = resume_options(start, end)
+    encoded_duration = (media_info.duration if end is None else end) - start
+
+    # Decode once, split the decoded frames and scale each branch to its rung
+    split_labels = "".join(f"[v{index}]" for index in range(len(qualities)))
+    filter_graph = [f"[0:v]split={len(qualities)}{split_labels}"]
+    for index, quality in enumerate(qualities):
+        filter_graph.append(f"[v{index}]{quality.video_filter}[v{index}out]")
+
+    ffmpeg = (
+        FFmpeg()
+        .option("y")
+        .option("filter_complex", ";".join(filter_graph))
+        .input(file_path, source_input_options(file_path), **input_options)
+    )
+
+    # One HLS output per quality, each fed by its own branch of the filter graph
+    for index, quality in enumerate(qualities):
+        segmentsPath = os.path.join(base_path, quality.label)
+        os.makedirs(segmentsPath, exist_ok=True)
+        shared_progress[quality.label] = 0
+
+        ffmpeg = ffmpeg.output(
+            os.path.join(segmentsPath, "playlist.m3u8"),
+            map=f"[v{index}out]",
+            codec="h264",
+            b=quality.bitrate,
+            **quality.encoder_options,
+            threads=plan.threads[quality],
+            force_key_frames=KEYFRAME_CADENCE,
+            **output_options,
+            **hls_output_options(segmentsPath, start_number=start_number)
         )
-        frames = result.stdout.decode('utf-8').strip()
-        if frames and frames != 'N/A':
-            return int(frames)
+
+    @ffmpeg.on("progress")
+    def on_progress(progress: Progress):
+        if start:
+            percentage = resumed_percentage(progress, media_info.fps, start, media_info.duration)
         else:
-            return get_frames_by_duration_and_fps()
-    except Exception as e:
-        print(f"Error getting total frames: {e}")
+            percentage = progress_percentage(progress, media_info.duration)
+        # Every rung advances with the shared decoder, so they all report the same progress
+        for quality in qualities:
+            shared_progress[quality.label] = percentage
+
+    @ffmpeg.on("completed")
+    def on_completed():
+        for quality in qualities:
+            shared_progress[quality.label] = 100
+
+    with timings.span("encode") as span:
         try:
-            return get_frames_by_duration_and_fps()
+            ffmpeg.execute()
+            span.frames = sum(rendition_frames(quality, media_info, encoded_duration) for quality in qualities)
         except Exception as e:
             send_combined_progress(ProgressStatus.ERROR, error=str(e))
-            print(f"Error calculating frames from duration and fps: {e}")
-            return 0
+            print(f"Error during single pass transcoding: {e}")
+
+    # Every rung shares the process, each gets the span of the whole pass with its own frames
+    for quality in qualities:
+        timings.add([Span(f"encode:{quality.label}", span.start, span.seconds, frames=rendition_frames(quality, media_info, encoded_duration) if span.frames else None)])
+    return timings.spans
+
+def get_keyframe_times(file_path):
+    """Get the timestamps (in seconds) of the keyframes of the first video stream."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey", "-show_entries", "frame=pts_time", "-of", "csv=p=0", file_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    times = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        line = line.strip().rstrip(',')
+        if line and line != 'N/A':
+            times.append(float(line))
+    return sorted(times)
+
+def max_chunks() -> int:
+    """Number of chunks the chunked engine splits a video into, at most."""
+    return TRANSCODE_CHUNKS or max(1, math.floor(read_cpu_limit()))
 
-def create_video_thumbnail(video_path: str, thumbnail_path: str, time: str = "00:00:01"):
+def split_at_keyframes(keyframes: list[float], duration: float, chunk_count: int):
     """
-    Create a thumbnail from a video using ffmpeg.
+    Split a video into time ranges that start on source keyframes.
 
     Parameters:
-    - video_path (str): Path to the input video file.
-    - thumbnail_path (str): Path to save the generated thumbnail image.
-    - time (str): Timestamp to capture the thumbnail (format: HH:MM:SS). Default is 00:00:01.
+    - keyframes (list[float]): Keyframe timestamps of the source, in seconds.
+    - duration (float): Duration of the source, in seconds.
+    - chunk_count (int): Desired number of chunks.
 
     Returns:
-    - bool: True if the thumbnail was created successfully, False otherwise.
+    - list[tuple[float, float]]: (start, duration) of each chunk, covering the whole video.
     """
-    if not os.path.exists(video_path):
-        print("Error: The specified video file does not exist.")
-        return False
+    chunk_count = max(1, min(chunk_count, int(duration // MIN_CHUNK_DURATION)))
+    boundaries = [0.0]
+    for index in range(1, chunk_count):
+        target = duration * index / chunk_count
+        # Snap the boundary to the first keyframe at or after the target, so no chunk decodes frames of its neighbour
+        boundary = next((time for time in keyframes if time >= target), None)
+        if boundary is not None and boundary > boundaries[-1] and boundary < duration:
+            boundaries.append(boundary)
+    boundaries.append(duration)
+    return [(start, end - start) for start, end in zip(boundaries, boundaries[1:])]
 
+def transcode_chunk(file_path, base_path, quality: Rendition, chunk_index: int, start: float, duration: float, media_info: MediaInfo, shared_progress: SharedProgress, threads: int) -> Span:
+    """Transcode a single time range of the video to a specific quality and return its span."""
+    segmentsPath = os.path.join(base_path, quality.label)
+    os.makedirs(segmentsPath, exist_ok=True)
+
+    ffmpeg = (
+        FFmpeg()
+        .option("y")
+        .input(file_path, source_input_options(file_path), ss=start, t=duration)
+        .output(
+            os.path.join(segmentsPath, f"chunk_{chunk_index:03d}.m3u8"),
+            map="0:v:0",
+            codec="h264",
+            b=quality.bitrate,
+            **quality.encoder_options,
+            vf=quality.video_filter,
+            threads=threads,
+            # Restart the segment cadence at every chunk start so the stitched segments line up
+            force_key_frames=KEYFRAME_CADENCE,
+            output_ts_offset=start,
+            **hls_output_options(segmentsPath, f"c{chunk_index:03d}_")
+        )
+    )
+
+    def update_progress(seconds):
+        # Each chunk owns a slot holding its share of the quality's progress, in basis points
+        shared_progress.set_part(quality.label, chunk_index, int((min(seconds, duration) / media_info.duration) * 10000))
+
+    last_progress: dict[str, Progress] = {}
+
+    @ffmpeg.on("progress")
+    def on_progress(progress: Progress):
+        # Timestamps are shifted by the chunk start, so derive the encoded time from the frame count
+        fps = quality.fps or media_info.fps
+        update_progress(progress.frame / fps if fps else 0)
+        last_progress["progress"] = progress
+
+    @ffmpeg.on("completed")
+    def on_completed():
+        update_progress(duration)
+
+    span = Span(f"encode:{quality.label}", time.time())
     try:
-        # Execute the ffmpeg command
-        command = [
-            "ffmpeg",
-            "-i", video_path,
-            "-ss", time,  # Seek to the specified time
-            "-vframes", "1",  # Capture a single frame
-            "-q:v", "2",  # Set quality level for the output image
-            thumbnail_path
-        ]
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print(f"Thumbnail created at {thumbnail_path}")
-        return True
-    except subprocess.CalledProcessError as e:
-        send_combined_progress(ProgressStatus.ERROR, error=str(e))
-        print(f"Error: ffmpeg command failed. {e}")
-        return False
+        ffmpeg.execute()
+        span.frames = rendition_frames(quality, media_info, duration)
+        if "progress" in last_progress:
+            span.bytes = last_progress["progress"].size
     except Exception as e:
         send_combined_progress(ProgressStatus.ERROR, error=str(e))
-        print(f"Unexpected error: {e}")
-        return False
+        print(f"Error during transcoding of chunk {chunk_index} to {quality.label}: {e}")
+    span.seconds = time.time() - span.start
+    return span
+
+def transcode_chunk_task(args) -> Span:
+    """transcode_chunk for a pool worker, which closes its mapping of the shared progress once the chunk is done."""
+    try:
+        return transcode_chunk(*args)
+    finally:
+        args[7].close()
+
+def stitch_chunk_playlists(segments_path: str, chunk_count: int):
+    """
+    Concatenate the per-chunk HLS playlists of a quality into a single playlist.m3u8.
+
+    Every chunk is a separate encode, its first segment is marked EXT-X-DISCONTINUITY so players
+    reset their decoder at the boundary instead of relying on the timestamps lining up.
+    """
+    playlist = m3u8.M3U8()
+    # fMP4 segments need EXT-X-MAP, the chunks keep their own init sections
+    playlist.version = 7 if HLS_PACKAGING == "fmp4" else 3
+    playlist.media_sequence = 0
+    playlist.playlist_type = "vod"
+    playlist.is_endlist = True
 
-def create_master_playlist(base_path: str, qualities: list[VideoQuality], output_file: str):
+    target_duration = HLS_SEGMENT_DURATION
+    for chunk_index in range(chunk_count):
+        chunk_playlist_path = os.path.join(segments_path, f"chunk_{chunk_index:03d}.m3u8")
+        chunk_playlist = m3u8.load(chunk_playlist_path)
+        for index, segment in enumerate(chunk_playlist.segments):
+            target_duration = max(target_duration, math.ceil(segment.duration))
+            segment.discontinuity = chunk_index > 0 and index == 0
+            playlist.segments.append(segment)
+        os.remove(chunk_playlist_path)
+
+    playlist.target_duration = target_duration
+    playlist.dump(os.path.join(segments_path, "playlist.m3u8"))
+
+def transcode_chunked(file_path, base_path, qualities: list[Rendition], media_info: MediaInfo, videoId: str, shared_progress: SharedProgress, plan: ResourcePlan) -> list[Span]:
+    """Split the video at keyframes and transcode every (quality, chunk) pair on a process pool."""
+    timings = JobTimings()
+    with timings.span("keyframes"):
+        chunks = split_at_keyframes(get_keyframe_times(file_path), media_info.duration, max_chunks())
+    print(f"Transcoding {len(chunks)} chunks for each of {', '.join(quality.label for quality in qualities)}...")
+
+    # Create a pool of workers sized by the resource plan, fed with every (quality, chunk) pair
+    with Pool(processes=plan.pool_size) as pool:
+        chunk_spans = pool.map(transcode_chunk_task, [
+            (file_path, base_path, quality, chunk_index, start, chunk_duration, media_info, shared_progress, plan.threads[quality])
+            for quality in plan.order
+            for chunk_index, (start, chunk_duration) in enumerate(chunks)
+        ], chunksize=1)
+
+    # One span per quality, from its first chunk start to its last chunk end
+    for quality in qualities:
+        name = f"encode:{quality.label}"
+        timings.add([merge_spans(name, [span for span in chunk_spans if span.name == name])])
+
+    with timings.span("stitch"):
+        for quality in qualities:
+            try:
+                stitch_chunk_playlists(os.path.join(base_path, quality.label), len(chunks))
+            except Exception as e:
+                send_combined_progress(ProgressStatus.ERROR, error=str(e))
+                print(f"Error stitching playlists for {quality.label}: {e}")
+    return timings.spans
+
+def create_master_playlist(base_path: str, qualities: list[Rendition], output_file: str, audio: bool = False):
     """
     Create a master playlist (.m3u8) that references individual quality playlists.
 
     Parameters:
     - base_path (str): The base directory containing the individual quality playlists.
-    - qualities (list[VideoQuality]): List of qualities to include in the master playlist.
+    - qualities (list[Rendition]): List of qualities to include in the master playlist.
     - output_file (str): Path to save the master playlist file.
+    - audio (bool): Whether the video-only qualities share the audio rendition.
     """
     master_playlist_path = os.path.join(base_path, output_file)
 
     try:
-        with open(master_playlist_path, 'w') as f:
+        # Written aside and renamed, so the playlist is never uploaded half-written while it is rewritten
+        with open(master_playlist_path + ".tmp", 'w') as f:
             # M3U8 header
             f.write("#EXTM3U\n")
+            if HLS_PACKAGING == "fmp4":
+                f.write("#EXT-X-VERSION:7\n")
+
+            audio_bandwidth = int(AUDIO_BITRATE[:-1]) * 1000 if audio else 0
+            audio_group = f",AUDIO=\"{AUDIO_GROUP}\"" if audio else ""
+            if audio:
+                audio_path = os.path.join(AUDIO_LABEL, "playlist.m3u8")
+                f.write(f"#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID=\"{AUDIO_GROUP}\",NAME=\"default\",DEFAULT=YES,AUTOSELECT=YES,URI=\"{audio_path}\"\n")
 
             for quality in qualities:
                 playlist_path = os.path.join(quality.label, "playlist.m3u8")
-                bandwidth = int(quality.bitrate[:-1]) * 1000  # Convert bitrate to an integer in bits
-                resolution = f"{quality.width}x{quality.height}" 
+                resolution = f"{quality.width}x{quality.height}"
+                frame_rate = f",FRAME-RATE={quality.fps:.3f}" if quality.fps else ""
 
                 # M3U8 entry for each quality
-                f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={resolution},NAME=\"{quality.label}\"\n")
+                f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={quality.bandwidth + audio_bandwidth},RESOLUTION={resolution}{frame_rate}{audio_group},NAME=\"{quality.label}\"\n")
                 f.write(f"{playlist_path}\n")
+        os.replace(master_playlist_path + ".tmp", master_playlist_path)
 
         print(f"Master playlist created at {master_playlist_path}")
     except Exception as e:
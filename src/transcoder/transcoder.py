@@ -1,87 +1,357 @@
 from __future__ import annotations
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import replace
 import json
-import shutil
 import time
-from multiprocessing import Pool, Manager
-from S3_storage import download_s3_file, upload_s3_folder
-from transcode_flow import create_master_playlist, get_total_frames, get_video_quality, transcode_to_quality
-from video_quality import VideoQuality
-from progress import send_combined_progress, ProgressStatus
+from functools import partial
+from multiprocessing import Pool, get_context
+import pika
+import metrics
+from S3_storage import object_size, open_s3_source, StreamingUploader
+from transcode_flow import AUDIO_LABEL, create_master_playlist, max_chunks, probe_media, TranscodeError, transcode_audio, transcode_chunked, transcode_ladder, transcode_to_quality_task
+from rendition_planner import Rendition, plan_renditions
+from complexity import measure_complexity
+from governor import plan_resources
+from cache import CacheUpdate, TranscodeCache, source_digest
+from checkpoint import JobCheckpoint, ResumePoint
+from scheduler import FairShareScheduler, PendingJob, probe_cost
+from scratch import ScratchSpace, ScratchSpaceError, sweep
+from thumbnails import create_previews
+from timings import JobTimings, Span
+from progress import send_combined_progress, ProgressPublisher, ProgressStatus, SharedProgress
 from config import (
     RABBITMQ_HOST,
     TRANSCODE_QUEUE_NAME,
     S3_BUCKET_NAME,
     STATUS_QUEUE_NAME,
-    RABBITMQ_CHANNEL
+    TRANSCODE_CONCURRENCY,
+    CONTENT_ADAPTIVE,
+    COMPLEXITY_SAMPLES,
+    FAST_FIRST,
+    FAST_FIRST_PRESET,
+    TRANSCODE_CACHE,
+    TRANSCODE_ENGINE,
+    METRICS_PORT,
+    SCRATCH_ADMISSION_TIMEOUT,
+    SCHEDULER_WINDOW
 )
 
+# Source headers probed at the same time to cost the buffered messages
+PROBE_CONCURRENCY = 4
 
-def process_file(file_path, output, videoId: str):
-    """Transcode the video into all qualities equal to or lower than its actual quality."""
+
+def process_file(file_path, output, videoId: str, timings: JobTimings | None = None, uploader: StreamingUploader | None = None, checkpoint: JobCheckpoint | None = None):
+    """
+    Transcode the video into all qualities equal to or lower than its actual quality.
+    Returns the cache entry to register, if any, and raises TranscodeError when the source cannot be transcoded.
+    """
     basePath = os.path.dirname(output)
     os.makedirs(basePath, exist_ok=True)
+    timings = timings if timings is not None else JobTimings()
 
     print(f"Processing file at {file_path}...")
 
-    # Get video total frames
-    video_total_frame = get_total_frames(file_path)
-    if video_total_frame == 0:
-        print("Unable to get video duration. Exiting.")
-        return
+    # Probe the video once, the result is shared with every worker
+    with timings.span("probe"):
+        media_info = probe_media(file_path)
+    if media_info is None or media_info.duration == 0:
+        raise TranscodeError("Unable to get video duration")
 
-    # Determine the actual quality of the video
-    actual_quality = get_video_quality(file_path)
-    if not actual_quality:
-        print("Could not determine video quality. Exiting.")
-        return
+    # Scale the bitrates to the content when the complexity probe is enabled
+    complexity = 1.0
+    if CONTENT_ADAPTIVE:
+        if checkpoint is not None and checkpoint.complexity is not None:
+            # A resumed job keeps the ladder of its earlier attempts
+            complexity = checkpoint.complexity
+        else:
+            with timings.span("complexity"):
+                complexity = measure_complexity(file_path, media_info, COMPLEXITY_SAMPLES)
+        if checkpoint is not None:
+            checkpoint.complexity = complexity
+
+    # Fit the ladder to the source, the top rendition is the actual quality of the video
+    qualities_to_process = plan_renditions(media_info, complexity)
+    if not qualities_to_process:
+        raise TranscodeError("Could not determine video quality")
+    actual_quality = qualities_to_process[0]
+    if FAST_FIRST and uploader is not None and len(qualities_to_process) > 1:
+        # The lowest rung is encoded at the fast preset for good, the cache and the checkpoint key it with that preset
+        qualities_to_process[-1] = replace(qualities_to_process[-1], preset=FAST_FIRST_PRESET)
+
+    # Reuse the renditions of an identical source transcoded before, only the missing ones are encoded
+    digest = None
+    qualities_to_encode = qualities_to_process
+    has_audio = media_info.has_audio
+    audio_cached = False
+    if TRANSCODE_CACHE:
+        with timings.span("cache"):
+            digest = source_digest(file_path)
+            cached, audio_cached = TranscodeCache(S3_BUCKET_NAME).restore(digest, qualities_to_process, videoId, has_audio)
+        qualities_to_encode = [quality for quality in qualities_to_process if quality not in cached]
+    encode_audio = has_audio and not audio_cached
+
+    # Renditions completed by an earlier attempt of this job are kept, partial ones resume after their last uploaded segment
+    pending = qualities_to_encode
+    pending_audio = encode_audio
+    resume_points = {}
+    if checkpoint is not None:
+        completed, resume_points = checkpoint.resume(qualities_to_encode, encode_audio, TRANSCODE_ENGINE)
+        pending = [quality for quality in qualities_to_encode if quality.label not in completed]
+        pending_audio = encode_audio and AUDIO_LABEL not in completed
+    audio_resume = resume_points.get(AUDIO_LABEL, ResumePoint())
 
-    # Transcode to all qualities below or equal to the actual quality in parallel
-    qualities_to_process = VideoQuality.qualities_below(actual_quality)
+    # The audio is encoded once, next to the video-only renditions that share it, and the thumbnails
+    # and trickplay sprites come from a keyframe-only decode of their own
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio_future = executor.submit(transcode_audio, file_path, basePath, audio_resume.start, audio_resume.start_number) if pending_audio else None
+        previews_future = executor.submit(create_previews, file_path, basePath, media_info)
 
-    # Create a manager for shared progress dictionary
-    with Manager() as manager:
-        shared_progress = manager.dict()
-        
-        # Create a pool of workers (one per transcoding task)
-        with Pool(processes=len(qualities_to_process)) as pool:
-            pool.starmap(transcode_to_quality, [(file_path, basePath, quality, actual_quality, videoId, shared_progress) for quality in qualities_to_process])
+        def publish(renditions: list[Rendition]):
+            # Variants may only be published once the audio rendition they reference is complete
+            if audio_future is not None:
+                audio_future.result()
+            publish_renditions(basePath, renditions, uploader, has_audio)
 
+        if FAST_FIRST and uploader is not None and len(pending) > 1:
+            # Make the video playable from its lowest pending rung, then add the others as they finish
+            first = pending[-1]
+            timings.add(encode_qualities(file_path, basePath, [first], actual_quality, media_info, videoId, resume_points=resume_points))
+            playable = [quality for quality in qualities_to_process if quality not in pending] + [first]
+            with timings.span("publish"):
+                publish(playable)
+            send_combined_progress(ProgressStatus.PLAYABLE, videoId)
+
+            def on_rendition_done(quality: Rendition):
+                playable.append(quality)
+                publish(playable)
+
+            timings.add(encode_qualities(file_path, basePath, pending[:-1], actual_quality, media_info, videoId, on_rendition_done, resume_points))
+        elif pending:
+            timings.add(encode_qualities(file_path, basePath, pending, actual_quality, media_info, videoId, resume_points=resume_points))
+
+        if audio_future is not None:
+            timings.add(audio_future.result())
+        timings.add(previews_future.result())
+
+    if checkpoint is not None:
+        checkpoint.complete_resumed()
 
     # Create a master playlist for all qualities
-    create_master_playlist(basePath, qualities_to_process, "master.m3u8")
+    create_master_playlist(basePath, qualities_to_process, "master.m3u8", has_audio)
+
+    if digest is not None:
+        return CacheUpdate(digest, qualities_to_encode, encode_audio)
+    return None
 
-    send_combined_progress(ProgressStatus.COMPLETED, videoId)
 
+def publish_renditions(basePath, renditions: list[Rendition], uploader: StreamingUploader, audio: bool):
+    """Upload finished renditions, and the audio they share, with a master playlist listing only them."""
+    renditions = sorted(renditions, key=lambda rendition: rendition.bandwidth, reverse=True)
+    create_master_playlist(basePath, renditions, "master.m3u8", audio)
+    uploader.publish([rendition.label for rendition in renditions] + ([AUDIO_LABEL] if audio else []))
+    print(f"Published {', '.join(rendition.label for rendition in renditions)}")
 
 
-def callback(ch, method, properties, body):
-    """Callback function for RabbitMQ consumer."""
+def encode_qualities(file_path, basePath, qualities_to_process, actual_quality, media_info, videoId, on_rendition_done=None, resume_points=None) -> list[Span]:
+    """
+    Encode the given qualities with the configured transcoding engine and return the spans of the work.
+    on_rendition_done is called in this process as soon as each quality is done with the pool engine,
+    and for every quality once the single pass or the chunked encode is done.
+    Qualities with a resume point, by label, continue the encode of an earlier attempt.
+    """
+    points = {quality: (resume_points or {}).get(quality.label, ResumePoint()) for quality in qualities_to_process}
+
+    # Size the parallelism to the CPU and memory limits of the container
+    plan = plan_resources(qualities_to_process, actual_quality, TRANSCODE_ENGINE)
+
+    # Workers write their progress into shared memory, a single publisher thread sends it
+    shared_progress = SharedProgress(
+        [quality.label for quality in qualities_to_process],
+        parts=max_chunks() if TRANSCODE_ENGINE == "chunked" else 1
+    )
+    publisher = ProgressPublisher(videoId, shared_progress)
+    publisher.start()
+
+    try:
+        if TRANSCODE_ENGINE == "single_pass":
+            # Decode the source once and encode every quality from the same ffmpeg process
+            # The checkpoint resumes every quality of the pass from the same segment
+            point = points[qualities_to_process[0]]
+            spans = transcode_ladder(file_path, basePath, qualities_to_process, media_info, videoId, shared_progress, plan, point.start, point.start_number)
+        elif TRANSCODE_ENGINE == "chunked":
+            # Encode keyframe-aligned chunks of every quality in parallel and stitch them afterwards
+            spans = transcode_chunked(file_path, basePath, qualities_to_process, media_info, videoId, shared_progress, plan)
+        else:
+            # Create a pool of workers sized by the resource plan, most expensive qualities first
+            spans = []
+            with Pool(processes=plan.pool_size) as pool:
+                tasks = [
+                    (file_path, basePath, quality, media_info, videoId, shared_progress, plan.threads[quality], points[quality].start, points[quality].start_number)
+                    for quality in plan.order
+                ]
+                for quality, quality_spans in pool.imap_unordered(transcode_to_quality_task, tasks, chunksize=1):
+                    spans += quality_spans
+                    if on_rendition_done is not None:
+                        on_rendition_done(quality)
+            return spans
+        # The qualities of a single pass or a chunked encode are done together
+        if on_rendition_done is not None:
+            for quality in qualities_to_process:
+                on_rendition_done(quality)
+        return spans
+    finally:
+        publisher.stop()
+        shared_progress.close()
+
+
+
+def run_job(body):
+    """
+    Download, transcode and upload a single video inside its own scratch space.
+    Returns the timings of the job, None when the video could not be transcoded.
+    """
     message = json.loads(body)
     object_id = message['videoId']  # The S3 object name sent in the message
     object_path = message['path']  # The S3 object location sent in the message
     object_bucket = message['bucket'] # The S3 bucket name sent in the message
     print(f"Received message with object_name: {object_id}")
 
-    # Download the file from S3 and process it
-    file_path = download_s3_file(object_bucket, object_path)
-    output = f"./encoded/{object_id}"
-    process_file(file_path, output, object_id)
-    upload_s3_folder("./encoded/", object_id, S3_BUCKET_NAME)
-    #os.remove(output)
-    # Acknowledge message processing completion
-    ack = ch.basic_ack(delivery_tag=method.delivery_tag)
-    if ack:
-        print(f"Message processed and acknowledged: {object_id}")
-
-    # Clean up after processing
+    timings = JobTimings()
+
+    # Every job gets its own directories, so concurrent jobs never share files, removed when it ends whether it failed or not
+    with ScratchSpace(object_id) as scratch:
+        # Wait for the running jobs to free enough space, the message goes back to the queue otherwise
+        scratch.admit(object_size(object_bucket, object_path), SCRATCH_ADMISSION_TIMEOUT)
+
+        # Stream the file from S3, or download it when it cannot be streamed, and process it
+        with timings.span("source") as span:
+            file_path = open_s3_source(object_bucket, object_path, scratch.source_dir)
+            if file_path and os.path.exists(file_path):
+                span.bytes = os.path.getsize(file_path)
+        if file_path is None:
+            send_combined_progress(ProgressStatus.ERROR, object_id, error=f"Could not read {object_path} from S3")
+            print(f"Error: could not read {object_path} from S3")
+            return None
+        output = os.path.join(scratch.encoded_dir, object_id)
+        # Upload the segments while they are being encoded, the playlists follow once everything is done
+        with timings.span("upload") as upload_span:
+            uploader = StreamingUploader(scratch.encoded_dir, object_id, S3_BUCKET_NAME)
+            uploader.start()
+            error = None
+            try:
+                cache_update = process_file(file_path, output, object_id, timings, uploader)
+            except TranscodeError as e:
+                cache_update, error = None, str(e)
+            with timings.span("upload_tail"):
+                results = uploader.finish()
+            upload_span.bytes = sum(result.size for result in results if result.ok)
+        # Only renditions that made it to the bucket may be served to later duplicates
+        if cache_update is not None and all(result.ok for result in results):
+            TranscodeCache(S3_BUCKET_NAME).register(cache_update, object_id)
+        summary = timings.summary()
+        summary["scratch"] = scratch.summary()
+    if error is not None:
+        send_combined_progress(ProgressStatus.ERROR, object_id, error=error)
+        print(f"Error: {error}")
+        return None
+    send_combined_progress(ProgressStatus.COMPLETED, object_id, timings=summary)
+    return summary
+
+
+def ack_message(channel, delivery_tag, future):
+    """Acknowledge a message once its job is done. Runs on the connection's thread."""
+    metrics.ACTIVE_JOBS.dec()
+    if isinstance(future.exception(), ScratchSpaceError):
+        # Not a failure of the video, another worker or this one once its jobs are done has room for it
+        metrics.JOBS.inc(label="requeued")
+        print(f"Requeuing message {delivery_tag}: {future.exception()}")
+        if channel.is_open:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        return
+
+    if future.exception() is not None:
+        metrics.JOBS.inc(label="error")
+        send_combined_progress(ProgressStatus.ERROR, error=str(future.exception()))
+        print(f"Error processing message {delivery_tag}: {future.exception()}")
+    elif future.result() is None:
+        # run_job already sent the ERROR status of the video
+        metrics.JOBS.inc(label="error")
+    else:
+        metrics.JOBS.inc(label="completed")
+        metrics.record_job(future.result())
+
+    if channel.is_open:
+        channel.basic_ack(delivery_tag=delivery_tag)
+        print(f"Message processed and acknowledged: {delivery_tag}")
+
+
+def probe_job(body) -> tuple[str, float]:
+    """User and estimated cost of a transcode message, read from the header of its source."""
     try:
-        shutil.rmtree("./tmp")
-        shutil.rmtree("./encoded")
-        print("Cleaned up temporary files and folders.")
+        message = json.loads(body)
+        user = message.get('userId') or ""
+        return user, probe_cost(message['bucket'], message['path'])
     except Exception as e:
-        send_combined_progress(ProgressStatus.ERROR, error=str(e))
-        print(f"Error deleting file: {e}")
+        # Invalid messages fail as soon as they run, they may as well run early
+        print(f"Could not estimate the cost of the message: {e}")
+        return "", 0.0
+
+
+def buffer_job(connection, ch, executor, scheduler, job: PendingJob):
+    """Add a probed message to the buffer and start it if a slot is free. Runs on the connection's thread."""
+    scheduler.add(job)
+    metrics.BUFFERED_JOBS.inc()
+    print(f"Buffered message {job.delivery_tag} with cost {job.cost:.0f}, {len(scheduler)} waiting")
+    dispatch(connection, ch, executor, scheduler)
+
+
+def dispatch(connection, ch, executor, scheduler):
+    """Hand the buffered jobs over to job processes while slots are free. Runs on the connection's thread."""
+    while scheduler.active < TRANSCODE_CONCURRENCY:
+        job = scheduler.next()
+        if job is None:
+            return
+        metrics.BUFFERED_JOBS.dec()
+        # The publisher stamps messages in seconds, older messages are not stamped
+        if job.properties.timestamp:
+            metrics.QUEUE_LAG.observe(max(0.0, time.time() - job.properties.timestamp))
+        metrics.ACTIVE_JOBS.inc()
+        future = executor.submit(run_job, job.body)
+        # Job completion is reported from an executor thread, pika channels may only be used from the connection's thread
+        future.add_done_callback(
+            lambda future, job=job: connection.add_callback_threadsafe(
+                partial(finish_job, connection, ch, executor, scheduler, job, future)
+            )
+        )
+
+
+def finish_job(connection, ch, executor, scheduler, job: PendingJob, future):
+    """Acknowledge a finished job and start the next one in its slot. Runs on the connection's thread."""
+    scheduler.done(job)
+    ack_message(ch, job.delivery_tag, future)
+    dispatch(connection, ch, executor, scheduler)
+
+
+def callback(connection, executor, prober, scheduler, ch, method, properties, body):
+    """
+    Callback function for RabbitMQ consumer, buffers the message until a job process is free.
+
+    The worker holds up to SCHEDULER_WINDOW messages more than it runs. The source header of each
+    one is probed on a separate thread, the connection's thread keeps serving heartbeats, and the
+    scheduler picks the next job among them by user and cost.
+    """
+    if not SCHEDULER_WINDOW:
+        # Nothing to choose from, the messages run in queue order
+        buffer_job(connection, ch, executor, scheduler, PendingJob(method.delivery_tag, body, properties, "", 0.0))
+        return
+
+    def on_probed(future):
+        user, cost = future.result()
+        job = PendingJob(method.delivery_tag, body, properties, user, cost)
+        connection.add_callback_threadsafe(partial(buffer_job, connection, ch, executor, scheduler, job))
+
+    prober.submit(probe_job, body).add_done_callback(on_probed)
 
 
 def main():
@@ -90,8 +360,10 @@ def main():
     while True:
         try:
             print(f"Attempt {attempt}: Connecting to RabbitMQ on {RABBITMQ_HOST}...")
-            RABBITMQ_CHANNEL.queue_declare(queue=TRANSCODE_QUEUE_NAME, passive=True)
-            RABBITMQ_CHANNEL.queue_declare(queue=STATUS_QUEUE_NAME, passive=True)
+            connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
+            channel = connection.channel()
+            channel.queue_declare(queue=TRANSCODE_QUEUE_NAME, passive=True)
+            channel.queue_declare(queue=STATUS_QUEUE_NAME, passive=True)
             print("Successfully connected to RabbitMQ!")
             break
         except Exception as e:
@@ -101,11 +373,31 @@ def main():
             time.sleep(5)
             continue
 
-    RABBITMQ_CHANNEL.basic_consume(queue=TRANSCODE_QUEUE_NAME, on_message_callback=callback)
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+
+    # Work directories left by jobs of a previous run of the worker are never cleaned up otherwise
+    sweep()
+
+    # Drop the transcode cache entries nobody used for CACHE_MAX_AGE_DAYS
+    if TRANSCODE_CACHE:
+        TranscodeCache(S3_BUCKET_NAME).evict_expired()
+
+    # Jobs run in fresh processes while this thread keeps serving the connection and its heartbeats
+    executor = ProcessPoolExecutor(max_workers=TRANSCODE_CONCURRENCY, mp_context=get_context("spawn"))
+    prober = ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY)
+    scheduler = FairShareScheduler()
+    # The messages beyond the running jobs stay unacknowledged in the buffer, other workers get them back if this one dies
+    channel.basic_qos(prefetch_count=TRANSCODE_CONCURRENCY + SCHEDULER_WINDOW)
+    channel.basic_consume(queue=TRANSCODE_QUEUE_NAME, on_message_callback=partial(callback, connection, executor, prober, scheduler))
     
     print(f"Waiting for messages in queue: {TRANSCODE_QUEUE_NAME}. To exit press CTRL+C")
-    RABBITMQ_CHANNEL.start_consuming()
+    try:
+        channel.start_consuming()
+    finally:
+        prober.shutdown(wait=False, cancel_futures=True)
+        executor.shutdown(wait=True)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()